@@ -46,6 +46,14 @@ class MovieQAPath(object):
         self.encode_dir = join(self.data_dir, 'encode')
         # Directory of tfrecords
         self.dataset_dir = join(self.data_dir, 'dataset')
+        # Directory of contiguous feature stores
+        self.store_dir = join(self.data_dir, 'store')
+        # Directory of packed frame stores, one per movie
+        self.frame_store_dir = join(self.data_dir, 'frame_store')
+        # Directory of columnar copies of json intermediates
+        self.columnar_dir = join(self.data_dir, 'columnar')
+        # Directory of parsed subtitle files, keyed by content hash
+        self.subtitle_cache_dir = join(self.data_dir, 'subtitle_cache')
 
         self.test_dir = join(self.data_dir, 'test')
 
@@ -57,6 +65,12 @@ class MovieQAPath(object):
 
         # Video data
         self.video_data_file = join(self.data_dir, 'video_data.json')
+        # Manifest of finished video clips, one json object per line
+        self.video_manifest_file = join(self.data_dir, 'video_manifest.jsonl')
+        # Manifest of video clips whose sampled frames are extracted
+        self.sample_manifest_file = join(self.data_dir, 'sample_manifest.jsonl')
+        # Manifest of finished object features, with shape and checksum
+        self.object_feature_manifest = join(self.data_dir, 'object_feature_manifest.jsonl')
         # Images' file names
         self.images_name_file = join(self.data_dir, 'images_name.json')
         # Shot boundary
@@ -83,6 +97,8 @@ class MovieQAPath(object):
         self.encode_qa_file = join(self.data_dir, 'encode_qa.json')
         # Vocabulary file
         self.vocab_file = join(self.data_dir, 'vocab.json')
+        # Content hashes of tokenized text and checksums of vocabulary artifacts
+        self.vocab_manifest_file = join(self.data_dir, 'vocab_manifest.json')
         # Embedding file
         self.embedding_file = join(self.data_dir, 'embedding.npy')
 
@@ -106,6 +122,18 @@ class MovieQAPath(object):
         self.subtitle_feature = join(self.encode_dir, 'subtitle.npz')
         self.qa_feature = join(self.encode_dir, 'qa.npz')
 
+        # Feature stores: all per-movie arrays concatenated, and row index of each imdb_key
+        self.object_feature_store = join(self.store_dir, 'object_feature.npy')
+        self.object_feature_index = join(self.store_dir, 'object_feature_index.json')
+        self.subtitle_feature_store = join(self.store_dir, 'subtitle.npy')
+        self.subtitle_feature_index = join(self.store_dir, 'subtitle_index.json')
+        # Packed QA store: embedding of all questions, their spectra as frame intervals, and row of each qid
+        self.qa_store_file = join(self.store_dir, 'qa_embedding.npy')
+        self.qa_spec_interval_file = join(self.store_dir, 'qa_spec_intervals.npy')
+        self.qa_spec_offset_file = join(self.store_dir, 'qa_spec_offsets.npy')
+        self.qa_spec_length_file = join(self.store_dir, 'qa_spec_lengths.npy')
+        self.qa_store_index = join(self.store_dir, 'qa_index.json')
+
 
 class ExtendedObject(object):
     _group_name = None
@@ -0,0 +1,169 @@
+import argparse
+import random
+from os.path import join, exists
+
+import numpy as np
+from tqdm import tqdm
+
+import utils.data_utils as du
+import utils.func_utils as fu
+from config import MovieQAPath
+from data.columnar import load_npy
+
+_mp = MovieQAPath()
+
+# Storage codecs of features. int8 keeps one float32 scale per vector along the last axis,
+# e.g. per 2048-d object feature or per 300-d sentence embedding, in a sidecar file.
+CODECS = ['float32', 'float16', 'int8']
+
+
+def scale_name(npy_name):
+    """Sidecar holding the scales of an int8 .npy file."""
+    return npy_name[:-len('.npy')] + '.scale.npy'
+
+
+def quantize(arr, codec):
+    """
+    :param arr: float array
+    :param codec: one of CODECS
+    :return data, scale: encoded array, and float32 scales of shape arr.shape[:-1] for int8, None otherwise
+    """
+    arr = np.asarray(arr, dtype=np.float32)
+    if codec == 'float32':
+        return arr, None
+    elif codec == 'float16':
+        return arr.astype(np.float16), None
+    elif codec == 'int8':
+        scale = np.abs(arr).max(axis=-1, initial=0) / 127
+        data = np.rint(arr / np.where(scale > 0, scale, 1)[..., None]).astype(np.int8)
+        return data, scale.astype(np.float32)
+    else:
+        raise ValueError('Unknown codec %s, expected one of %s.' % (codec, CODECS))
+
+
+def dequantize(data, scale=None):
+    """
+    :param data: encoded array
+    :param scale: scales of int8 data
+    :return: float32 array
+    """
+    data = np.asarray(data)
+    if data.dtype == np.int8:
+        return data.astype(np.float32) * np.asarray(scale, dtype=np.float32)[..., None]
+    return data.astype(np.float32)
+
+
+def save(npy_name, arr, codec='float32'):
+    """
+    Encode and save an array. The scales are written before the data, so finished data always have their scales.
+    :param npy_name: path of .npy file
+    :param arr: float array
+    :param codec: one of CODECS, or None to keep the dtype of arr
+    :return: None
+    """
+    data, scale = quantize(arr, codec) if codec is not None else (np.asarray(arr), None)
+    if scale is not None:
+        du.atomic_save(scale_name(npy_name), scale)
+    else:
+        fu.safe_remove(scale_name(npy_name))
+    du.atomic_save(npy_name, data)
+
+
+def read(npy_name, start=None, end=None):
+    """
+    :param npy_name: path of .npy file written by save, or by np.save
+    :param start: first row
+    :param end: end of rows, exclusive
+    :return data, scale: encoded rows [start, end), and their scales for int8 data, None otherwise
+    """
+    data = load_npy(npy_name)[start:end]
+    scale = load_npy(scale_name(npy_name))[start:end] if data.dtype == np.int8 else None
+    return data, scale
+
+
+def load(npy_name, start=None, end=None):
+    """
+    :return: float32 rows [start, end) of a .npy file written by save, or by np.save
+    """
+    return dequantize(*read(npy_name, start, end))
+
+
+def cosine(a, b):
+    """Cosine similarity of vectors along the last axis, 1 for two zero vectors."""
+    norm = np.linalg.norm(a, axis=-1) * np.linalg.norm(b, axis=-1)
+    return np.where(norm > 0, np.sum(a * b, axis=-1) / np.where(norm > 0, norm, 1), 1.0)
+
+
+def report_arrays(arrays, codec):
+    """
+    Compare arrays with their round trip through a codec. The models l2-normalize features, so the error
+    that matters is the cosine similarity of each vector with its decoded copy.
+    :param arrays: list of float arrays
+    :param codec: one of CODECS
+    :return: dictionary of bytes ratio, mean and min cosine similarity, and max absolute error
+    """
+    raw, encoded, cos, error = 0, 0, [], 0.0
+    for arr in arrays:
+        arr = np.asarray(arr, dtype=np.float32)
+        data, scale = quantize(arr, codec)
+        decoded = dequantize(data, scale)
+        raw += arr.nbytes
+        encoded += data.nbytes + (scale.nbytes if scale is not None else 0)
+        cos.append(cosine(arr, decoded).reshape(-1))
+        error = max(error, float(np.abs(arr - decoded).max(initial=0)))
+    cos = np.concatenate(cos) if cos else np.ones(1)
+    return {'bytes_ratio': encoded / raw if raw else 1.0, 'mean_cosine': float(cos.mean()),
+            'min_cosine': float(cos.min()), 'max_abs_error': error}
+
+
+def answer_agreement(qa_arrays, codec):
+    """
+    Proxy of the change of accuracy on QA embedding: rate of questions whose answer closest to the question
+    in cosine similarity stays the same after the round trip through a codec.
+    :param qa_arrays: list of (6, E) arrays, question then 5 answers
+    :param codec: one of CODECS
+    :return: agreement rate
+    """
+    if not qa_arrays:
+        return 1.0
+    qa = np.stack([np.asarray(a, dtype=np.float32) for a in qa_arrays])
+    decoded = dequantize(*quantize(qa, codec))
+    before = np.argmax(cosine(qa[:, :1], qa[:, 1:]), axis=1)
+    after = np.argmax(cosine(decoded[:, :1], decoded[:, 1:]), axis=1)
+    return float(np.mean(before == after))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num_movie', default=20, type=int, help='Number of movies sampled.')
+    parser.add_argument('--num_qa', default=2000, type=int, help='Number of questions sampled.')
+    return parser.parse_args()
+
+
+def main():
+    """
+    Report how much each codec changes the stored features of a sample of movies and questions.
+    :return: None
+    """
+    args = parse_args()
+    random.seed(0)
+    movies = list(du.json_load(_mp.sample_frame_file).keys())
+    movies = random.sample(movies, min(args.num_movie, len(movies)))
+    qids = [qa['qid'] for qa in du.json_load(_mp.qa_file) if qa['video_clips']]
+    qids = random.sample(qids, min(args.num_qa, len(qids)))
+    sources = {
+        'object feature': [join(_mp.object_feature_dir, k + '.npy') for k in movies],
+        'subtitle': [join(_mp.encode_dir, k + '.npy') for k in movies],
+        'qa': [join(_mp.encode_dir, q + '.npy') for q in qids],
+    }
+    for name, files in sources.items():
+        arrays = [load(f) for f in tqdm(files, desc='Load %s' % name) if exists(f)]
+        for codec in CODECS[1:]:
+            result = report_arrays(arrays, codec)
+            if name == 'qa':
+                result['answer_agreement'] = answer_agreement(arrays, codec)
+            print(name, codec, result)
+
+
+if __name__ == '__main__':
+    main()
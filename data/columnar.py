@@ -0,0 +1,208 @@
+import json
+from collections import OrderedDict
+from os.path import join, exists, getmtime
+
+import numpy as np
+
+import utils.data_utils as du
+import utils.func_utils as fu
+from config import MovieQAPath
+
+_mp = MovieQAPath()
+
+
+def column_file(name, column):
+    return join(_mp.columnar_dir, '%s.%s.npy' % (name, column))
+
+
+def save_column(name, column, arr):
+    fu.make_dirs(_mp.columnar_dir)
+    du.atomic_save(column_file(name, column), arr)
+
+
+def load_npy(file_name):
+    # An empty array can not be memory-mapped.
+    if np.prod(du.npy_header(file_name)[0]) == 0:
+        return np.load(file_name)
+    return np.load(file_name, mmap_mode='r')
+
+
+def load_column(name, column):
+    return load_npy(column_file(name, column))
+
+
+def is_fresh(name, json_file, columns):
+    """
+    Columns are fresh if they all exist and none is older than the json file they are made from.
+    :param name: name of the table
+    :param json_file: json file the table is made from
+    :param columns: column names
+    :return: boolean
+    """
+    files = [column_file(name, c) for c in columns]
+    if not all(exists(f) for f in files):
+        return False
+    return not exists(json_file) or min(getmtime(f) for f in files) >= getmtime(json_file)
+
+
+def ragged_offsets(lengths):
+    """
+    :param lengths: length of each group
+    :return: int64 array of length len(lengths) + 1, group i is [offsets[i], offsets[i + 1])
+    """
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    return offsets
+
+
+def string_files(name, column):
+    """
+    :return blob_file, offsets_file: files of a string table column
+    """
+    return column_file(name, column + '_blob'), column_file(name, column + '_offsets')
+
+
+def write_strings(blob_file, offsets_file, strings):
+    """
+    Save a list of strings as a string table: one uint8 blob of utf-8 bytes and their offsets.
+    :param blob_file: file of utf-8 bytes
+    :param offsets_file: file of offsets
+    :param strings: list of strings
+    :return: None
+    """
+    encoded = [s.encode('utf-8') for s in strings]
+    du.atomic_save(offsets_file, ragged_offsets([len(e) for e in encoded]))
+    du.atomic_save(blob_file, np.frombuffer(b''.join(encoded), dtype=np.uint8))
+
+
+def save_strings(name, column, strings):
+    fu.make_dirs(_mp.columnar_dir)
+    write_strings(*string_files(name, column), strings)
+
+
+class StringTable(object):
+    """
+    Read-only string table. Strings are decoded only when they are accessed.
+    """
+
+    def __init__(self, blob_file, offsets_file):
+        self._blob = load_npy(blob_file)
+        self._offsets = np.array(load_npy(offsets_file))
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __getitem__(self, i):
+        return self._blob[self._offsets[i]:self._offsets[i + 1]].tobytes().decode('utf-8')
+
+    def slice(self, start, end):
+        """
+        Decode strings [start, end) with one read of the blob.
+        :return: list of strings
+        """
+        offsets = self._offsets[start:end + 1] - self._offsets[start]
+        raw = self._blob[self._offsets[start]:self._offsets[end]].tobytes()
+        return [raw[offsets[i]:offsets[i + 1]].decode('utf-8') for i in range(end - start)]
+
+    def tolist(self):
+        return self.slice(0, len(self))
+
+    def json(self, i):
+        return json.loads(self[i], object_pairs_hook=OrderedDict)
+
+
+FRAME_TIME = 'frame_time'
+FRAME_TIME_COLUMNS = ['keys_blob', 'keys_offsets', 'offsets', 'time']
+
+
+def save_frame_time(frame_time):
+    """
+    frame_time.keys_*: imdb keys
+    frame_time.offsets: frames of movie i are [offsets[i], offsets[i + 1])
+    frame_time.time: float64 timestamp of all frames
+    """
+    keys = list(frame_time.keys())
+    save_strings(FRAME_TIME, 'keys', keys)
+    save_column(FRAME_TIME, 'offsets', ragged_offsets([len(frame_time[k]) for k in keys]))
+    save_column(FRAME_TIME, 'time', np.array([t for k in keys for t in frame_time[k]], dtype=np.float64))
+
+
+def load_frame_time():
+    """
+    :return keys, offsets, time: imdb keys, offsets and memory-mapped timestamps
+    """
+    return StringTable(*string_files(FRAME_TIME, 'keys')).tolist(), \
+        np.array(load_column(FRAME_TIME, 'offsets')), load_column(FRAME_TIME, 'time')
+
+
+SUBTITLE = 'subtitle'
+SUBTITLE_COLUMNS = ['keys_blob', 'keys_offsets', 'offsets', 'start', 'end', 'lines_blob', 'lines_offsets']
+
+
+def save_subtitle(subtitle):
+    """
+    subtitle.keys_*: imdb keys
+    subtitle.offsets: lines of movie i are [offsets[i], offsets[i + 1])
+    subtitle.start, subtitle.end: float64 timestamps of all lines
+    subtitle.lines_*: all lines
+    """
+    keys = list(subtitle.keys())
+    save_strings(SUBTITLE, 'keys', keys)
+    save_column(SUBTITLE, 'offsets', ragged_offsets([len(subtitle[k]['lines']) for k in keys]))
+    save_column(SUBTITLE, 'start', np.array([t for k in keys for t in subtitle[k]['start']], dtype=np.float64))
+    save_column(SUBTITLE, 'end', np.array([t for k in keys for t in subtitle[k]['end']], dtype=np.float64))
+    save_strings(SUBTITLE, 'lines', [l for k in keys for l in subtitle[k]['lines']])
+
+
+def load_subtitle():
+    """
+    :return keys, offsets, start, end, lines: imdb keys, offsets, memory-mapped timestamps and string table of lines
+    """
+    return StringTable(*string_files(SUBTITLE, 'keys')).tolist(), np.array(load_column(SUBTITLE, 'offsets')), \
+        load_column(SUBTITLE, 'start'), load_column(SUBTITLE, 'end'), \
+        StringTable(*string_files(SUBTITLE, 'lines'))
+
+
+QA = 'qa'
+QA_COLUMNS = ['qid_blob', 'qid_offsets', 'imdb_key_blob', 'imdb_key_offsets', 'clip_offsets',
+              'video_clips_blob', 'video_clips_offsets', 'record_blob', 'record_offsets']
+
+
+def save_qa(qa):
+    """
+    qa.qid_*, qa.imdb_key_*: qid and imdb key of each question
+    qa.clip_offsets: video clips of question i are [clip_offsets[i], clip_offsets[i + 1])
+    qa.video_clips_*: video clips of all questions
+    qa.record_*: each question as a json string, decoded only when it is selected
+    """
+    save_strings(QA, 'qid', [ins['qid'] for ins in qa])
+    save_strings(QA, 'imdb_key', [ins['imdb_key'] for ins in qa])
+    save_column(QA, 'clip_offsets', ragged_offsets([len(ins['video_clips']) for ins in qa]))
+    save_strings(QA, 'video_clips', [v for ins in qa for v in ins['video_clips']])
+    save_strings(QA, 'record', [json.dumps(ins, ensure_ascii=False) for ins in qa])
+
+
+def load_qa():
+    """
+    :return qid, imdb_key, clip_offsets, video_clips, record: columns of QA, record is a string table
+    """
+    return StringTable(*string_files(QA, 'qid')).tolist(), StringTable(*string_files(QA, 'imdb_key')).tolist(), \
+        np.array(load_column(QA, 'clip_offsets')), StringTable(*string_files(QA, 'video_clips')).tolist(), \
+        StringTable(*string_files(QA, 'record'))
+
+
+def main():
+    """
+    Convert the json intermediates to columnar format.
+    :return: None
+    """
+    if exists(_mp.frame_time_file):
+        save_frame_time(du.json_load(_mp.frame_time_file))
+    if exists(_mp.subtitle_file):
+        save_subtitle(du.json_load(_mp.subtitle_file))
+    if exists(_mp.qa_file):
+        save_qa(du.json_load(_mp.qa_file))
+
+
+if __name__ == '__main__':
+    main()
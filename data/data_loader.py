@@ -1,6 +1,9 @@
 import re
+from collections import defaultdict
+from collections.abc import Sequence
 from datetime import timedelta
 from glob import glob
+from multiprocessing import Pool
 from os.path import exists, join
 from unicodedata import normalize
 
@@ -11,6 +14,7 @@ from tqdm import tqdm
 import utils.data_utils as du
 import utils.func_utils as fu
 from config import MovieQAPath
+from data import columnar as col
 
 _mp = MovieQAPath()
 
@@ -59,6 +63,83 @@ VIDEO_NAME_REGEX = re.compile(
 )
 
 
+# Version of the parsed subtitle format. Bump it when parsing changes, so that cached files
+# of the old parser are not used anymore.
+# 2: cues are grouped exactly as SRT_REGEX, e.g. a cue without content followed by the next cue
+#    without empty line takes that cue as content.
+SUBTITLE_PARSER_VERSION = 2
+
+SRT_INDEX_LINE_REGEX = re.compile(r'(?:.*\D)?({idx})\s*'.format(idx=RGX_INDEX), re.DOTALL)
+SRT_INDEX_START_REGEX = re.compile(r'{idx}\s*'.format(idx=RGX_INDEX))
+SRT_TIME_LINE_REGEX = re.compile(
+    r'({ts}) --> ({ts}) ?({proprietary})'.format(
+        ts=RGX_TIMESTAMP,
+        proprietary=RGX_PROPRIETARY
+    ))
+SRT_TIME_START_REGEX = re.compile(RGX_TIMESTAMP)
+
+
+def strip_eol(line):
+    return line[:-2] if line.endswith('\r\n') else line[:-1] if line.endswith('\n') else line
+
+
+def iter_srt_cues(lines):
+    """
+    Streaming version of SRT_REGEX.finditer. A cue starts with an index line and a timestamp line.
+    Its content ends at the end of the first line followed by the end of file or the next cue, possibly
+    after one empty line, as the lazy content of SRT_REGEX. Only the lines of the current cue are kept
+    in memory.
+    :param lines: iterable of lines with '\n', e.g. a file opened in text mode
+    :return: generator of (index, start, end, proprietary, content) as SRT_REGEX groups
+    """
+    it, buf = iter(lines), []
+
+    def fill(n):
+        while len(buf) < n:
+            line = next(it, None)
+            if line is None:
+                return False
+            buf.append(line)
+        return True
+
+    def header(i, anywhere):
+        # Number of lines and groups of the index and timestamp lines, if a cue starts at buf[i].
+        # When the cue follows another one, its index has to be at the start of line, and only the
+        # start of its timestamp line is checked, as the lookahead of SRT_REGEX.
+        match = (SRT_INDEX_LINE_REGEX if anywhere else SRT_INDEX_START_REGEX).fullmatch(buf[i])
+        if not match or not buf[i].endswith('\n'):
+            return 0, None
+        n = i + 1
+        while fill(n + 1) and not buf[n].strip():
+            n += 1
+        if len(buf) <= n:
+            return 0, None
+        if not anywhere:
+            return n + 1 - i, SRT_TIME_START_REGEX.match(buf[n])
+        time = SRT_TIME_LINE_REGEX.fullmatch(strip_eol(buf[n])) if buf[n].endswith('\n') else None
+        return n + 1 - i, time and (match.group(1),) + time.groups()
+
+    def is_end(i):
+        # The end of file or the next cue starts at buf[i].
+        return not fill(i + 1) or header(i, False)[1]
+
+    while fill(1):
+        n, groups = header(0, True)
+        if not groups:
+            buf.pop(0)
+            continue
+        del buf[:n]
+        content = []
+        while fill(1):
+            content.append(buf.pop(0))
+            if is_end(0):
+                break
+            if buf[0] in ('\n', '\r\n') and is_end(1):
+                buf.pop(0)
+                break
+        yield groups + (strip_eol(''.join(content)),)
+
+
 def duration(basename):
     match = VIDEO_NAME_REGEX.match(basename).groups()
     return int(match[1]), int(match[2])
@@ -79,12 +160,17 @@ class FrameTime(object):
     {
         'imdb_key': set of included imdb keys
     }
+    Timestamps are read from the columnar copy of frame_time.json, and each list is a
+    memory-mapped float64 array.
     """
     def __init__(self):
-        if exists(_mp.frame_time_file):
-            self._frame_time = du.json_load(_mp.frame_time_file)
-        else:
-            self._frame_time = self.process()
+        if not col.is_fresh(col.FRAME_TIME, _mp.frame_time_file, col.FRAME_TIME_COLUMNS):
+            if exists(_mp.frame_time_file):
+                col.save_frame_time(du.json_load(_mp.frame_time_file))
+            else:
+                self.process()
+        keys, offsets, time = col.load_frame_time()
+        self._frame_time = {k: time[offsets[i]:offsets[i + 1]] for i, k in enumerate(keys)}
         self._inc = {'imdb_key': set(list(self._frame_time.keys()))}
 
     @staticmethod
@@ -99,6 +185,7 @@ class FrameTime(object):
             # fu.basename_wo_ext(p) -> imdb_key
             frame_time[fu.basename_wo_ext(p)] = FrameTime.get_frame_time(p)
         du.json_dump(frame_time, _mp.frame_time_file, indent=0)
+        col.save_frame_time(frame_time)
         return frame_time
 
     @staticmethod
@@ -172,61 +259,89 @@ class Subtitle(object):
         {
             'imdb_key': set of included imdb keys
         }
+        Subtitles are read from the columnar copy of subtitle.json. start and end are memory-mapped
+        float64 arrays, and lines are decoded only for the movies returned by get().
         """
     def __init__(self):
-        if exists(_mp.subtitle_file):
-            self._subtitle = du.json_load(_mp.subtitle_file)
-        else:
-            self._subtitle = self.process()
+        if not col.is_fresh(col.SUBTITLE, _mp.subtitle_file, col.SUBTITLE_COLUMNS):
+            if exists(_mp.subtitle_file):
+                col.save_subtitle(du.json_load(_mp.subtitle_file))
+            else:
+                self.process()
+        keys, offsets, self._start, self._end, self._lines = col.load_subtitle()
+        # imdb key -> range of its lines
+        self._subtitle = {k: (offsets[i], offsets[i + 1]) for i, k in enumerate(keys)}
         self._inc = {'imdb_key': set(list(self._subtitle.keys()))}
 
     @staticmethod
-    def process():
+    def process(num_workers=8):
         """
         Process subtitle files of movies. It will encode the subtitle with ISO-8859-1,
         and substitute new line or <> tokens with '\b' or '', and normalize the characters.
+        Files are parsed in parallel, and a parsed file is cached by the hash of its content,
+        so only new or changed files are parsed again.
+        :param num_workers: number of processes
         :return subtitle: dictionary mapping imdb key to subtitle
         """
         subtitle = {}
-        # print(_mp.subtitle_dir)
         subtitle_paths = glob(join(_mp.subtitle_dir, '*.srt'))
-        # print(subtitle_paths)
-        for p in tqdm(subtitle_paths, desc='Process subtitle'):
-            iid = 0
-            # basename imdb_key
-            basename = fu.basename_wo_ext(p)
-            subtitle[basename] = {'lines': [], 'start': [], 'end': []}
-            with open(p, 'r', encoding='iso-8859-1') as f:
-                for match in SRT_REGEX.finditer(f.read()):
-                    raw_index, raw_start, raw_end, proprietary, content = match.groups()
-
-                    content = re.sub(r'\r\n|\n', ' ', content)
-                    content = re.sub(r'<.+?>', '', content, flags=re.DOTALL)
-                    content = re.sub(r'[<>]', '', content)
-                    content = normalize("NFKD", content)
-                    content = content.encode('utf-8').decode('ascii', 'ignore').strip()
-
-                    if content:
-                        content = sent_tokenize(content)
-                        content = [sent.strip() for sent in content if sent.strip()]
-                        s = Subtitle.timestamp_to_secs(raw_start)
-                        e = Subtitle.timestamp_to_secs(raw_end)
-                        if s > e:
-                            s, e = e, s
-                        time_span = (e - s) / len(content)
-                        for idx, sent in enumerate(content):
-                            subtitle[basename]['start'].append(s + time_span * idx)
-                            subtitle[basename]['end'].append(s + time_span * (idx + 1))
-                            subtitle[basename]['lines'].append(sent)
-                    iid += 1
-            index = np.argsort(np.array(subtitle[basename]['start']))
-            subtitle[basename]['start'] = [subtitle[basename]['start'][idx] for idx in index]
-            subtitle[basename]['end'] = [subtitle[basename]['end'][idx] for idx in index]
-            subtitle[basename]['lines'] = [subtitle[basename]['lines'][idx] for idx in index]
+        fu.make_dirs(_mp.subtitle_cache_dir)
+        with Pool(num_workers) as pool:
+            for basename, sub in tqdm(pool.imap(Subtitle.parse_cached, subtitle_paths),
+                                      total=len(subtitle_paths), desc='Process subtitle'):
+                subtitle[basename] = sub
 
         du.json_dump(subtitle, _mp.subtitle_file, indent=0)
+        col.save_subtitle(subtitle)
         return subtitle
 
+    @staticmethod
+    def parse_cached(p):
+        """
+        Parse a subtitle file, or load it from cache if the same content was parsed before.
+        :param p: file path of subtitle
+        :return basename, subtitle: imdb key and its subtitle
+        """
+        cache_file = join(_mp.subtitle_cache_dir, '%s.v%d.json' % (du.file_checksum(p), SUBTITLE_PARSER_VERSION))
+        if exists(cache_file):
+            return fu.basename_wo_ext(p), du.json_load(cache_file)
+        sub = Subtitle.parse(p)
+        du.atomic_json_dump(sub, cache_file, indent=0)
+        return fu.basename_wo_ext(p), sub
+
+    @staticmethod
+    def parse(p):
+        """
+        Parse the cues of a subtitle file, and split them into sentences sorted by start time.
+        :param p: file path of subtitle
+        :return: dictionary of lines, start and end
+        """
+        lines, start, end = [], [], []
+        with open(p, 'r', encoding='iso-8859-1') as f:
+            for raw_index, raw_start, raw_end, proprietary, content in iter_srt_cues(f):
+                content = re.sub(r'\r\n|\n', ' ', content)
+                content = re.sub(r'<.+?>', '', content, flags=re.DOTALL)
+                content = re.sub(r'[<>]', '', content)
+                content = normalize("NFKD", content)
+                content = content.encode('utf-8').decode('ascii', 'ignore').strip()
+
+                if content:
+                    content = sent_tokenize(content)
+                    content = [sent.strip() for sent in content if sent.strip()]
+                    s = Subtitle.timestamp_to_secs(raw_start)
+                    e = Subtitle.timestamp_to_secs(raw_end)
+                    if s > e:
+                        s, e = e, s
+                    time_span = (e - s) / len(content)
+                    for idx, sent in enumerate(content):
+                        start.append(s + time_span * idx)
+                        end.append(s + time_span * (idx + 1))
+                        lines.append(sent)
+        index = np.argsort(np.array(start))
+        return {'lines': [lines[idx] for idx in index],
+                'start': [start[idx] for idx in index],
+                'end': [end[idx] for idx in index]}
+
     @staticmethod
     def timestamp_to_secs(timestamp):
         """
@@ -252,13 +367,55 @@ class Subtitle(object):
         return self
 
     def get(self):
-        return {k: self._subtitle[k] for k in self._subtitle
+        return {k: {'lines': self._lines.slice(start, end),
+                    'start': self._start[start:end],
+                    'end': self._end[start:end]}
+                for k, (start, end) in self._subtitle.items()
                 if k in self._inc['imdb_key']}
 
 
+class QAView(Sequence):
+    """
+    Read-only sequence of selected questions. A question is decoded on its first access and
+    kept, so changes made to it are seen by later accesses.
+    """
+    def __init__(self, record, index):
+        self._record = record
+        self._index = index
+        self._cache = {}
+
+    def __len__(self):
+        return len(self._index)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if i not in self._cache:
+            self._cache[i] = self._record.json(self._index[i])
+        return self._cache[i]
+
+    def tolist(self):
+        return list(self)
+
+
 class QA(object):
+    """
+    QA are read from the columnar copy of qa.json. Questions are indexed by imdb_key, video clip
+    and split once, and get() returns a QAView decoding only the selected questions.
+    """
     def __init__(self):
-        self._qa = du.json_load(_mp.qa_file)
+        if not col.is_fresh(col.QA, _mp.qa_file, col.QA_COLUMNS):
+            col.save_qa(du.json_load(_mp.qa_file))
+        self._qid, imdb_key, clip_offsets, video_clips, self._record = col.load_qa()
+        self._clips = [video_clips[clip_offsets[i]:clip_offsets[i + 1]] for i in range(len(self._qid))]
+        self._imdb_index, self._clip_index, self._split_index = defaultdict(list), defaultdict(list), {}
+        for i, k in enumerate(imdb_key):
+            self._imdb_index[k].append(i)
+        for i, clips in enumerate(self._clips):
+            for v in clips:
+                self._clip_index[v].append(i)
         self._split = du.json_load(_mp.splits_file)
         self.video_data = du.json_load(_mp.video_data_file)
         self._inc = {'split': set(list(self._split.keys())),
@@ -304,19 +461,34 @@ class QA(object):
 
         return self
 
+    def split_index(self, split):
+        """
+        :param split: e.g. train
+        :return: positions of questions whose qid contains split, computed once per split
+        """
+        if split not in self._split_index:
+            self._split_index[split] = [i for i, q in enumerate(self._qid) if split in q]
+        return self._split_index[split]
+
     def get(self):
-        qa = self._qa.copy()
-        qa = [ins for ins in qa
-              if any(s in ins['qid'] for s in self._inc['split']) and
-              ins['imdb_key'] in self._inc['imdb_key']]
+        index = set()
+        for k in self._inc['imdb_key']:
+            index.update(self._imdb_index.get(k, ()))
+        split_index = set()
+        for split in self._inc['split']:
+            split_index.update(self.split_index(split))
+        index.intersection_update(split_index)
         if self._inc['video_clips'] == {True}:
-            qa = [ins for ins in qa if ins['video_clips']]
+            index = [i for i in index if self._clips[i]]
         elif self._inc['video_clips'] != {False}:
             if self._inc['video_clips']:
-                qa = [ins for ins in qa if fu.intersect(ins['video_clips'], self._inc['video_clips'])]
+                clip_index = set()
+                for v in self._inc['video_clips']:
+                    clip_index.update(self._clip_index.get(v, ()))
+                index.intersection_update(clip_index)
             else:
-                qa = [ins for ins in qa if not ins['video_clips']]
-        return qa
+                index = [i for i in index if not self._clips[i]]
+        return QAView(self._record, sorted(index))
 
 
 class ShotBoundary(object):
@@ -327,6 +499,10 @@ class ShotBoundary(object):
             self._sb = self.process()
         self._inc = {'imdb_key': set([k.split('.')[0] for k in self._sb]),
                      'videos': set([k for k in self._sb])}
+        # imdb key -> videos of the movie
+        self._imdb_index = defaultdict(list)
+        for k in self._sb:
+            self._imdb_index[k.split('.')[0]].append(k)
 
     @staticmethod
     def process():
@@ -363,12 +539,13 @@ class ShotBoundary(object):
         return self
 
     def get(self):
-        sb = self._sb.copy()
         if self._inc['imdb_key']:
-            sb = {k: sb[k] for k in sb if any(imdb in k for imdb in self._inc['imdb_key'])}
+            videos = [k for imdb in self._inc['imdb_key'] for k in self._imdb_index.get(imdb, ())]
+        else:
+            videos = self._sb.keys()
         if self._inc['videos']:
-            sb = {k: sb[k] for k in sb if k in self._inc['videos']}
-        return sb
+            videos = [k for k in videos if k in self._inc['videos']]
+        return {k: self._sb[k] for k in videos}
 
 
 class DataLoader(object):
@@ -0,0 +1,153 @@
+import argparse
+from os.path import join, exists
+
+import numpy as np
+from numpy.lib.format import open_memmap
+from tqdm import tqdm
+
+import utils.data_utils as du
+import utils.func_utils as fu
+from config import MovieQAPath
+from data import codec as cd
+
+_mp = MovieQAPath()
+
+
+class FeatureStore(object):
+    """
+    Read-only view of a feature store. A store is one .npy file holding the arrays of all
+    movies concatenated along the first axis, and an index file mapping each imdb key
+    to its row range.
+    self._index =
+    {
+        'ttxxxxxx': [start, end],
+        ...,
+    }
+    Every lookup returns a slice of the memory-mapped array, so nothing is read from
+    disk until the rows are actually used. An int8 store keeps its scales in a sidecar
+    store of the same rows.
+    """
+
+    def __init__(self, store_file, index_file):
+        self._data = np.load(store_file, mmap_mode='r')
+        self._scale = np.load(cd.scale_name(store_file), mmap_mode='r') if self._data.dtype == np.int8 else None
+        self._index = du.json_load(index_file)
+
+    def __getitem__(self, key):
+        start, end = self._index[key]
+        return self._data[start:end]
+
+    def get(self, key, start=None, end=None):
+        """
+        :param key: imdb key
+        :param start: first row of the movie
+        :param end: end of rows of the movie, exclusive
+        :return: float32 rows [start, end) of the movie
+        """
+        first, last = self._index[key]
+        start, end, _ = slice(start, end).indices(last - first)
+        rows = slice(first + start, first + max(start, end))
+        return cd.dequantize(self._data[rows], self._scale[rows] if self._scale is not None else None)
+
+    def __contains__(self, key):
+        return key in self._index
+
+    def __len__(self):
+        return len(self._index)
+
+    def keys(self):
+        return self._index.keys()
+
+    def num_rows(self, key):
+        start, end = self._index[key]
+        return end - start
+
+    @property
+    def dtype(self):
+        return self._data.dtype
+
+    @property
+    def row_shape(self):
+        return self._data.shape[1:]
+
+
+def build_feature_store(npy_names, keys, store_file, index_file, codec='float32', chunk_rows=1024):
+    """
+    Concatenate per-movie .npy files into one contiguous store, and save the row index.
+    Arrays are copied chunk by chunk into a pre-allocated memory map, so the whole store never
+    has to fit in memory.
+    :param npy_names: list of per-movie .npy files
+    :param keys: list of imdb keys, aligned with npy_names
+    :param store_file: path of the store
+    :param index_file: path of the row index
+    :param codec: storage codec of the store, whatever the codec of the per-movie files
+    :param chunk_rows: number of rows copied at once
+    :return index: dictionary mapping imdb key to [start, end]
+    """
+    index, total, row_shape = {}, 0, None
+    for k, n in zip(keys, tqdm(npy_names, desc='Read headers')):
+        shape, _, _ = du.npy_header(n)
+        if row_shape is None:
+            row_shape = shape[1:]
+        assert shape[1:] == row_shape, '%s has row shape %s, expected %s.' % (n, shape[1:], row_shape)
+        index[k] = [total, total + shape[0]]
+        total += shape[0]
+
+    fu.make_dirs(_mp.store_dir)
+    dtype, _ = cd.quantize(np.zeros((1,) + tuple(row_shape), dtype=np.float32), codec)
+    store = open_memmap(store_file, mode='w+', dtype=dtype.dtype, shape=(total,) + tuple(row_shape))
+    scales = None
+    if codec == 'int8':
+        scales = open_memmap(cd.scale_name(store_file), mode='w+', dtype=np.float32,
+                             shape=(total,) + tuple(row_shape[:-1]))
+    else:
+        fu.safe_remove(cd.scale_name(store_file))
+    for k, n in zip(keys, tqdm(npy_names, desc='Build %s' % fu.basename(store_file))):
+        start, end = index[k]
+        for i in range(start, end, chunk_rows):
+            data, scale = cd.quantize(cd.load(n, i - start, min(i + chunk_rows, end) - start), codec)
+            store[i:i + len(data)] = data
+            if scales is not None:
+                scales[i:i + len(data)] = scale
+    store.flush()
+    del store
+    if scales is not None:
+        scales.flush()
+        del scales
+
+    du.json_dump(index, index_file, indent=0)
+    return index
+
+
+def collect(feature_dir, keys):
+    """
+    Collect the imdb keys which have a .npy file in the feature directory.
+    :param feature_dir: directory of per-movie .npy files
+    :param keys: candidate imdb keys
+    :return keys, npy_names: available keys and their .npy files
+    """
+    keys = sorted(k for k in keys if exists(join(feature_dir, k + '.npy')))
+    return keys, [join(feature_dir, k + '.npy') for k in keys]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--no_subt', action='store_true', help='Do not build subtitle store.')
+    parser.add_argument('--no_feat', action='store_true', help='Do not build object feature store.')
+    parser.add_argument('--codec', default='float32', choices=cd.CODECS, help='Storage codec of the stores.')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    movies = list(du.json_load(_mp.sample_frame_file).keys())
+    if not args.no_subt:
+        keys, npy_names = collect(_mp.encode_dir, movies)
+        build_feature_store(npy_names, keys, _mp.subtitle_feature_store, _mp.subtitle_feature_index, args.codec)
+    if not args.no_feat:
+        keys, npy_names = collect(_mp.object_feature_dir, movies)
+        build_feature_store(npy_names, keys, _mp.object_feature_store, _mp.object_feature_index, args.codec)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,215 @@
+import argparse
+import fcntl
+import json
+import os
+import shutil
+from os.path import join, exists
+
+import imageio
+from tqdm import tqdm
+
+import utils.data_utils as du
+import utils.func_utils as fu
+from config import MovieQAPath
+
+_mp = MovieQAPath()
+
+
+def store_files(imdb_key):
+    """
+    Paths of the frame store of a movie.
+    :param imdb_key: e.g. ttxxxxxxx
+    :return store_file, index_file: concatenated encoded frames and their offset table
+    """
+    return join(_mp.frame_store_dir, imdb_key + '.bin'), join(_mp.frame_store_dir, imdb_key + '.jsonl')
+
+
+class ClipWriter(object):
+    """
+    Write the encoded frames of a clip to a temporary file as they come, and append that file to
+    the frame store of its movie on close, so a clip is never held in memory.
+    Several processes can write clips of the same movie, since the append is done under a file lock.
+    Bytes appended by an interrupted writer are not in the offset table, so they are never read.
+    """
+
+    def __init__(self, clip):
+        self.clip = clip
+        self.store_file, self.index_file = store_files(fu.imdb_key(clip))
+        fu.make_dirs(_mp.frame_store_dir)
+        self._part_file = join(_mp.frame_store_dir, clip + '.part')
+        self._part = open(self._part_file, 'wb')
+        # [index, offset in the temporary file, length] of each frame
+        self._table = []
+
+    def add(self, index, img):
+        """
+        :param index: 0-based frame index in the clip
+        :param img: image array
+        """
+        self.add_bytes(index, imageio.imwrite('<bytes>', img, format='jpg'))
+
+    def add_bytes(self, index, data):
+        self._table.append([index, self._part.tell(), len(data)])
+        self._part.write(data)
+
+    def close(self):
+        self._part.close()
+        with open(self._part_file, 'rb') as p, open(self.store_file, 'ab') as f, open(self.index_file, 'ab+') as g:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                offset = f.seek(0, os.SEEK_END)
+                shutil.copyfileobj(p, f, 1 << 20)
+                f.flush()
+                os.fsync(f.fileno())
+                table = [[i, offset + o, n] for i, o, n in self._table]
+                # A writer interrupted in the middle of its line leaves it torn, so end it first.
+                end = g.seek(0, os.SEEK_END)
+                if end:
+                    g.seek(end - 1)
+                    if g.read(1) != b'\n':
+                        g.write(b'\n')
+                g.write((json.dumps({'clip': self.clip, 'frames': table}) + '\n').encode('utf-8'))
+                g.flush()
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+        fu.safe_remove(self._part_file)
+        del self._table[:]
+
+
+class FrameStore(object):
+    """
+    Read-only view of the frame store of a movie. A store is one file of concatenated encoded
+    frames, and an offset table with one json line per clip:
+    {"clip": "ttxxxxxxx.sfxxxxxx.efxxxxxx.video", "frames": [[index, offset, length], ...]}
+    A frame is fetched with a single positioned read.
+    """
+
+    def __init__(self, imdb_key):
+        self.store_file, self.index_file = store_files(imdb_key)
+        self._index = {}
+        with open(self.index_file, 'r') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                for i, offset, length in record['frames']:
+                    self._index[(record['clip'], i)] = (offset, length)
+        self._fd = None
+
+    def __contains__(self, item):
+        return item in self._index
+
+    def __len__(self):
+        return len(self._index)
+
+    def clips(self):
+        return sorted(set(c for c, _ in self._index))
+
+    def location(self, clip, index):
+        """
+        :param clip: video name without extension
+        :param index: 0-based frame index in the clip
+        :return offset, length: position of the encoded frame in store file
+        """
+        return self._index[(clip, index)]
+
+    def get_bytes(self, clip, index):
+        offset, length = self._index[(clip, index)]
+        if self._fd is None:
+            self._fd = os.open(self.store_file, os.O_RDONLY)
+        return os.pread(self._fd, length, offset)
+
+    def get(self, clip, index):
+        return imageio.imread(self.get_bytes(clip, index), format='jpg')
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+
+_stores, _fds = {}, {}
+
+
+def open_store(imdb_key):
+    """
+    Open the frame store of a movie once per process.
+    :param imdb_key: e.g. ttxxxxxxx
+    :return: FrameStore
+    """
+    if imdb_key not in _stores:
+        _stores[imdb_key] = FrameStore(imdb_key)
+    return _stores[imdb_key]
+
+
+def read_bytes(store_file, offset, length):
+    """
+    Read an encoded frame from a store file, e.g. inside tf.py_func. File descriptors are kept
+    open per process, and os.pread is safe to call from several threads.
+    :param store_file: path of store file
+    :param offset: byte offset of the frame
+    :param length: byte length of the frame
+    :return: encoded frame
+    """
+    if isinstance(store_file, bytes):
+        store_file = store_file.decode()
+    if store_file not in _fds:
+        _fds[store_file] = os.open(store_file, os.O_RDONLY)
+    return os.pread(_fds[store_file], int(length), int(offset))
+
+
+def packed_clips(imdb_key):
+    """
+    :param imdb_key: e.g. ttxxxxxxx
+    :return: set of clips in the frame store of a movie
+    """
+    if not exists(store_files(imdb_key)[1]):
+        return set()
+    clips = set()
+    with open(store_files(imdb_key)[1], 'r') as f:
+        for line in f:
+            # Lines torn by an interrupted writer are skipped, as in FrameStore.
+            try:
+                clips.add(json.loads(line)['clip'])
+            except ValueError:
+                continue
+    return clips
+
+
+def pack_movie(imdb_key, clips, reset=False):
+    """
+    Pack the extracted JPEG files of a movie into its frame store. The JPEG files are copied
+    as they are, without decoding. Clips already in the store are skipped.
+    :param imdb_key: e.g. ttxxxxxxx
+    :param clips: dictionary with key: video name, value: list of 0-based frame indices
+    :param reset: boolean, remove the store first or not.
+    :return: None
+    """
+    if reset:
+        for f in store_files(imdb_key):
+            fu.safe_remove(f)
+    packed = packed_clips(imdb_key)
+    for v in sorted(set(clips) - packed):
+        writer = ClipWriter(v)
+        for i in clips[v]:
+            with open(join(_mp.image_dir, v, '%s_%05d.jpg' % (v, i + 1)), 'rb') as f:
+                writer.add_bytes(i, f.read())
+        writer.close()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--reset', action='store_true', help='Pack all movies again from scratch.')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    sample = du.json_load(_mp.sample_frame_file)
+    for imdb_key in tqdm(sample, desc='Pack frames'):
+        pack_movie(imdb_key, sample[imdb_key], args.reset)
+
+
+if __name__ == '__main__':
+    main()
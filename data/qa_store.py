@@ -0,0 +1,132 @@
+import argparse
+from os.path import join
+
+import numpy as np
+from tqdm import tqdm
+
+import utils.data_utils as du
+import utils.func_utils as fu
+from config import MovieQAPath
+from data import codec as cd
+from data.columnar import load_npy, ragged_offsets
+
+_mp = MovieQAPath()
+
+
+def spec_intervals(spectrum):
+    """
+    :param spectrum: 0/1 array over the sampled frames of a movie
+    :return: int64 array of shape (k, 2), the [start, end) of each run of ones
+    """
+    padded = np.concatenate([[0], np.asarray(spectrum) != 0, [0]]).astype(np.int8)
+    change = np.flatnonzero(np.diff(padded))
+    return change.reshape((-1, 2)).astype(np.int64)
+
+
+class QAStore(object):
+    """
+    Read-only view of the packed QA store.
+    qa_embedding.npy: embedding of question and 5 answers of all questions, (num_qa, 6, E), encoded by a codec
+    qa_spec_intervals.npy: [start, end) frame intervals of all spectra, (num_intervals, 2)
+    qa_spec_offsets.npy: intervals of question i are [offsets[i], offsets[i + 1])
+    qa_spec_lengths.npy: number of sampled frames of the movie of each question
+    qa_index.json: row of each qid
+    Arrays are memory-mapped, so a question is read from disk only when it is used.
+    """
+
+    def __init__(self):
+        self._embedding = load_npy(_mp.qa_store_file)
+        self._scale = load_npy(cd.scale_name(_mp.qa_store_file)) if self._embedding.dtype == np.int8 else None
+        self._intervals = load_npy(_mp.qa_spec_interval_file)
+        self._offsets = np.array(load_npy(_mp.qa_spec_offset_file))
+        self._lengths = np.array(load_npy(_mp.qa_spec_length_file))
+        self._index = du.json_load(_mp.qa_store_index)
+
+    def __contains__(self, qid):
+        return qid in self._index
+
+    def __len__(self):
+        return len(self._index)
+
+    def row(self, qid):
+        return self._index[qid]
+
+    def embedding(self, row):
+        """
+        :param row: row or list of rows
+        :return: float32 embedding
+        """
+        return cd.dequantize(self._embedding[row], self._scale[row] if self._scale is not None else None)
+
+    def intervals(self, row):
+        return self._intervals[self._offsets[row]:self._offsets[row + 1]]
+
+    def length(self, row):
+        return int(self._lengths[row])
+
+    def spec(self, row):
+        """
+        :param row: row of the question
+        :return: int32 spectrum over the sampled frames of the movie
+        """
+        spectrum = np.zeros(self.length(row), dtype=np.int32)
+        for start, end in self.intervals(row):
+            spectrum[start:end] = 1
+        return spectrum
+
+
+def save_qa_store(qids, embedding, intervals, lengths, codec='float32'):
+    """
+    Save the packed QA store.
+    :param qids: list of qids
+    :param embedding: array of shape (num_qa, 6, E), aligned with qids
+    :param intervals: list of interval arrays returned by spec_intervals, aligned with qids
+    :param lengths: number of sampled frames of the movie of each question
+    :param codec: storage codec of embedding
+    :return: None
+    """
+    fu.make_dirs(_mp.store_dir)
+    cd.save(_mp.qa_store_file, embedding, codec)
+    du.atomic_save(_mp.qa_spec_interval_file,
+                   np.concatenate([np.zeros((0, 2), dtype=np.int64)] + list(intervals)).astype(np.int64))
+    du.atomic_save(_mp.qa_spec_offset_file, ragged_offsets([len(i) for i in intervals]))
+    du.atomic_save(_mp.qa_spec_length_file, np.asarray(lengths, dtype=np.int64))
+    # The index is written last, so a store with an index is complete.
+    du.atomic_json_dump({qid: row for row, qid in enumerate(qids)}, _mp.qa_store_index, indent=0)
+
+
+def build_qa_store(qids, codec='float32'):
+    """
+    Pack the per-question files qid.npy and qid_spec.npy written by older versions of text_v3.
+    :param qids: list of qids
+    :param codec: storage codec of embedding
+    :return: None
+    """
+    embedding, intervals, lengths = None, [], []
+    for row, qid in enumerate(tqdm(qids, desc='Pack QA')):
+        qa = cd.load(join(_mp.encode_dir, qid + '.npy'))
+        if embedding is None:
+            embedding = np.zeros((len(qids),) + qa.shape, dtype=np.float32)
+        embedding[row] = qa
+        spectrum = np.load(join(_mp.encode_dir, qid + '_spec.npy'))
+        intervals.append(spec_intervals(spectrum))
+        lengths.append(len(spectrum))
+    if embedding is None:
+        embedding = np.zeros((0, 6, 300), dtype=np.float32)
+    save_qa_store(qids, embedding, intervals, lengths, codec)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--codec', default='float32', choices=cd.CODECS, help='Storage codec of QA embedding.')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    qids = [qa['qid'] for qa in du.json_load(_mp.qa_file) if qa['video_clips']]
+    build_qa_store(qids, args.codec)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,6 @@
 import argparse
 from functools import partial
-from multiprocessing import Pool, Manager
+from itertools import chain
 from os.path import join
 
 import numpy as np
@@ -33,6 +33,115 @@ def pad_list_numpy(sents, shape):
     return arr
 
 
+def pad_sentences(sents, width):
+    """
+    Pad sentences into one preallocated matrix.
+    :param sents: list of lists of word ids
+    :param width: length of padded sentence
+    :return arr, lengths: int64 matrix of padded sentences, and length of each sentence
+    """
+    lengths = np.array([len(sent) for sent in sents], dtype=np.int64)
+    arr = np.zeros((len(sents), width), dtype=np.int64)
+    arr[np.arange(width) < lengths[:, None]] = np.fromiter(chain.from_iterable(sents), dtype=np.int64,
+                                                           count=int(lengths.sum()))
+    return arr, lengths
+
+
+def shard_qa(qa, video_data, key, max_frames):
+    """
+    Split the questions of a movie into groups, whose video clips have at most max_frames frames,
+    unless a question alone has more. Questions without clips in the movie (e.g. plot-only questions)
+    add no frame, so they stay in the group of the question before them. If no question has clips,
+    the only group keeps all clips of the movie, as without max_frames.
+    :param qa: list of questions of a movie
+    :param video_data: video meta data
+    :param key: imdb key
+    :param max_frames: maximal number of frames of a group, 0 for only one group with all clips
+    :return: list of (questions, video clips)
+    """
+    video_list = sorted(list(video_data[key].keys()))
+    if not max_frames:
+        return [(qa, video_list)]
+    shards, group, clips = [], [], set()
+    for ins in qa:
+        union = clips | (set(ins['video_clips']) & set(video_list))
+        if clips and sum(video_data[key][v]['real_frames'] for v in union) > max_frames:
+            shards.append((group, sorted(clips)))
+            group, union = [], set(ins['video_clips']) & set(video_list)
+        group.append(ins)
+        clips = union
+    if group or not shards:
+        shards.append((group, sorted(clips) if clips else video_list))
+    return shards
+
+
+def serialize_movie(qa, encode_subt, args, video_data, key, video_list, feat=None):
+    """
+    Serialize questions of a movie and the video clips in video_list to a SequenceExample.
+    :param qa: list of questions
+    :param encode_subt: encoded subtitle
+    :param args: arguments
+    :param video_data: video meta data
+    :param key: imdb key
+    :param video_list: sorted list of video clips
+    :param feat: feature of all frames of the movie
+    :return: serialized SequenceExample
+    """
+    all_videos = sorted(list(video_data[key].keys()))
+    frames = np.array([video_data[key][v]['real_frames'] for v in all_videos], dtype=np.int64)
+    offset = dict(zip(all_videos, np.cumsum(frames) - frames))
+    # Start of each clip in this record
+    start = dict(zip(video_list, np.cumsum([0] + [video_data[key][v]['real_frames'] for v in video_list])))
+    num_frame = int(sum(video_data[key][v]['real_frames'] for v in video_list))
+    # A record of the whole movie keeps all subtitle, and a shard only the subtitle of its clips.
+    whole = video_list == all_videos
+
+    spectrum = np.zeros((len(qa), num_frame), dtype=np.int64)
+    ques, ql = pad_sentences([ins['question'] for ins in qa], args.q_max)
+    ans = np.zeros((len(qa), 5, args.a_max), dtype=np.int64)
+    al = np.zeros((len(qa), 5), dtype=np.int64)
+    gt = []
+
+    for idx, ins in enumerate(qa):
+        ans[idx], al[idx] = pad_sentences(ins['answers'], args.a_max)
+        for v in video_list:
+            if v in ins['video_clips']:
+                spectrum[idx][start[v]:start[v] + video_data[key][v]['real_frames']] = 1
+        if args.split == 'train' or args.split == 'val':
+            gt.append(ins['correct_index'])
+
+    sequence_dict = {
+        "ques": du.feature_list(ques, 'int'),
+        "ans": du.feature_list(np.reshape(ans, [len(qa), 5 * args.a_max]), 'int'),
+        "al": du.feature_list(al, 'int'),
+        "spec": du.feature_list(spectrum, 'int'),
+        "ql": du.feature_list(ql, 'int'),
+    }
+    feature = {"N": du.feature(num_frame, 'int'),
+               "N_q": du.feature(len(qa), 'int')}
+
+    if 'subt' in args.mode:
+        videos = [v for v in sorted(list(encode_subt[key].keys()))
+                  if encode_subt[key][v] and (whole or v in start)]
+        subt, sl = pad_sentences([sent for v in videos for sent in encode_subt[key][v]], args.subt_max)
+        sequence_dict['subt'] = du.feature_list(subt, 'int')
+        sequence_dict['sl'] = du.feature_list(sl, 'int')
+
+    if 'feat' in args.mode:
+        if not whole:
+            feat = np.concatenate([feat[offset[v]:offset[v] + video_data[key][v]['real_frames']]
+                                   for v in video_list])
+        sequence_dict['feat'] = du.feature_list(np.reshape(feat, [-1, 4 * 4 * 1536]), 'float')
+
+    if args.split == 'train' or args.split == 'val':
+        sequence_dict['gt'] = du.feature_list(gt, 'int')
+
+    feature_lists = tf.train.FeatureLists(feature_list=sequence_dict)
+    context = tf.train.Features(feature=feature)
+    example = tf.train.SequenceExample(context=context, feature_lists=feature_lists)
+    return example.SerializeToString()
+
+
 def create_one_tfrecord(qa, encode_subt, args, video_data, key):
     # num_shards = int(math.ceil(len(qa) / float(args.num_per_shards)))
     print(len(qa))
@@ -48,65 +157,14 @@ def create_one_tfrecord(qa, encode_subt, args, video_data, key):
 
     fu.safe_remove(output_filename)
 
-    with tf.python_io.TFRecordWriter(output_filename) as tfrecord_writer:
-        video_list = sorted(list(video_data[key].keys()))
-        num_frame = sum([video_data[key][v]['real_frames'] for v in video_list])
-
-        spectrum = np.zeros((len(qa[key]), num_frame), dtype=np.int64)
-        ques = np.zeros((len(qa[key]), args.q_max), dtype=np.int64)
-        ans = np.zeros((len(qa[key]), 5, args.a_max), dtype=np.int64)
-        ql = np.zeros(len(qa[key]), dtype=np.int64)
-        al = np.zeros((len(qa[key]), 5), dtype=np.int64)
-        gt = []
-
-        for idx, ins in enumerate(qa[key]):
-            ques[idx][:len(ins['question'])] = ins['question']
-            ql[idx] = len(ins['question'])
-            for i in range(5):
-                ans[idx][i][:len(ins['answers'][i])] = ins['answers'][i]
-                al[idx][i] = len(ins['answers'])
-            index = 0
-            for v in video_list:
-                if v in ins['video_clips']:
-                    spectrum[idx][index:index + len(video_data[key][v]['real_frames'])] = 1
-                index += video_data[key][v]['real_frames']
-            if args.split == 'train' or args.split == 'val':
-                gt.append(ins['correct_index'])
-
-        sequence_dict = {
-            "ques": du.feature_list(ques, 'int'),
-            "ans": du.feature_list(np.reshape(ans, [len(qa[key]), 5 * args.a_max]), 'int'),
-            "al": du.feature_list(al, 'int'),
-            "spec": du.feature_list(spectrum, 'int'),
-            "ql": du.feature_list(ql, 'int'),
-        }
-        feature = {"N": du.feature(num_frame, 'int'),
-                   "N_q": du.feature(len(qa[key]), 'int')}
-
-        if 'subt' in args.mode:
-            subt = np.zeros((0, args.subt_max), dtype=np.int64)
-            sl = []
-            videos = sorted(list(encode_subt[key].keys()))
-
-            for v in videos:
-                if encode_subt[key][v]:
-                    subt = np.concatenate([subt, du.pad_list_numpy(encode_subt[key][v], args.subt_max)])
-                    sl += [len(sent) for sent in encode_subt[key][v]]
-
-            sequence_dict['subt'] = du.feature_list(subt, 'int')
-            sequence_dict['sl'] = du.feature_list(sl, 'int')
-
-        if 'feat' in args.mode:
-            feat = np.reshape(np.load(join(_mp.feature_dir, key + '.npy')), [-1, 4 * 4 * 1536])
-            sequence_dict['feat'] = du.feature_list(feat, 'float')
+    feat = None
+    if 'feat' in args.mode:
+        feat = np.reshape(np.load(join(_mp.feature_dir, key + '.npy'), mmap_mode='r'), [-1, 4 * 4 * 1536])
 
-        if args.split == 'train' or args.split == 'val':
-            sequence_dict['gt'] = du.feature_list(gt, 'int')
-
-        feature_lists = tf.train.FeatureLists(feature_list=sequence_dict)
-        context = tf.train.Features(feature=feature)
-        example = tf.train.SequenceExample(context=context, feature_lists=feature_lists)
-        tfrecord_writer.write(example.SerializeToString())
+    # A large movie is split into several records, one per group of questions.
+    with tf.python_io.TFRecordWriter(output_filename) as tfrecord_writer:
+        for shard, video_list in shard_qa(qa[key], video_data, key, args.max_frames):
+            tfrecord_writer.write(serialize_movie(shard, encode_subt, args, video_data, key, video_list, feat))
 
     # start_ndx = shard_id * args.num_per_shards
     # end_ndx = min((shard_id + 1) * args.num_per_shards, len(qa))
@@ -161,7 +219,16 @@ def create_one_tfrecord(qa, encode_subt, args, video_data, key):
     #         tfrecord_writer.write(example.SerializeToString())
 
 
-def create_tfrecord(encode_qa, encode_subt, split, mode, num_per_shards):
+# Read-only data of the worker processes, see fu.shared_pool.
+_shared = {}
+
+
+def create_worker(args, key):
+    create_one_tfrecord(_shared['qa'], _shared['encode_subt'], args, _shared['video_data'], key)
+    return key
+
+
+def create_tfrecord(encode_qa, encode_subt, split, mode, num_per_shards, max_frames=0):
     split_qa = [qa for qa in encode_qa if split in qa['qid']]
     video_data = du.json_load(_mp.video_data_file)
     imdb_split = du.json_load(_mp.splits_file)
@@ -174,20 +241,16 @@ def create_tfrecord(encode_qa, encode_subt, split, mode, num_per_shards):
 
     args.subt_max, args.q_max, args.a_max = find_max_length(encode_qa, encode_subt)
 
-    manager = Manager()
-
-    split_qa = manager.dict(qa)
-    encode_subt = manager.dict(encode_subt)
-    video_data = manager.dict(video_data)
-
     args.split = split
     args.mode = mode
     args.num_per_shards = num_per_shards
-    func = partial(create_one_tfrecord, split_qa, encode_subt, args, video_data)
+    args.max_frames = max_frames
+    func = partial(create_worker, args)
     # num_shards = int(math.ceil(len(split_qa) / float(num_per_shards)))
-    keys = list(split_qa.keys())
+    keys = list(qa.keys())
     num_shards = len(keys)
-    with Pool(8) as pool, tqdm(total=num_shards, desc='Create %s Tfrecord' % split) as pbar:
+    with fu.shared_pool(_shared, 8, qa=qa, encode_subt=encode_subt, video_data=video_data) as pool, \
+            tqdm(total=num_shards, desc='Create %s Tfrecord' % split) as pbar:
         for _ in pool.imap_unordered(func, keys):
             pbar.update()
 
@@ -204,6 +267,8 @@ def parse_args():
     parser.add_argument('--num_per_shards', default=32, help='Number of shards.', type=int)
     parser.add_argument('--count', action='store_true', help='Count the number of qa.')
     parser.add_argument('--mode', default='subt+feat', help='Create records with only subtitle.')
+    parser.add_argument('--max_frames', default=0, type=int,
+                        help='Split a movie into records of at most this number of frames, 0 for no split.')
     return parser.parse_args()
 
 
@@ -218,11 +283,14 @@ def main():
         count(encode_qa)
     else:
         if 'train' in split:
-            create_tfrecord(encode_qa, encode_subt, 'train', args.mode, args.num_per_shards)
+            create_tfrecord(encode_qa, encode_subt, 'train', args.mode, args.num_per_shards,
+                            args.max_frames)
         if 'val' in split:
-            create_tfrecord(encode_qa, encode_subt, 'val', args.mode, args.num_per_shards)
+            create_tfrecord(encode_qa, encode_subt, 'val', args.mode, args.num_per_shards,
+                            args.max_frames)
         if 'tests' in split:
-            create_tfrecord(encode_qa, encode_subt, 'tests', args.mode, args.num_per_shards)
+            create_tfrecord(encode_qa, encode_subt, 'tests', args.mode, args.num_per_shards,
+                            args.max_frames)
 
 
 if __name__ == '__main__':
@@ -21,12 +21,16 @@ class EmbeddingPath(object):
         self.encode_embedding_len_file = join(self.data_dir, 'encode_embedding_len.npy')
         self.encode_embedding_vec_file = join(self.data_dir, 'encode_embedding_vec.npy')
 
-        # All embedding keys and values
-        self.w2v_embedding_key_file = join(self.data_dir, 'w2v_embedding.json')
+        # All embedding keys and values. Keys are a string table: utf-8 bytes of all keys and their
+        # offsets, and values are a float32 array, both can be memory-mapped.
+        self.w2v_embedding_key_file = join(self.data_dir, 'w2v_embedding_keys.npy')
+        self.w2v_embedding_offset_file = join(self.data_dir, 'w2v_embedding_offsets.npy')
         self.w2v_embedding_vec_file = join(self.data_dir, 'w2v_embedding.npy')
-        self.ft_embedding_key_file = join(self.data_dir, 'ft_embedding.json')
+        self.ft_embedding_key_file = join(self.data_dir, 'ft_embedding_keys.npy')
+        self.ft_embedding_offset_file = join(self.data_dir, 'ft_embedding_offsets.npy')
         self.ft_embedding_vec_file = join(self.data_dir, 'ft_embedding.npy')
-        self.glove_embedding_key_file = join(self.data_dir, 'glove_embedding.json')
+        self.glove_embedding_key_file = join(self.data_dir, 'glove_embedding_keys.npy')
+        self.glove_embedding_offset_file = join(self.data_dir, 'glove_embedding_offsets.npy')
         self.glove_embedding_vec_file = join(self.data_dir, 'glove_embedding.npy')
 
         # Trained embedding
@@ -1,15 +1,19 @@
-import io
 import math
+import os
 import time
 from argparse import ArgumentParser
-from collections import Counter
+from functools import partial
+from multiprocessing import Pool
 from os.path import exists
 from pprint import pprint
 
 import numpy as np
+from numpy.lib.format import open_memmap
 from tqdm import tqdm, trange
 
+from data import columnar as col
 from embed.args import EmbeddingPath
+from embed.ngram import NgramEncoder, count_grams, num_grams
 from utils import data_utils as du
 from utils import func_utils as fu
 
@@ -17,93 +21,159 @@ cp = EmbeddingPath()
 UNK = 'UNK'
 
 
-def load_embedding_vec(target):
+def load_embedding_vec(target, num_workers=1):
     """
     Load word embedding of different method. You can refer to EmbeddingPath
     to prepare data.
     :param target: string, target word embedding
-    :return embedding_keys, embedding_vecs: list of words, and numpy array of embedding vector
+    :param num_workers: number of processes parsing the text file
+    :return embedding_keys, embedding_vecs: list of words, and memory-mapped array of embedding vector
     """
     start_time = time.time()
-    # File and function setup for embedding
+    # File setup for embedding
     if target == 'glove':
-        key_file = cp.glove_embedding_key_file
+        key_files = cp.glove_embedding_key_file, cp.glove_embedding_offset_file
         vec_file = cp.glove_embedding_vec_file
         raw_file = cp.glove_file
-        load_fn = load_glove
     elif target == 'w2v':
-        key_file = cp.w2v_embedding_key_file
+        key_files = cp.w2v_embedding_key_file, cp.w2v_embedding_offset_file
         vec_file = cp.w2v_embedding_vec_file
         raw_file = cp.word2vec_file
-        load_fn = load_w2v
     elif target == 'fasttext':
-        key_file = cp.ft_embedding_key_file
+        key_files = cp.ft_embedding_key_file, cp.ft_embedding_offset_file
         vec_file = cp.ft_embedding_vec_file
         raw_file = cp.fasttext_file
-        load_fn = load_glove
     else:
-        key_file = None
-        vec_file = None
-        raw_file = None
-        load_fn = None
+        raise ValueError('Unknown embedding: %s' % target)
 
     # Check if there already exists pre-loaded file
-    if exists(key_file) and exists(vec_file):
-        embedding_keys = du.json_load(key_file)
-        embedding_vecs = np.load(vec_file)
-    else:
+    if not (all(exists(f) for f in key_files) and exists(vec_file)):
         # If not, load it from text file
-        embedding_keys, embedding_vecs = load_fn(raw_file)
-        du.json_dump(embedding_keys, key_file)
-        np.save(vec_file, embedding_vecs)
+        embedding_keys = load_text_embedding(raw_file, vec_file, num_workers)
+        col.write_strings(*key_files, embedding_keys)
+    embedding_keys = col.StringTable(*key_files).tolist()
+    embedding_vecs = np.load(vec_file, mmap_mode='r')
 
     print('Loading embedding done. %.3f s' % (time.time() - start_time))
     return embedding_keys, embedding_vecs
 
 
-def load_w2v(filename):
+def read_header(filename):
+    """
+    word2vec and fastText text files start with a line of the size of vocabulary and the
+    dimension of embedding, and GloVe files do not.
+    :param filename: string, file path of embedding
+    :return header_size, dim: length of header in bytes, and dimension of embedding
     """
-    Load word2vec.
-    :param filename: string, file path of woed2vec.
-    :return embedding_keys, embedding_vecs: list of words, and numpy array of embedding vector
+    with open(filename, 'rb') as f:
+        first = f.readline()
+    fields = first.split()
+    if len(fields) == 2 and all(field.isdigit() for field in fields):
+        return len(first), int(fields[1])
+    return 0, cp.embedding_size
+
+
+def line_ranges(filename, start, chunk_bytes):
     """
-    embedding_key, embedding_vec = [], []
+    Split a file into byte ranges of whole lines.
+    :param filename: string, file path
+    :param start: byte offset of the first range
+    :param chunk_bytes: approximate size of a range
+    :return: list of (start, end)
+    """
+    size, ranges = os.path.getsize(filename), []
+    with open(filename, 'rb') as f:
+        while start < size:
+            f.seek(min(start + chunk_bytes, size))
+            f.readline()
+            ranges.append((start, f.tell()))
+            start = f.tell()
+    return ranges
+
+
+def read_lines(filename, start, end):
+    with open(filename, 'rb') as f:
+        f.seek(start)
+        data = f.read(end - start).decode('utf-8')
+    return [line for line in data.split('\n') if line.strip()]
 
-    with open(filename, 'r') as f:
-        # First line is size of vocabulary and dimension of embedding
-        num, dim = [int(comp) for comp in f.readline().strip().split()]
-        # Split each line of the rest to word and embedding vector
-        for _ in trange(num, desc='Load word embedding %dd' % dim):
-            word, *vec = f.readline().rstrip().rsplit(sep=' ', maxsplit=dim)
-            embedding_key.append(word)
-            embedding_vec.append([float(e) for e in vec])
-        assert len(embedding_vec[-1]) == num, 'Wrong size of embedding.'
-        # Wrap it to a numpy array
-        embedding_vec = np.array(embedding_vec, dtype=np.float32)
-    return embedding_key, embedding_vec
 
+def count_lines(item):
+    return len(read_lines(*item))
 
-def load_glove(filename):
+
+def parse_lines(lines, dim):
     """
-    Load GloVe embedding.
-    :param filename: string, file path of GloVe.
-    :return embedding_keys, embedding_vecs: list of words, and numpy array of embedding vector.
+    Parse lines of a word and its embedding separated by space, straight into a float32 array.
+    :param lines: list of lines
+    :param dim: dimension of embedding
+    :return keys, vecs: list of words, and float32 array of embedding vector
+    """
+    keys, vecs = [], np.empty((len(lines), dim), dtype=np.float32)
+    for idx, line in enumerate(lines):
+        line = line.rstrip()
+        word, _, vec = line.partition(' ')
+        if vec.count(' ') != dim - 1:
+            # A word with space
+            word, *vec = line.rsplit(sep=' ', maxsplit=dim)
+            vec = ' '.join(vec)
+        vec = vec.split(' ')
+        if len(vec) != dim:
+            raise ValueError('Wrong embedding dim %d of %s, expected %d.' % (len(vec), word, dim))
+        keys.append(word)
+        # Raises ValueError on a malformed number.
+        vecs[idx] = np.array(vec, dtype=np.float32)
+    return keys, vecs
+
+
+def parse_range(filename, dim, vec_file, item):
+    """
+    Parse a range of lines into their rows of the vector file.
+    :param filename: string, file path of embedding
+    :param dim: dimension of embedding
+    :param vec_file: string, file path of preallocated vector file
+    :param item: tuple of start, end and first row of the range
+    :return: list of words
     """
-    embedding_key, embedding_vec = [], []
-    embedding_size = cp.embedding_size
-    # Read in the data.
-    with io.open(filename, 'r', encoding='utf-8') as savefile:
-        # Split each line of the rest to word and embedding vector
-        for line in tqdm(savefile):
-            tokens = line.rstrip().split(sep=' ', maxsplit=embedding_size)
+    start, end, row = item
+    keys, vecs = parse_lines(read_lines(filename, start, end), dim)
+    out = np.load(vec_file, mmap_mode='r+')
+    out[row:row + len(keys)] = vecs
+    out.flush()
+    return keys
 
-            word, *entries = tokens
-            embedding_key.append(word)
-            embedding_vec.append([float(x) for x in entries])
-            assert len(embedding_vec[-1]) == embedding_size, 'Wrong embedding dim.'
-        # Wrap it to a numpy array
-        embedding_vec = np.array(embedding_vec, dtype=np.float32)
-    return embedding_key, embedding_vec
+
+def load_text_embedding(filename, vec_file, num_workers=1, chunk_bytes=64 << 20):
+    """
+    Load GloVe, word2vec or fastText text file. The file is split into chunks of lines, which are
+    parsed, optionally by several processes, straight into their rows of a preallocated float32
+    array in vec_file.
+    :param filename: string, file path of embedding
+    :param vec_file: string, file path of vector file
+    :param num_workers: number of processes
+    :param chunk_bytes: approximate size of a chunk
+    :return: list of words
+    """
+    header_size, dim = read_header(filename)
+    ranges = line_ranges(filename, header_size, chunk_bytes)
+    items = [(filename, start, end) for start, end in ranges]
+    pool = Pool(num_workers) if num_workers > 1 else None
+    imap = pool.imap if pool else map
+    try:
+        counts = list(tqdm(imap(count_lines, items), total=len(items), desc='Count lines'))
+        rows = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+        open_memmap(du.part_name(vec_file), mode='w+', dtype=np.float32, shape=(int(rows[-1]), dim)).flush()
+        func = partial(parse_range, filename, dim, du.part_name(vec_file))
+        embedding_keys = []
+        for keys in tqdm(imap(func, [(s, e, r) for (s, e), r in zip(ranges, rows[:-1])]),
+                         total=len(ranges), desc='Load word embedding %dd' % dim):
+            embedding_keys.extend(keys)
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+    du.commit_part(vec_file)
+    return embedding_keys
 
 
 def filter_stat(embedding_keys, embedding_vector, max_length=0, print_stat=True,
@@ -174,7 +244,7 @@ def process(args):
     :param args: named tuple, arguments
     :return: None
     """
-    embedding_keys, embedding_vector = load_embedding_vec(cp.target)
+    embedding_keys, embedding_vector = load_embedding_vec(cp.target, args.workers)
 
     fu.block_print(['%s\'s # of embedding: %d' % (cp.target, len(embedding_keys)),
                     '%s\'s shape of embedding vec: %s' % (cp.target, str(embedding_vector.shape))])
@@ -183,42 +253,25 @@ def process(args):
 
     embedding_keys, embedding_vector = filter_stat(embedding_keys, embedding_vector, cp.max_length)
 
-    counter_1gram = Counter()
-    counter_3gram = Counter()
-    counter_6gram = Counter()
-    size_set = set()
-    gram_embedding_keys = [[] for _ in range(len(embedding_keys))]
-
-    max_size = 0
-
-    # Update counter and divide each word to n-gram.
-    for idx, k in enumerate(tqdm(embedding_keys, desc='Counting')):
-        counter_1gram.update(k)
-        gram_embedding_keys[idx].extend(k)
-        k = '<' + k + '>'
-        three_gram = [k[i:i + 3] for i in range(len(k) - 2)]
-        counter_3gram.update(three_gram)
-        gram_embedding_keys[idx].extend(three_gram)
-        six_gram = [k[i:i + 6] for i in range(len(k) - 5)]
-        counter_6gram.update(six_gram)
-        gram_embedding_keys[idx].extend(six_gram)
-        size_set.add(len(gram_embedding_keys[idx]))
-        if max_size < len(gram_embedding_keys[idx]):
-            max_size = len(gram_embedding_keys[idx])
+    # Divide each word to n-gram and count them.
+    counters = count_grams(embedding_keys)
+    sizes = num_grams([len(k) for k in embedding_keys])
+    max_size = int(sizes.max(initial=0))
 
     print('Max size of tokens:', max_size)
-    print('Size set of tokens:', size_set)
+    print('Size set of tokens:', set(sizes.tolist()))
     print('Number of grams:\n',
-          '1-gram:', len(counter_1gram), '3-gram:', len(counter_3gram), '6-gram:', len(counter_6gram))
+          '1-gram:', len(counters[1]), '3-gram:', len(counters[3]), '6-gram:', len(counters[6]))
 
     if not args.debug:
-        du.json_dump({'1': counter_1gram, '3': counter_3gram, '6': counter_6gram}, cp.gram_counter_file)
-        vocab = list(counter_1gram) + list(counter_3gram) + list(counter_6gram) + [UNK]
+        du.json_dump({'1': counters[1], '3': counters[3], '6': counters[6]}, cp.gram_counter_file)
+        vocab = list(counters[1]) + list(counters[3]) + list(counters[6]) + [UNK]
         du.json_dump(vocab, cp.gram_vocab_file)
-        gtoi = {gram: idx for idx, gram in enumerate(vocab)}
-        encoded_embedding_keys = np.ones((len(embedding_keys), max_size), dtype=np.int64) * (len(gtoi) - 1)
-        for idx, k in enumerate(tqdm(gram_embedding_keys, desc='Encoding')):
-            encoded_embedding_keys[idx, :len(k)] = [gtoi[gram] for gram in k]
+        encoder = NgramEncoder(vocab)
+        encoded_embedding_keys = np.full((len(embedding_keys), max_size), len(vocab) - 1, dtype=np.int64)
+        for idx in trange(0, len(embedding_keys), 65536, desc='Encoding'):
+            ids, _ = encoder.encode(embedding_keys[idx:idx + 65536], pad=len(vocab) - 1)
+            encoded_embedding_keys[idx:idx + len(ids), :ids.shape[1]] = ids
         print(encoded_embedding_keys[:5])
         assert len(encoded_embedding_keys) == len(embedding_vector), \
             'First dimensions of encoded keys and vectors are not matched.'
@@ -233,6 +286,7 @@ def process(args):
 def main():
     parser = ArgumentParser()
     parser.add_argument('--debug', action='store_true', help='debug')
+    parser.add_argument('--workers', default=4, type=int, help='Number of processes loading word embedding.')
     args = parser.parse_args()
     process(args)
 
@@ -0,0 +1,238 @@
+from collections import Counter, OrderedDict
+from itertools import compress
+
+import numpy as np
+
+# Sizes of character n-grams taken from '<' + word + '>', besides the characters of the word.
+GRAM_SIZES = (3, 6)
+
+
+def word_grams(word):
+    """
+    Decompose a word into n-grams: its characters, then 3-grams and 6-grams of '<' + word + '>'.
+    :param word: string
+    :return: list of n-grams
+    """
+    w = '<' + word + '>'
+    return list(word) + [w[i:i + n] for n in GRAM_SIZES for i in range(len(w) - n + 1)]
+
+
+def num_grams(lengths):
+    """
+    :param lengths: int array of word lengths
+    :return: number of n-grams of each word
+    """
+    lengths = np.asarray(lengths, dtype=np.int64)
+    return lengths + sum(np.maximum(lengths + 3 - n, 0) for n in GRAM_SIZES)
+
+
+def code_points(words):
+    """
+    :param words: list of words
+    :return points, lengths: uint32 matrix of code points of '<' + word + '>' padded with 0, and
+        lengths of words
+    """
+    lengths = np.array([len(w) for w in words], dtype=np.int64)
+    points = np.zeros((len(words), lengths.max(initial=0) + 2), dtype=np.uint32)
+    column = np.arange(points.shape[1])
+    points[(column >= 1) & (column[None] <= lengths[:, None])] = \
+        np.frombuffer(''.join(words).encode('utf-32-le'), dtype=np.uint32)
+    points[:, 0] = ord('<')
+    points[np.arange(len(words)), lengths + 1] = ord('>')
+    return points, lengths
+
+
+class Alphabet(object):
+    """
+    Map characters to codes 1..len(chars), 0 for unknown characters, so that an n-gram is
+    packed into one int64 key. Grams which do not fit in 63 bits can not be packed.
+    """
+
+    def __init__(self, chars):
+        """
+        :param chars: string of all characters
+        """
+        self._points = np.array(sorted(set(map(ord, set(chars) | {'<', '>'}))), dtype=np.uint32)
+        self.bits = len(self._points).bit_length()
+        self.packable = self.bits * max(GRAM_SIZES) <= 63
+
+    def codes(self, points):
+        index = np.minimum(np.searchsorted(self._points, points), len(self._points) - 1)
+        return np.where(self._points[index] == points, index + 1, 0).astype(np.int64)
+
+    def strings(self, keys, n):
+        """
+        Unpack keys of n-grams without unknown characters.
+        :param keys: int64 keys
+        :param n: size of n-grams
+        :return: list of n-grams
+        """
+        mask = (1 << self.bits) - 1
+        codes = np.stack([(keys >> (self.bits * (n - 1 - j))) & mask for j in range(n)], axis=1)
+        text = self._points[codes.reshape(-1) - 1].astype('<u4').tobytes().decode('utf-32-le')
+        return [text[i:i + n] for i in range(0, len(text), n)]
+
+    def pack(self, codes):
+        """
+        :param codes: int64 matrix of codes, one n-gram per row
+        :return: int64 key of each n-gram
+        """
+        keys = np.zeros(len(codes), dtype=np.int64)
+        for j in range(codes.shape[1]):
+            keys = (keys << self.bits) | codes[:, j]
+        return keys
+
+    def windows(self, codes, lengths, n):
+        """
+        Keys of all n-grams of a batch in the order of word_grams.
+        :param codes: int64 matrix of codes of '<' + word + '>'
+        :param lengths: lengths of words
+        :param n: 1 for characters of words, or one of GRAM_SIZES
+        :return keys, valid: int64 matrix of keys and mask of n-grams inside the words
+        """
+        if n == 1:
+            keys = codes[:, 1:-1]
+            return keys, np.arange(keys.shape[1]) < lengths[:, None]
+        width = max(codes.shape[1] - n + 1, 0)
+        keys = np.zeros((len(codes), width), dtype=np.int64)
+        for j in range(n):
+            keys = (keys << self.bits) | codes[:, j:j + width]
+        return keys, np.arange(width) < (lengths + 3 - n)[:, None]
+
+
+def _compact(parts, valid, pad):
+    """
+    Concatenate the n-grams of each word, dropping the windows outside the word.
+    :param parts: int64 matrices of gram ids, one per n-gram size
+    :param valid: masks of windows inside the words, each one is a prefix of the row
+    :param pad: id of padding
+    :return ids, sizes: padded matrix of gram ids, and number of n-grams of each word
+    """
+    sizes = sum(v.sum(axis=1) for v in valid)
+    ids = np.full((len(sizes), sizes.max(initial=0)), pad, dtype=np.int64)
+    offset = np.zeros(len(sizes), dtype=np.int64)
+    for part, inside in zip(parts, valid):
+        rows, cols = np.nonzero(inside)
+        ids[rows, offset[rows] + cols] = part[rows, cols]
+        offset += inside.sum(axis=1)
+    return ids, sizes
+
+
+class NgramEncoder(object):
+    """
+    Map words to ids of their n-grams in a gram vocabulary. The vocabulary is compiled to one
+    sorted key table per n-gram size, and a batch of words is looked up with np.searchsorted.
+    """
+
+    def __init__(self, grams):
+        """
+        :param grams: list of grams, or dictionary mapping gram to id
+        """
+        if isinstance(grams, dict):
+            grams, ids = list(grams), np.fromiter(grams.values(), dtype=np.int64, count=len(grams))
+        else:
+            grams, ids = list(grams), np.arange(len(grams), dtype=np.int64)
+        self._grams, self._ids = grams, ids
+        self._vocab = None
+        sizes = np.fromiter(map(len, grams), dtype=np.int64, count=len(grams))
+        self._alphabet = Alphabet(''.join(compress(grams, np.isin(sizes, (1,) + GRAM_SIZES))))
+        self._table = {}
+        if self._alphabet.packable:
+            for n in (1,) + GRAM_SIZES:
+                points = np.frombuffer(''.join(compress(grams, sizes == n)).encode('utf-32-le'),
+                                       dtype=np.uint32).reshape((-1, n))
+                keys = self._alphabet.pack(self._alphabet.codes(points))
+                order = np.argsort(keys)
+                self._table[n] = keys[order], ids[sizes == n][order]
+
+    def encode(self, words, pad=-1):
+        """
+        :param words: list of words
+        :param pad: id of padding and of grams out of vocabulary
+        :return ids, sizes: int64 matrix of gram ids in the order of word_grams padded with pad,
+            and number of n-grams of each word
+        """
+        if not self._alphabet.packable:
+            if self._vocab is None:
+                self._vocab = dict(zip(self._grams, self._ids.tolist()))
+            grams = [word_grams(w) for w in words]
+            sizes = np.array([len(g) for g in grams], dtype=np.int64)
+            ids = np.full((len(words), sizes.max(initial=0)), pad, dtype=np.int64)
+            for i, g in enumerate(grams):
+                ids[i, :len(g)] = [self._vocab.get(gram, pad) for gram in g]
+            return ids, sizes
+        points, lengths = code_points(words)
+        codes = self._alphabet.codes(points)
+        parts, valid = [], []
+        for n in (1,) + GRAM_SIZES:
+            keys, inside = self._alphabet.windows(codes, lengths, n)
+            table_keys, table_ids = self._table[n]
+            ids = np.full(keys.shape, pad, dtype=np.int64)
+            if len(table_keys):
+                keys = keys[inside]
+                index = np.minimum(np.searchsorted(table_keys, keys), len(table_keys) - 1)
+                ids[inside] = np.where(table_keys[index] == keys, table_ids[index], pad)
+            parts.append(ids)
+            valid.append(inside)
+        return _compact(parts, valid, pad)
+
+    def embed(self, words, embedding, chunk_size=1024):
+        """
+        Embedding of words as the sum of embedding of their n-grams in vocabulary.
+        :param words: list of words
+        :param embedding: embedding of grams
+        :param chunk_size: number of words gathered at a time
+        :return embed, known: embedding of words, and mask of words with any gram in vocabulary
+        """
+        embed = np.zeros((len(words), embedding.shape[1]), dtype=embedding.dtype)
+        known = np.zeros(len(words), dtype=bool)
+        for start in range(0, len(words), chunk_size):
+            ids, _ = self.encode(words[start:start + chunk_size])
+            mask = ids >= 0
+            rows = embedding[np.maximum(ids, 0)]
+            rows[~mask] = 0
+            embed[start:start + chunk_size] = np.sum(rows, axis=1)
+            known[start:start + chunk_size] = mask.any(axis=1)
+        return embed, known
+
+
+def count_grams(words, chunk_size=65536):
+    """
+    Count characters, 3-grams and 6-grams of words. Grams are kept in the order they first appear.
+    :param words: list of words
+    :param chunk_size: number of words counted at a time
+    :return: dictionary mapping n to Counter of n-grams
+    """
+    counters = {n: Counter() for n in (1,) + GRAM_SIZES}
+    alphabet = Alphabet(''.join(words))
+    if not alphabet.packable:
+        for w in words:
+            grams = word_grams(w)
+            counters[1].update(grams[:len(w)])
+            for n in GRAM_SIZES:
+                counters[n].update(g for g in grams[len(w):] if len(g) == n)
+        return counters
+    # Distinct keys of each n, with their counts and positions of first appearance
+    seen = {n: (np.zeros(0, dtype=np.int64),) * 3 for n in counters}
+    width = max(len(w) for w in words) + 2 if words else 0
+    for start in range(0, len(words), chunk_size):
+        points, lengths = code_points(words[start:start + chunk_size])
+        codes = alphabet.codes(points)
+        for n in counters:
+            keys, inside = alphabet.windows(codes, lengths, n)
+            # Position of a gram in the order of iterating words and their grams
+            position = (start + np.arange(len(keys)))[:, None] * width + np.arange(keys.shape[1])
+            unique, index, inverse = np.unique(keys[inside], return_index=True, return_inverse=True)
+            counts, first = np.bincount(inverse.reshape(-1), minlength=len(unique)), position[inside][index]
+            # Grams of this chunk come after all seen grams, so the first appearance of a seen gram
+            # is kept by the stable unique.
+            unique, index, inverse = np.unique(np.concatenate([seen[n][0], unique]),
+                                               return_index=True, return_inverse=True)
+            seen[n] = unique, np.bincount(inverse.reshape(-1), weights=np.concatenate([seen[n][1], counts]),
+                                          minlength=len(unique)).astype(np.int64), \
+                np.concatenate([seen[n][2], first])[index]
+    for n in counters:
+        unique, counts, first = seen[n]
+        order = np.argsort(first)
+        counters[n].update(OrderedDict(zip(alphabet.strings(unique[order], n), counts[order].tolist())))
+    return counters
@@ -1,9 +1,10 @@
 import math
+import time
 from collections import OrderedDict
 from functools import partial
 from glob import glob
 from multiprocessing import Pool
-from os.path import join
+from os.path import join, basename
 from pprint import pprint
 
 import numpy as np
@@ -16,10 +17,19 @@ from utils import func_utils as fu
 
 
 def create_one_tfrecord(pack):
-    fu.safe_remove(pack.record_name)
-    with tf.python_io.TFRecordWriter(pack.record_name) as tfrecord_writer:
-        for example in pack:
-            tfrecord_writer.write(example.SerializeToString())
+    """
+    Write the examples of a package to its record, through a temporary file, so an interrupted
+    shard is never taken as finished.
+    :param pack: Package
+    :return record_name, length, seconds: record, number of examples, and time spent writing
+    """
+    begin = time.time()
+    fu.safe_remove(du.part_name(pack.record_name))
+    with tf.python_io.TFRecordWriter(du.part_name(pack.record_name)) as tfrecord_writer:
+        for record in pack:
+            tfrecord_writer.write(record)
+    du.commit_part(pack.record_name)
+    return pack.record_name, len(pack), time.time() - begin
 
 
 class Sender(object):
@@ -50,14 +60,20 @@ class Sender(object):
             raise StopIteration
 
 
-# TODO(tommy8054): Consider using threading to prefetch data and share them by SimpleQueue().
 class MailPerson(object):
     """Deliver package to each worker.
-    In our setting, we give exclusive subset of data to each worker. For small data,
-    it is ok. However, if data grows much larger, we should consider this class as a
-    producer to prefetch data and deliver to worker by queue."""
+    Each worker gets an exclusive range of examples. A package only carries the range and the
+    file names of the source arrays, which the worker memory-maps, so nothing but indices goes
+    through the pool and memory does not grow with the number of examples."""
 
     def __init__(self, pattern, num_shards, num_example, features, feature_list):
+        """
+        :param pattern: pattern of record names, formatted with shard number and number of shards
+        :param num_shards: number of shards
+        :param num_example: number of examples
+        :param features: dictionary mapping context feature to .npy file
+        :param feature_list: dictionary mapping sequence feature to .npy file
+        """
         self.pattern = pattern
         self.num_shards = num_shards
         self.num_example = num_example
@@ -73,12 +89,10 @@ class MailPerson(object):
         return self
 
     def __getitem__(self, index):
-        start_ndx = index * self.num_per_shard
+        start_ndx = min(index * self.num_per_shard, self.num_example)
         end_ndx = min((index + 1) * self.num_per_shard, self.num_example)
-        return Package(self.pattern % (index + 1, self.num_shards),
-                       end_ndx - start_ndx,
-                       {k: v[start_ndx:end_ndx] for k, v in self.features.items()},
-                       {k: v[start_ndx:end_ndx] for k, v in self.feature_list.items()}, )
+        return Package(self.pattern % (index + 1, self.num_shards), start_ndx, end_ndx,
+                       self.features, self.feature_list)
 
     def __next__(self):
         if self.index < self.num_shards:
@@ -88,58 +102,97 @@ class MailPerson(object):
             raise StopIteration
 
 
-class Package(object):
-    """Package contain items for worker to work on."""
+def feature_kind(dtype):
+    """Field of tf.train.Feature which holds values of dtype."""
+    if np.issubdtype(dtype, np.integer):
+        return 'int64_list'
+    elif np.issubdtype(dtype, np.floating):
+        return 'float_list'
+    else:
+        return 'bytes_list'
+
+
+def fill_values(feature, kind, value):
+    """
+    Replace the values of a tf.train.Feature in place.
+    :param feature: tf.train.Feature
+    :param kind: field returned by feature_kind
+    :param value: scalar or list of values
+    :return: None
+    """
+    if not isinstance(value, list):
+        value = [value]
+    if kind == 'bytes_list':
+        value = [v.encode('utf-8') if isinstance(v, str) else v for v in value]
+    field = getattr(feature, kind).value
+    del field[:]
+    field.extend(value)
+
 
-    def __init__(self, record_name, length, features, feature_list):
-        assert len(set(
-            len(v) for v in list(feature_list.values()) + list(features.values()))) \
-               == 1, 'Numbers of first dimension in data are mismatched.'
+class Package(object):
+    """Package contains a range of examples for worker to work on.
+    Source arrays are memory-mapped when the package is iterated, and rows are read chunk by
+    chunk into one proto which is reused for all examples."""
+
+    def __init__(self, record_name, start, end, features, feature_list, chunk_size=1024):
+        """
+        :param record_name: file name of the record
+        :param start: first example
+        :param end: end of examples, exclusive
+        :param features: dictionary mapping context feature to .npy file
+        :param feature_list: dictionary mapping sequence feature to .npy file
+        :param chunk_size: number of rows read from the source arrays at a time
+        """
         self.record_name = record_name
-        self.length = length
+        self.start = start
+        self.end = end
         self.features = features
         self.feature_list = feature_list
-        self.index = 0
-
-    def _create_example(self, index):
-        return tf.train.Example(
-            features=tf.train.Features(
-                feature={
-                    k: du.to_feature(v[index])
-                    for k, v in self.features.items()
-                }))
-        # Iterate over feature and get one of instance in (key, value) pairs.
-
-    def _create_sequence_example(self, index):
-        return tf.train.SequenceExample(
-            context=tf.train.Features(feature={
-                k: du.to_feature(v[index])
-                for k, v in self.features.items()
-            }),
-            feature_lists=tf.train.FeatureLists(
-                feature_list={
-                    k: du.to_feature(v[index])
-                    for k, v in self.feature_list.items()}))
-
-    def __getitem__(self, index):
+        self.chunk_size = chunk_size
+
+    def _create_example(self, arrays):
+        """
+        Proto with one entry per feature, whose values are replaced for each example.
+        :param arrays: dictionary mapping feature to memory-mapped array
+        :return example, fields: proto, and (feature or feature list, kind, name) to fill
+        """
+        fields = []
         if self.feature_list:
-            return self._create_sequence_example(index)
+            example = tf.train.SequenceExample()
+            context = example.context.feature
+            for k in self.feature_list:
+                feature_list = example.feature_lists.feature_list[k]
+                for _ in range(arrays[k].shape[1]):
+                    feature_list.feature.add()
+                fields.append((feature_list, feature_kind(arrays[k].dtype), k))
         else:
-            return self._create_example(index)
+            example = tf.train.Example()
+            context = example.features.feature
+        for k in self.features:
+            fields.append((context[k], feature_kind(arrays[k].dtype), k))
+        return example, fields
 
     def __len__(self):
-        return self.length
+        return self.end - self.start
 
     def __iter__(self):
-        self.index = 0
-        return self
-
-    def __next__(self):
-        if self.index < self.length:
-            self.index += 1
-            return self[self.index - 1]
-        else:
-            raise StopIteration
+        """
+        :return: generator of serialized examples
+        """
+        arrays = {k: np.load(v, mmap_mode='r')
+                  for k, v in list(self.features.items()) + list(self.feature_list.items())}
+        example, fields = self._create_example(arrays)
+        for chunk in range(self.start, self.end, self.chunk_size):
+            rows = {k: v[chunk:min(chunk + self.chunk_size, self.end)].tolist() for k, v in arrays.items()}
+            for index in range(min(self.chunk_size, self.end - chunk)):
+                for field, kind, k in fields:
+                    if k in self.feature_list:
+                        for feature, value in zip(field.feature, rows[k][index]):
+                            fill_values(feature, kind, value)
+                    else:
+                        fill_values(field, kind, rows[k][index])
+                # Map entries in key order, so a shard is the same bytes on every run.
+                yield example.SerializeToString(deterministic=True)
 
 
 class TfRecordDataSet(object):
@@ -240,8 +293,9 @@ class TfRecordDataSet(object):
                                     self.context_features, list(self.target.keys()))
 
     def create_tfrecord(self):
-        target = {k: np.load(v) for k, v in self.target.items()}
-        self.num_example, *check_tail = list(set(len(v) for v in target.values()))
+        # Only the headers are read here, workers memory-map the arrays.
+        target = {k: du.npy_header(v) for k, v in self.target.items()}
+        self.num_example, *check_tail = list(set(shape[0] for shape, _, _ in target.values()))
         assert len(check_tail) == 0, 'Different length of targets. %s' % check_tail
         self.info['number_example'] = self.num_example
         self.info['num_shards'] = self.num_shards
@@ -251,20 +305,19 @@ class TfRecordDataSet(object):
 
         for k in target.keys():
             # Iterate over targets
-            t = target[k]
+            shape, _, dtype = target[k]
             # Save tensor information
             self.info['data'][k] = {
-                'dim': t.ndim,
-                'shape': t.shape,
-                'dtype': str(t.dtype)
+                'dim': len(shape),
+                'shape': shape,
+                'dtype': str(dtype)
             }
-            # t is numpy array
-            dim = t.ndim
+            dim = len(shape)
             # decide whether t is a sequence or not (dim == 3 )
             if dim == 3:
-                feature_list[k] = t
+                feature_list[k] = self.target[k]
             elif 0 < dim < 3:
-                features[k] = t
+                features[k] = self.target[k]
             else:
                 raise ValueError('Wrong dimension (%d) of target value. Can\'t be processed later.' % dim)
             # else:
@@ -288,7 +341,8 @@ class TfRecordDataSet(object):
                                features, feature_list)
 
         with Pool(self.num_threads) as pool, tqdm(total=self.num_shards, desc=self.target_dir) as pbar:
-            for _ in pool.imap_unordered(create_one_tfrecord, deliverer):
+            for record_name, length, seconds in pool.imap_unordered(create_one_tfrecord, deliverer):
+                pbar.set_postfix(shard=basename(record_name), rate='%.0f examples/s' % (length / max(seconds, 1e-6)))
                 pbar.update()
 
 
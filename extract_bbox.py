@@ -1,4 +1,5 @@
 import argparse
+import json
 import os
 import time
 from functools import partial
@@ -8,10 +9,12 @@ from os.path import join, exists
 
 import numpy as np
 import tensorflow as tf
-from numpy.lib.format import read_array_header_1_0, read_magic
+from numpy.lib.format import open_memmap, read_array_header_1_0, read_magic
 from tqdm import tqdm
 
 from config import MovieQAPath
+from data import codec as cd
+from data import frame_store as fs
 from utils import data_utils as du
 from utils import func_utils as fu
 
@@ -86,37 +89,129 @@ def get_images_path_v2():
     return file_names, capacity, npy_names
 
 
-def get_images_path_v3():
-    file_names, capacity, npy_names = [], [], []
+def progress_name(npy_name):
+    """Sidecar recording the number of rows already flushed to the .part file of a movie."""
+    return npy_name + '.progress'
+
+
+def load_manifest():
+    """
+    Load the records of finished movies. A line broken by interruption is ignored.
+    :return: dictionary with key: imdb_key, value: {'key', 'shape', 'dtype', 'sha1'}
+    """
+    manifest = {}
+    if exists(_mp.object_feature_manifest):
+        with open(_mp.object_feature_manifest, 'r') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                manifest[record['key']] = record
+    return manifest
+
+
+def append_manifest(record):
+    with open(_mp.object_feature_manifest, 'a') as f:
+        f.write(json.dumps(record) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def feature_record(npy_name, arr):
+    return {'key': fu.basename_wo_ext(npy_name), 'shape': list(arr.shape), 'dtype': arr.dtype.str,
+            'sha1': du.array_checksum(arr)}
+
+
+def is_finished(npy_name, capacity, manifest):
+    """
+    A movie is finished if its .npy file has the expected number of rows and is in manifest.
+    A complete .npy file missing from manifest, e.g. from an older run, is added to it.
+    :param npy_name: .npy file of the movie
+    :param capacity: number of frames of the movie
+    :param manifest: dictionary of manifest records
+    :return: boolean
+    """
+    key = fu.basename_wo_ext(npy_name)
+    if not exists(npy_name):
+        return False
+    if key in manifest:
+        return manifest[key]['shape'][0] == capacity and list(du.npy_header(npy_name)[0]) == manifest[key]['shape']
+    try:
+        # Fails on a file truncated by an interrupted np.save.
+        arr = np.load(npy_name, mmap_mode='r')
+    except ValueError:
+        return False
+    if arr.shape[0] != capacity:
+        return False
+    manifest[key] = feature_record(npy_name, arr)
+    append_manifest(manifest[key])
+    return True
+
+
+def resume_row(npy_name, capacity, codec='float32'):
+    """
+    :param npy_name: .npy file of the movie
+    :param capacity: number of frames of the movie
+    :param codec: storage codec of features
+    :return: number of rows saved by an interrupted run, 0 if the movie starts from scratch
+    """
+    part, progress = du.part_name(npy_name), progress_name(npy_name)
+    if not exists(part) or not exists(progress):
+        return 0
+    shape, _, dtype = du.npy_header(part)
+    # A movie started with another codec starts again.
+    if shape[0] != capacity or dtype != np.dtype(codec) or \
+            (codec == 'int8' and not exists(du.part_name(cd.scale_name(npy_name)))):
+        return 0
+    return min(du.json_load(progress)['rows'], capacity)
+
+
+def get_images_path_v3(frame_store=False, codec='float32'):
+    file_names, capacity, npy_names, start = [], [], [], []
     sample = du.json_load(_mp.sample_frame_file)
+    manifest = load_manifest()
 
     for imdb_key in tqdm(sample, desc='Collect Images'):
-        if not exists(join(_mp.object_feature_dir, imdb_key + '.npy')):
-            npy_names.append(join(_mp.object_feature_dir, imdb_key + '.npy'))
+        npy_name = join(_mp.object_feature_dir, imdb_key + '.npy')
+        num = sum(len(idx) for idx in sample[imdb_key].values())
+        if not is_finished(npy_name, num, manifest):
+            npy_names.append(npy_name)
             videos = list(sample[imdb_key].keys())
             videos.sort()
-            num = 0
+            images = []
+            store = fs.open_store(imdb_key) if frame_store else None
             for v in tqdm(videos):
-                images = [join(_mp.image_dir, v, '%s_%05d.jpg' % (v, i + 1))
-                          for i in sample[imdb_key][v]]
-                file_names.extend(images)
-                num += len(images)
+                if store:
+                    # (store file, offset, length) of each frame
+                    images.extend([(store.store_file,) + tuple(store.location(v, i)) for i in sample[imdb_key][v]])
+                else:
+                    images.extend([join(_mp.image_dir, v, '%s_%05d.jpg' % (v, i + 1))
+                                   for i in sample[imdb_key][v]])
+            # Frames before the resumed row are already saved.
+            start.append(resume_row(npy_name, num, codec))
+            file_names.extend(images[start[-1]:])
             capacity.append(num)
 
     # print(capacity, npy_names)
-    return file_names, capacity, npy_names
+    return file_names, capacity, npy_names, start
 
 
 def check():
     sample = du.json_load(_mp.sample_frame_file)
+    manifest = load_manifest()
     for imdb_key in tqdm(sample, desc='Check..'):
         capacity = 0
         videos = list(sample[imdb_key].keys())
         videos.sort()
         for v in tqdm(videos):
             capacity += len(sample[imdb_key][v])
-        if load_shape(join(_mp.object_feature_dir, imdb_key + '.npy'))[0] != capacity:
-            raise ValueError('Fuck up! %s' % join(_mp.feature_dir, imdb_key + '.npy'))
+        npy_name = join(_mp.object_feature_dir, imdb_key + '.npy')
+        if du.npy_header(npy_name)[0][0] != capacity:
+            raise ValueError('Fuck up! %s' % npy_name)
+        if imdb_key not in manifest or \
+                du.array_checksum(np.load(npy_name, mmap_mode='r')) != manifest[imdb_key]['sha1']:
+            raise ValueError('Checksum mismatch! %s' % npy_name)
 
 
 def count_num(features_list):
@@ -126,37 +221,140 @@ def count_num(features_list):
     return num
 
 
-def writer_worker(queue, capacity, npy_names):
-    video_idx = 0
-    local_feature = []
-    with tqdm(total=len(npy_names)) as pbar:
-        while len(capacity) > video_idx:
-            item = queue.get()
-            if item is not None:
-                local_feature.append(item)
-                local_size = sum([len(f) for f in local_feature])
-                while len(capacity) > video_idx and local_size >= capacity[video_idx]:
-
-                    concat_feature = np.concatenate(local_feature, axis=0)
-                    final_features = concat_feature[:capacity[video_idx]]
-
-                    assert final_features.shape[0] == capacity[video_idx], \
-                        "%s Both frames are not same!" % npy_names[video_idx]
-                    try:
-                        np.save(npy_names[video_idx], final_features)
-                    except Exception as e:
-                        np.save(npy_names[video_idx], final_features)
-                        raise e
-                    time.sleep(3)
-                    pbar.set_description(' '.join([fu.basename_wo_ext(npy_names[video_idx]),
-                                                   str(len(final_features))]))
-                    del local_feature[:]
-                    local_feature.append(concat_feature[capacity[video_idx]:])
-                    local_size = sum([len(f) for f in local_feature])
-                    video_idx += 1
-                    pbar.update()
-            else:
-                break
+def writer_worker(queue, done, capacity, npy_names, sync_rows=1024, codec='float32'):
+    """
+    Save the features of the movies routed to this writer. Each movie is a memory map
+    pre-allocated with its capacity in a .part file, and every batch is copied to its rows
+    directly. The number of flushed rows is recorded every sync_rows rows, so an interrupted
+    movie is resumed from there. A finished movie is renamed to its .npy file.
+    :param queue: queue of (movie index, first row, features), None to stop
+    :param done: queue of (movie index, manifest record) for finished movies
+    :param capacity: list of number of frames of each movie
+    :param npy_names: list of .npy file of each movie
+    :param sync_rows: number of rows between two progress records
+    :param codec: storage codec of features, int8 scales are written to a memory map beside the features
+    :return: None
+    """
+    buffers, scales, counts, synced = {}, {}, {}, {}
+    while True:
+        item = queue.get()
+        if item is None:
+            break
+        idx, start, feature = item
+        feature, scale = cd.quantize(feature, codec)
+        if idx not in buffers:
+            # A movie resumed after its first row continues in the existing .part file.
+            buffers[idx] = open_memmap(du.part_name(npy_names[idx]), mode='r+' if start else 'w+',
+                                       dtype=feature.dtype, shape=(capacity[idx],) + feature.shape[1:])
+            if scale is not None:
+                scales[idx] = open_memmap(du.part_name(cd.scale_name(npy_names[idx])),
+                                          mode='r+' if start else 'w+', dtype=scale.dtype,
+                                          shape=(capacity[idx],) + scale.shape[1:])
+            counts[idx], synced[idx] = start, start
+        buffers[idx][start:start + len(feature)] = feature
+        if scale is not None:
+            scales[idx][start:start + len(scale)] = scale
+        counts[idx] += len(feature)
+        if counts[idx] == capacity[idx]:
+            buffer = buffers.pop(idx)
+            buffer.flush()
+            record = feature_record(npy_names[idx], buffer)
+            del buffer
+            if idx in scales:
+                scales.pop(idx).flush()
+                du.commit_part(cd.scale_name(npy_names[idx]))
+            du.commit_part(npy_names[idx])
+            fu.safe_remove(progress_name(npy_names[idx]))
+            del counts[idx], synced[idx]
+            done.put((idx, record))
+        elif counts[idx] - synced[idx] >= sync_rows:
+            buffers[idx].flush()
+            if idx in scales:
+                scales[idx].flush()
+            du.atomic_json_dump({'rows': counts[idx]}, progress_name(npy_names[idx]))
+            synced[idx] = counts[idx]
+
+
+class FeatureWriter(object):
+    """
+    Route batches of features to several writer processes. Movies are assigned to writers
+    round-robin, and the queues are bounded, so a slow disk blocks the session loop instead of
+    filling the memory.
+    """
+
+    def __init__(self, capacity, npy_names, start, num_writer=2, max_queue=64, codec='float32'):
+        self.capacity = capacity
+        self.npy_names = npy_names
+        self.start_rows = start
+        self.codec = codec
+        self.queues = [Queue(max_queue) for _ in range(num_writer)]
+        self.done = Queue()
+        self.processes = [Process(target=writer_worker, args=(q, self.done, capacity, npy_names),
+                                  kwargs={'codec': codec})
+                          for q in self.queues]
+        # Current movie and its number of received rows
+        self.video_idx, self.row = 0, start[0] if start else 0
+        self.num_done, self.num_rows = 0, 0
+        self.start_time = None
+        self.pbar = tqdm(total=len(npy_names), desc='Save features')
+
+    def start(self):
+        for p in self.processes:
+            p.start()
+        self.start_time = time.time()
+        self._skip_empty()
+
+    def _skip_empty(self):
+        # Movies without frames never get a batch.
+        while self.video_idx < len(self.capacity) and self.capacity[self.video_idx] == 0:
+            npy_name = self.npy_names[self.video_idx]
+            cd.save(npy_name, np.zeros((0, 6, 2048), dtype=np.float32), self.codec)
+            self.done.put((self.video_idx, feature_record(npy_name, np.load(npy_name))))
+            self.video_idx += 1
+            self.row = self.start_rows[self.video_idx] if self.video_idx < len(self.start_rows) else 0
+
+    def put(self, feature):
+        """
+        Split a batch at the boundaries of movies and send the pieces to their writers.
+        :param feature: features of a batch of frames, in order of file names
+        :return: None
+        """
+        self.num_rows += len(feature)
+        while len(feature) and self.video_idx < len(self.capacity):
+            length = min(len(feature), self.capacity[self.video_idx] - self.row)
+            queue = self.queues[self.video_idx % len(self.queues)]
+            queue.put((self.video_idx, self.row, feature[:length]))
+            feature = feature[length:]
+            self.row += length
+            if self.row == self.capacity[self.video_idx]:
+                self.video_idx += 1
+                self.row = self.start_rows[self.video_idx] if self.video_idx < len(self.start_rows) else 0
+                self._skip_empty()
+        self.report()
+
+    def report(self):
+        while not self.done.empty():
+            idx, record = self.done.get()
+            append_manifest(record)
+            self.num_done += 1
+            self.pbar.set_description(' '.join([record['key'], str(record['shape'][0])]))
+            self.pbar.update()
+        self.pbar.set_postfix(queue=[q.qsize() for q in self.queues],
+                              rows_per_sec='%.1f' % (self.num_rows / max(time.time() - self.start_time, 1e-6)))
+
+    def close(self):
+        for q in self.queues:
+            q.put(None)
+        for p in self.processes:
+            p.join()
+        self.report()
+        self.pbar.close()
+
+    def terminate(self):
+        for p in self.processes:
+            p.terminate()
+            p.join()
+        self.pbar.close()
 
 
 def parse_func(filename):
@@ -165,6 +363,13 @@ def parse_func(filename):
     return image, filename
 
 
+def parse_packed_func(store_file, offset, length):
+    raw_image = tf.py_func(fs.read_bytes, [store_file, offset, length], tf.string, stateful=False)
+    raw_image.set_shape([])
+    image = tf.image.decode_jpeg(raw_image, channels=3)
+    return image, store_file
+
+
 def preprocess_func(image, filename):
     image = tf.image.resize_image_with_crop_or_pad(image, 360, 720)
     return image, filename
@@ -173,7 +378,9 @@ def preprocess_func(image, filename):
 def input_pipeline(filename_placeholder, batch_size=32, num_worker=4):
     dataset = tf.data.Dataset.from_tensor_slices(filename_placeholder)
     dataset = dataset.repeat(1)
-    dataset = dataset.map(parse_func, num_parallel_calls=num_worker)
+    # A tuple of (store file, offset, length) placeholders reads frames from frame stores.
+    dataset = dataset.map(parse_packed_func if isinstance(filename_placeholder, tuple) else parse_func,
+                          num_parallel_calls=num_worker)
     dataset = dataset.map(preprocess_func, num_parallel_calls=num_worker)
     dataset = dataset.batch(batch_size)
     dataset = dataset.prefetch(1000)
@@ -189,6 +396,10 @@ def args_parse():
     parser.add_argument('--num_worker', default=4, type=int, help='Number of worker reading data.')
     parser.add_argument('--reset', action='store_true', help='Reset all the extracted features.')
     parser.add_argument('--check', action='store_true', help='Check all the extracted features.')
+    parser.add_argument('--frame_store', action='store_true', help='Read frames from frame stores.')
+    parser.add_argument('--num_writer', default=2, type=int, help='Number of processes saving features.')
+    parser.add_argument('--max_queue', default=64, type=int, help='Max batches waiting for each writer.')
+    parser.add_argument('--codec', default='float32', choices=cd.CODECS, help='Storage codec of features.')
     return parser.parse_args()
 
 
@@ -202,8 +413,9 @@ if __name__ == '__main__':
         check()
     if reset:
         os.system('rm -rf %s' % _mp.object_feature_dir)
+        fu.safe_remove(_mp.object_feature_manifest)
     fu.make_dirs(_mp.object_feature_dir)
-    fn, cap, npy_n = get_images_path_v3()
+    fn, cap, npy_n, st = get_images_path_v3(args.frame_store, args.codec)
 
     detection_graph = tf.Graph()
     with detection_graph.as_default():
@@ -215,7 +427,14 @@ if __name__ == '__main__':
 
     tf.reset_default_graph()
     num_step = int(ceil(len(fn) / bsize))
-    fp = tf.placeholder(tf.string, shape=[None])
+    if args.frame_store:
+        fp = (tf.placeholder(tf.string, shape=[None]), tf.placeholder(tf.int64, shape=[None]),
+              tf.placeholder(tf.int64, shape=[None]))
+        # Every placeholder is fed, with empty lists when all movies are finished.
+        feed_dict = {p: [f[i] for f in fn] for i, p in enumerate(fp)}
+    else:
+        fp = tf.placeholder(tf.string, shape=[None])
+        feed_dict = {fp: fn}
     img, names, it = input_pipeline(fp, bsize, num_w)
     tensor_list = tf.import_graph_def(od_graph_def, input_map={'image_tensor:0': img},
                                       return_elements=[key + ':0' for key in
@@ -231,30 +450,20 @@ if __name__ == '__main__':
     # with detection_graph.as_default():
     run_metadata = tf.RunMetadata()
     with tf.Session(config=config) as sess:
-        q = Queue()
-        p = Process(target=writer_worker, args=(q, cap, npy_n))
-        p.start()
-        sess.run(it.initializer, feed_dict={fp: fn})
+        writer = FeatureWriter(cap, npy_n, st, args.num_writer, args.max_queue, args.codec)
+        writer.start()
+        sess.run(it.initializer, feed_dict=feed_dict)
         # print(sess.run(feature_tensor).shape)
-        # total = 0
-        # count = 0
         try:
             for _ in range(num_step):
                 output_tensor = sess.run(object_feature, )
-                # total += np.sum(output_tensor[0])
-                # count += len(output_tensor[0])
-                # print(total / count)
                 # options=tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE),
                 # run_metadata=run_metadata)
-                q.put(output_tensor)
+                writer.put(output_tensor)
             # trace = timeline.Timeline(step_stats=run_metadata.step_stats)
             # with open('this.timeline.ctf.json', 'w') as trace_file:
             #     trace_file.write(trace.generate_chrome_trace_format())
-            q.put(None)
-            time.sleep(5)
+            writer.close()
         except KeyboardInterrupt:
             print()
-            p.terminate()
-        finally:
-            p.join()
-            q.close()
+            writer.terminate()
@@ -12,6 +12,7 @@ from numpy.lib.format import read_array_header_1_0, read_magic
 from tqdm import tqdm
 
 from config import MovieQAPath
+from data import frame_store as fs
 from legacy.inception_preprocessing import preprocess_image
 from legacy.inception_resnet_v2 import inception_resnet_v2_arg_scope, inception_resnet_v2
 from utils import data_utils as du
@@ -92,7 +93,7 @@ def get_images_path_v2():
     return file_names, capacity, npy_names
 
 
-def get_images_path_v3():
+def get_images_path_v3(frame_store=False):
     file_names, capacity, npy_names = [], [], []
     sample = du.json_load(_mp.sample_frame_file)
 
@@ -102,9 +103,14 @@ def get_images_path_v3():
         videos = list(sample[imdb_key].keys())
         videos.sort()
         num = 0
+        store = fs.open_store(imdb_key) if frame_store else None
         for v in tqdm(videos):
-            images = [join(_mp.image_dir, v, '%s_%05d.jpg' % (v, i + 1))
-                      for i in sample[imdb_key][v]]
+            if store:
+                # (store file, offset, length) of each frame
+                images = [(store.store_file,) + tuple(store.location(v, i)) for i in sample[imdb_key][v]]
+            else:
+                images = [join(_mp.image_dir, v, '%s_%05d.jpg' % (v, i + 1))
+                          for i in sample[imdb_key][v]]
             file_names.extend(images)
             num += len(images)
         capacity.append(num)
@@ -166,6 +172,13 @@ def parse_func(filename):
     return image, filename
 
 
+def parse_packed_func(store_file, offset, length):
+    raw_image = tf.py_func(fs.read_bytes, [store_file, offset, length], tf.string, stateful=False)
+    raw_image.set_shape([])
+    image = tf.image.decode_jpeg(raw_image, channels=3)
+    return image, store_file
+
+
 def preprocess_func(image, filename):
     image = preprocess_image(image, 299, 299, is_training=False)
     return image, filename
@@ -174,11 +187,13 @@ def preprocess_func(image, filename):
 def input_pipeline(filename_placeholder, batch_size=32, num_worker=4):
     dataset = tf.data.Dataset.from_tensor_slices(filename_placeholder)
     dataset = dataset.repeat(1)
+    # A tuple of (store file, offset, length) placeholders reads frames from frame stores.
+    parse = parse_packed_func if isinstance(filename_placeholder, tuple) else parse_func
     images, names_, iterator = [], [], []
     if args.num_gpu > 1:
         for i in range(args.num_gpu):
             dd = dataset.shard(args.num_gpu, i)
-            dd = dd.map(parse_func, num_parallel_calls=num_worker)
+            dd = dd.map(parse, num_parallel_calls=num_worker)
             dd = dd.map(preprocess_func, num_parallel_calls=num_worker)
             dd = dd.batch(batch_size)
             dd = dd.prefetch(16)
@@ -188,7 +203,7 @@ def input_pipeline(filename_placeholder, batch_size=32, num_worker=4):
             names_.append(n_)
             iterator.append(itit)
     else:
-        dataset = dataset.map(parse_func, num_parallel_calls=num_worker)
+        dataset = dataset.map(parse, num_parallel_calls=num_worker)
         dataset = dataset.batch(batch_size)
         dataset = dataset.prefetch(1000)
         iterator = dataset.make_initializable_iterator()
@@ -202,6 +217,7 @@ def args_parse():
     parser.add_argument('--batch_size', default=8, type=int, help='Batch size of images')
     parser.add_argument('--num_worker', default=2, type=int, help='Number of worker reading data.')
     parser.add_argument('--reset', action='store_true', help='Reset all the extracted features.')
+    parser.add_argument('--frame_store', action='store_true', help='Read frames from frame stores.')
     return parser.parse_args()
 
 
@@ -213,10 +229,16 @@ if __name__ == '__main__':
     if reset:
         os.system('rm -rf %s' % _mp.feature_dir)
     fu.make_dirs(_mp.feature_dir)
-    fn, cap, npy_n = get_images_path_v3()
+    fn, cap, npy_n = get_images_path_v3(args.frame_store)
 
     num_step = int(ceil(len(fn) / bsize))
-    fp = tf.placeholder(tf.string, shape=[None])
+    if args.frame_store:
+        fp = (tf.placeholder(tf.string, shape=[None]), tf.placeholder(tf.int64, shape=[None]),
+              tf.placeholder(tf.int64, shape=[None]))
+        feed_dict = dict(zip(fp, [list(c) for c in zip(*fn)]))
+    else:
+        fp = tf.placeholder(tf.string, shape=[None])
+        feed_dict = {fp: fn}
     img, names, it = input_pipeline(fp, bsize, num_w)
     if args.num_gpu > 1:
         feature_tensor = make_parallel(models, args.num_gpu, img)
@@ -240,7 +262,7 @@ if __name__ == '__main__':
         tf.global_variables_initializer().run()
         tf.local_variables_initializer().run()
         saver.restore(sess, './inception_resnet_v2_2016_08_30.ckpt')
-        sess.run([iit.initializer for iit in it], feed_dict={fp: fn})
+        sess.run([iit.initializer for iit in it], feed_dict=feed_dict)
         # print(sess.run(feature_tensor).shape)
         try:
             for _ in range(num_step):
@@ -6,6 +6,7 @@ import tensorflow as tf
 from tqdm import trange
 
 from config import MovieQAPath
+from data import codec as cd
 from utils import data_utils as du
 
 _mp = MovieQAPath()
@@ -14,7 +15,7 @@ embedding_size = 300
 
 def _qa_load(s, qa):
     qid = s.decode('utf-8')
-    enc = qa[qid].astype(np.float32)
+    enc = cd.dequantize(qa[qid], qa.get(qid + 'scale'))
     spec = qa[qid + 'spec'].astype(np.int32)
     gt = qa[qid + 'correct_index'].astype(np.int64)
     return enc[:1], enc[1:6], spec, gt
@@ -29,12 +30,16 @@ def qa_load(tensor, qa):
 
 def _feat_load(s, feature, subtitle, mode):
     imdb_key = s.decode('utf-8')
+    if 'subt' in mode:
+        subt = cd.dequantize(subtitle[imdb_key], subtitle.get(imdb_key + 'scale'))
+    if 'feat' in mode:
+        feat = cd.dequantize(feature[imdb_key], feature.get(imdb_key + 'scale'))
     if 'subt' in mode and 'feat' in mode:
-        return subtitle[imdb_key].astype(np.float32), feature[imdb_key].astype(np.float32)
+        return subt, feat
     elif 'subt' in mode:
-        return subtitle[imdb_key].astype(np.float32), np.zeros((1, 6, 2048), dtype=np.float32)
+        return subt, np.zeros((1, 6, 2048), dtype=np.float32)
     elif 'feat' in mode:
-        return np.zeros((1, embedding_size), dtype=np.float32), feature[imdb_key].astype(np.float32)
+        return np.zeros((1, embedding_size), dtype=np.float32), feat
     else:
         return np.zeros((1, embedding_size), dtype=np.float32), np.zeros((1, 6, 2048), dtype=np.float32)
 
@@ -6,20 +6,29 @@ import numpy as np
 from tqdm import tqdm
 
 from config import MovieQAPath
+from data import codec as cd
 from utils import data_utils as du
 
 _mp = MovieQAPath()
 
 
+def load_encoded(encode_dict, key, npy_name):
+    """Keep the encoded array under key, and the scales of int8 data under key + 'scale'."""
+    data, scale = cd.read(npy_name)
+    encode_dict[key] = np.array(data)
+    if scale is not None:
+        encode_dict[key + 'scale'] = np.array(scale)
+
+
 def load_ques(encode_dict, qa):
-    encode_dict[qa['qid']] = np.load(join(_mp.encode_dir, qa['qid'] + '.npy'))
+    load_encoded(encode_dict, qa['qid'], join(_mp.encode_dir, qa['qid'] + '.npy'))
     encode_dict[qa['qid'] + 'spec'] = np.load(join(_mp.encode_dir, qa['qid'] + '_spec.npy'))
     encode_dict[qa['qid'] + 'correct_index'] = qa['correct_index']
 
 
 def load_feat(objfeat_dcit, subtfeat_dict, imdb_key):
-    objfeat_dcit[imdb_key] = np.load(join(_mp.object_feature_dir, imdb_key + '.npy'))
-    subtfeat_dict[imdb_key] = np.load(join(_mp.encode_dir, imdb_key + '.npy'))
+    load_encoded(objfeat_dcit, imdb_key, join(_mp.object_feature_dir, imdb_key + '.npy'))
+    load_encoded(subtfeat_dict, imdb_key, join(_mp.encode_dir, imdb_key + '.npy'))
 
 
 def main():
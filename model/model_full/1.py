@@ -31,6 +31,25 @@ def l1_norm(x, axis=None, epsilon=1e-6, name=None):
         return tf.multiply(x, x_inv_norm, name=name)
 
 
+def spec_rows(context, spec):
+    """
+    Gather the spec rows of each question, padded to the largest number of spec rows S of the questions.
+    :param context: (B, N, E) context of each question, or (N, E) context shared by the questions
+    :param spec: (B, N) spec of each question
+    :return rows, mask: (B, S, E) spec rows, and (B, S) float mask of the valid ones
+    """
+    spec = tf.cast(spec, tf.bool)
+    # (K, 2): [question, row] of each spec row, and its position among the spec rows of its question
+    where = tf.where(spec)
+    position = tf.gather_nd(tf.cumsum(tf.to_int32(spec), axis=1, exclusive=True), where)
+    values = tf.gather(context, where[:, 1]) if context.shape.ndims == 2 else tf.gather_nd(context, where)
+    num_spec = tf.reduce_sum(tf.to_int32(spec), axis=1)
+    max_spec = tf.reduce_max(tf.concat([num_spec, [0]], 0))
+    rows = tf.scatter_nd(tf.stack([tf.to_int32(where[:, 0]), position], axis=1), values,
+                         tf.stack([tf.shape(spec)[0], max_spec, tf.shape(context)[-1]]))
+    return rows, tf.sequence_mask(num_spec, max_spec, dtype=tf.float32)
+
+
 class Model(object):
     def __init__(self, data, scale=0.0, training=False):
         self.data = data
@@ -196,6 +215,275 @@ class Model(object):
             self.output = tf.transpose(self.output)
 
 
+class BatchModel(object):
+    """
+    Model on a batch of questions from Input(batch_size > 1). It is the same model as Model,
+    and creates the same variables in the same order, so checkpoints are interchangeable.
+    Context rows beyond data.length are padding; they have no spec, and data.mask keeps
+    them out of propagation and attention.
+    """
+
+    def __init__(self, data, scale=0.0, training=False):
+        self.data = data
+        reg = layers.l2_regularizer(scale)
+        init = tf.glorot_normal_initializer(seed=0)
+
+        with tf.variable_scope('Embedding_Linear'):
+            # (B, 1, E_t), (B, 5, E_t), (B, N, E_t), (B, N, 6, 2048)
+            self.raw_ques = l2_norm(self.data.ques, axis=-1)
+            self.raw_ans = l2_norm(self.data.ans, axis=-1)
+            self.raw_subt = l2_norm(self.data.subt, axis=-1)
+            self.raw_feat = l2_norm(self.data.feat, axis=2)
+
+            self.raw_ques = dropout(self.raw_ques, training)
+            self.raw_ans = dropout(self.raw_ans, training)
+            self.raw_subt = dropout(self.raw_subt, training)
+            self.raw_feat = dropout(self.raw_feat, training)
+
+            # (B, N, 1)
+            self.mask = tf.expand_dims(self.data.mask, 2)
+            self.spec = tf.expand_dims(tf.to_float(self.data.spec), 2)
+            self.neg_spec = (1.0 - self.spec) * self.mask
+
+            # (B, 5, E_t)
+            self.ans = tf.layers.dense(self.raw_ans, hp['emb_dim'],
+                                       kernel_initializer=init, kernel_regularizer=reg)
+            self.ans = self.ans + self.raw_ans
+            self.ans = l2_norm(self.ans, axis=-1)
+            self.ans = dropout(self.ans, training)
+
+            # (B, N, E_t)
+            self.subt = tf.layers.dense(self.raw_subt, hp['emb_dim'],
+                                        kernel_initializer=init, kernel_regularizer=reg)
+            self.subt = self.subt + self.raw_subt
+            self.subt = l2_norm(self.subt, axis=-1)
+            self.subt = dropout(self.subt, training)
+
+            # (B, 1, E_t)
+            self.ques = tf.layers.dense(self.raw_ques, hp['emb_dim'],
+                                        kernel_initializer=init, kernel_regularizer=reg)
+            self.ques = self.ques + self.raw_ques
+            self.ques = l2_norm(self.ques, axis=-1)
+            self.ques = dropout(self.ques, training)
+
+            # (B, N, 6, E_t)
+            self.feat = tf.layers.dense(self.raw_feat, hp['emb_dim'],
+                                        kernel_initializer=init, kernel_regularizer=reg)
+            self.feat = l2_norm(self.feat, axis=2)
+            self.feat = dropout(self.feat, training)
+
+        with tf.variable_scope('Response'):
+            # (B, N, E_t)
+            self.front_subt = self.subt + self.ques
+            for _ in range(5):
+                self.front_subt = tf.layers.dense(self.front_subt, hp['emb_dim'],
+                                                  kernel_initializer=init, kernel_regularizer=reg)
+                self.front_subt = l2_norm(self.front_subt, axis=-1)
+                self.front_subt = dropout(self.front_subt, training)
+            # (B, N_s, E_t), (B, N_s): spec rows of each question, padded to the most spec rows of the batch
+            self.spec_subt, self.spec_mask = spec_rows(self.subt, self.data.spec)
+            # (B, N, N_s)
+            self.propagation = tf.matmul(self.front_subt, self.spec_subt, transpose_b=True)
+            self.propagation = tf.nn.relu(self.propagation) * tf.expand_dims(self.spec_mask, 1)
+            # (B, N, 1): mean over spec rows
+            num_spec = tf.maximum(tf.reduce_sum(self.spec_mask, axis=1), 1.0)
+            self.propagation = tf.reduce_sum(self.propagation, axis=2, keepdims=True) / num_spec[:, None, None]
+            # (B, N, 1)
+            self.belief = self.propagation * self.neg_spec
+            self.belief = dropout(self.belief, training)
+            self.belief = self.spec + self.belief
+            self.belief = tf.minimum(self.belief, 1.0)
+
+            # (B, N, 6, 1)
+            self.fq = tf.reduce_sum(self.feat * tf.expand_dims(self.ques, 1), axis=3, keepdims=True)
+            self.fq = tf.nn.relu(self.fq)
+            self.fq = dropout(self.fq, training)
+
+            # (B, N, E_t)
+            self.feat_new = tf.reduce_sum(self.feat * self.fq, axis=2)
+            self.feat_new = l2_norm(self.feat_new, axis=-1)
+            self.feat_new = dropout(self.feat_new, training)
+
+            # (B, N, 5)
+            self.fna = tf.matmul(self.feat_new, self.ans, transpose_b=True)
+            self.fna = tf.nn.relu(self.fna)
+            self.fna = dropout(self.fna, training)
+
+            # (B, N, 1)
+            self.fnq = tf.matmul(self.feat_new, self.ques, transpose_b=True)
+            self.fnq = tf.nn.relu(self.fnq)
+            self.fnq = dropout(self.fnq, training)
+
+            # (B, N, 1)
+            self.sq = tf.matmul(self.subt, self.ques, transpose_b=True)
+            self.sq = tf.nn.relu(self.sq)
+            self.sq = dropout(self.sq, training)
+            # (B, N, 5)
+            self.sa = tf.matmul(self.subt, self.ans, transpose_b=True)
+            self.sa = tf.nn.relu(self.sa)
+            self.sa = dropout(self.sa, training)
+            alpha1 = tf.nn.sigmoid(tf.get_variable('alpha1', [], initializer=tf.zeros_initializer()))
+            alpha2 = tf.nn.sigmoid(tf.get_variable('alpha2', [], initializer=tf.zeros_initializer()))
+
+            # (B, 5, N, 1)
+            self.attn = self.sq + alpha1 * self.sa
+            self.attn = self.attn * self.belief
+            self.attn = tf.expand_dims(tf.transpose(self.attn, [0, 2, 1]), 3)
+
+            self.feat_attn = self.fnq + self.fna * alpha2
+            self.feat_attn = self.feat_attn * self.belief
+            self.feat_attn = tf.expand_dims(tf.transpose(self.feat_attn, [0, 2, 1]), 3)
+
+            # (B, 5, E_t)
+            self.abst = tf.reduce_sum(self.attn * tf.expand_dims(self.subt, 1), axis=2)
+            self.abst_feat = tf.reduce_sum(self.feat_attn * tf.expand_dims(self.feat_new, 1), axis=2)
+            beta1 = tf.nn.sigmoid(tf.get_variable('beta1', [], initializer=tf.zeros_initializer()))
+            beta2 = tf.nn.sigmoid(tf.get_variable('beta2', [], initializer=tf.zeros_initializer()))
+            self.abst = beta1 * self.abst + self.ques * (1 - beta1) + beta2 * self.abst_feat
+            self.abst = l2_norm(self.abst, axis=-1)
+            self.abst = dropout(self.abst, training)
+
+            # (B, 5)
+            self.output = tf.reduce_sum(self.ans * self.abst, axis=2)
+
+
+class MovieModel(object):
+    """
+    Model scoring several questions of one movie from MovieInput. It is the same model as Model with
+    the same variables, but the movie-side projections (subt, feat, and the subtitle half of the first
+    Response layer) are computed once per movie instead of once per question. Questions are then
+    scored against them together with (Q, N) attention. In training, the dropout masks of the movie
+    context are shared by the questions of a step.
+    """
+
+    def __init__(self, data, scale=0.0, training=False):
+        self.data = data
+        reg = layers.l2_regularizer(scale)
+        init = tf.glorot_normal_initializer(seed=0)
+
+        with tf.variable_scope('Embedding_Linear'):
+            # (Q, E_t), (Q, 5, E_t), (N, E_t), (N, 6, 2048)
+            self.raw_ques = l2_norm(tf.squeeze(self.data.ques, 1))
+            self.raw_ans = l2_norm(self.data.ans, axis=2)
+            self.raw_subt = l2_norm(self.data.subt)
+            self.raw_feat = l2_norm(self.data.feat)
+
+            self.raw_ques = dropout(self.raw_ques, training)
+            self.raw_ans = dropout(self.raw_ans, training)
+            self.raw_subt = dropout(self.raw_subt, training)
+            self.raw_feat = dropout(self.raw_feat, training)
+
+            # (Q, N, 1)
+            self.spec = tf.expand_dims(tf.to_float(self.data.spec), 2)
+            self.neg_spec = 1.0 - self.spec
+
+            # (Q, 5, E_t)
+            self.ans = tf.layers.dense(self.raw_ans, hp['emb_dim'],
+                                       kernel_initializer=init, kernel_regularizer=reg)
+            self.ans = self.ans + self.raw_ans
+            self.ans = l2_norm(self.ans, axis=2)
+            self.ans = dropout(self.ans, training)
+
+            # (N, E_t), once per movie
+            self.subt = tf.layers.dense(self.raw_subt, hp['emb_dim'],
+                                        kernel_initializer=init, kernel_regularizer=reg)
+            self.subt = self.subt + self.raw_subt
+            self.subt = l2_norm(self.subt)
+            self.subt = dropout(self.subt, training)
+
+            # (Q, E_t)
+            self.ques = tf.layers.dense(self.raw_ques, hp['emb_dim'],
+                                        kernel_initializer=init, kernel_regularizer=reg)
+            self.ques = self.ques + self.raw_ques
+            self.ques = l2_norm(self.ques)
+            self.ques = dropout(self.ques, training)
+
+            # (N, 6, E_t), once per movie
+            self.feat = tf.layers.dense(self.raw_feat, hp['emb_dim'],
+                                        kernel_initializer=init, kernel_regularizer=reg)
+            self.feat = l2_norm(self.feat)
+            self.feat = dropout(self.feat, training)
+
+        with tf.variable_scope('Response'):
+            # dense(subt + ques) = dense(subt) + ques W, so the subtitle part is projected once per movie.
+            front = tf.layers.Dense(hp['emb_dim'], kernel_initializer=init, kernel_regularizer=reg)
+            # (Q, N, E_t)
+            self.front_subt = tf.expand_dims(front(self.subt), 0) + \
+                              tf.expand_dims(tf.matmul(self.ques, front.kernel), 1)
+            self.front_subt = l2_norm(self.front_subt, axis=2)
+            self.front_subt = dropout(self.front_subt, training)
+            for _ in range(4):
+                self.front_subt = tf.layers.dense(self.front_subt, hp['emb_dim'],
+                                                  kernel_initializer=init, kernel_regularizer=reg)
+                self.front_subt = l2_norm(self.front_subt, axis=2)
+                self.front_subt = dropout(self.front_subt, training)
+            # (Q, N_s, E_t), (Q, N_s): spec rows of each question, padded to the most spec rows of the step
+            self.spec_subt, self.spec_mask = spec_rows(self.subt, self.data.spec)
+            # (Q, N, N_s)
+            self.propagation = tf.matmul(self.front_subt, self.spec_subt, transpose_b=True)
+            self.propagation = tf.nn.relu(self.propagation) * tf.expand_dims(self.spec_mask, 1)
+            # (Q, N, 1): mean over spec rows
+            num_spec = tf.maximum(tf.reduce_sum(self.spec_mask, axis=1), 1.0)
+            self.propagation = tf.reduce_sum(self.propagation, axis=2, keepdims=True) / num_spec[:, None, None]
+            # (Q, N, 1)
+            self.belief = self.propagation * self.neg_spec
+            self.belief = dropout(self.belief, training)
+            self.belief = self.spec + self.belief
+            self.belief = tf.minimum(self.belief, 1.0)
+
+            # (N, Q, 6)
+            self.fq = tf.transpose(tf.tensordot(self.ques, self.feat, [[1], [2]]), [1, 0, 2])
+            self.fq = tf.nn.relu(self.fq)
+            self.fq = dropout(self.fq, training)
+
+            # (Q, N, E_t)
+            self.feat_new = tf.transpose(tf.matmul(self.fq, self.feat), [1, 0, 2])
+            self.feat_new = l2_norm(self.feat_new, axis=2)
+            self.feat_new = dropout(self.feat_new, training)
+
+            # (Q, N, 5)
+            self.fna = tf.matmul(self.feat_new, self.ans, transpose_b=True)
+            self.fna = tf.nn.relu(self.fna)
+            self.fna = dropout(self.fna, training)
+
+            # (Q, N, 1)
+            self.fnq = tf.matmul(self.feat_new, tf.expand_dims(self.ques, 2))
+            self.fnq = tf.nn.relu(self.fnq)
+            self.fnq = dropout(self.fnq, training)
+
+            # (Q, N, 1)
+            self.sq = tf.expand_dims(tf.matmul(self.ques, self.subt, transpose_b=True), 2)
+            self.sq = tf.nn.relu(self.sq)
+            self.sq = dropout(self.sq, training)
+            # (Q, N, 5)
+            self.sa = tf.transpose(tf.tensordot(self.ans, self.subt, [[2], [1]]), [0, 2, 1])
+            self.sa = tf.nn.relu(self.sa)
+            self.sa = dropout(self.sa, training)
+            alpha1 = tf.nn.sigmoid(tf.get_variable('alpha1', [], initializer=tf.zeros_initializer()))
+            alpha2 = tf.nn.sigmoid(tf.get_variable('alpha2', [], initializer=tf.zeros_initializer()))
+
+            # (Q, 5, N)
+            self.attn = self.sq + alpha1 * self.sa
+            self.attn = self.attn * self.belief
+            self.attn = tf.transpose(self.attn, [0, 2, 1])
+
+            self.feat_attn = self.fnq + self.fna * alpha2
+            self.feat_attn = self.feat_attn * self.belief
+            self.feat_attn = tf.transpose(self.feat_attn, [0, 2, 1])
+
+            # (Q, 5, E_t)
+            self.abst = tf.tensordot(self.attn, self.subt, [[2], [0]])
+            self.abst_feat = tf.matmul(self.feat_attn, self.feat_new)
+            beta1 = tf.nn.sigmoid(tf.get_variable('beta1', [], initializer=tf.zeros_initializer()))
+            beta2 = tf.nn.sigmoid(tf.get_variable('beta2', [], initializer=tf.zeros_initializer()))
+            self.abst = beta1 * self.abst + tf.expand_dims(self.ques, 1) * (1 - beta1) + beta2 * self.abst_feat
+            self.abst = l2_norm(self.abst, axis=2)
+            self.abst = dropout(self.abst, training)
+
+            # (Q, 5)
+            self.output = tf.reduce_sum(self.ans * self.abst, axis=2)
+
+
 def main():
     data = Input(split='train', mode='subt')
     model = Model(data)
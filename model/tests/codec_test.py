@@ -0,0 +1,130 @@
+import shutil
+import tempfile
+import unittest
+from os.path import exists, join
+
+import numpy as np
+
+from data import codec as cd
+from data import feature_store as fs
+
+
+class QuantizeTestCase(unittest.TestCase):
+    def setUp(self):
+        self.arr = np.random.RandomState(0).randn(4, 6, 32).astype(np.float32)
+
+    def test_float32(self):
+        data, scale = cd.quantize(self.arr, 'float32')
+        self.assertIsNone(scale)
+        np.testing.assert_array_equal(cd.dequantize(data, scale), self.arr)
+
+    def test_float16(self):
+        data, scale = cd.quantize(self.arr, 'float16')
+        self.assertEqual(data.dtype, np.float16)
+        self.assertIsNone(scale)
+        decoded = cd.dequantize(data)
+        self.assertEqual(decoded.dtype, np.float32)
+        np.testing.assert_allclose(decoded, self.arr, rtol=1e-3, atol=1e-4)
+
+    def test_int8(self):
+        data, scale = cd.quantize(self.arr, 'int8')
+        self.assertEqual(data.dtype, np.int8)
+        self.assertEqual(scale.shape, self.arr.shape[:-1])
+        self.assertEqual(scale.dtype, np.float32)
+        # The largest value of each vector is exact up to float rounding, the others are within half a step.
+        self.assertEqual(np.abs(data).max(axis=-1).min(), 127)
+        decoded = cd.dequantize(data, scale)
+        self.assertTrue((np.abs(decoded - self.arr) <= scale[..., None] / 2 * (1 + 1e-5)).all())
+
+    def test_zero_vectors(self):
+        self.arr[1, 2] = 0
+        self.arr[3] = 0
+        data, scale = cd.quantize(self.arr, 'int8')
+        self.assertEqual(scale[1, 2], 0)
+        self.assertTrue((scale[3] == 0).all())
+        decoded = cd.dequantize(data, scale)
+        self.assertFalse(np.isnan(decoded).any())
+        self.assertTrue((decoded[1, 2] == 0).all())
+        self.assertTrue((decoded[3] == 0).all())
+        for codec in ['float32', 'float16']:
+            self.assertTrue((cd.dequantize(*cd.quantize(np.zeros((2, 8)), codec)) == 0).all())
+
+    def test_unknown(self):
+        self.assertRaises(ValueError, cd.quantize, self.arr, 'int4')
+
+
+class SaveTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.name = join(self.dir, 'feature.npy')
+        self.arr = np.random.RandomState(1).randn(10, 16).astype(np.float32)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_int8(self):
+        cd.save(self.name, self.arr, 'int8')
+        self.assertTrue(exists(cd.scale_name(self.name)))
+        data, scale = cd.read(self.name, 2, 5)
+        self.assertEqual(data.dtype, np.int8)
+        np.testing.assert_array_equal(scale, cd.quantize(self.arr, 'int8')[1][2:5])
+        np.testing.assert_array_equal(cd.load(self.name, 2, 5), cd.load(self.name)[2:5])
+        np.testing.assert_allclose(cd.load(self.name), self.arr, atol=np.abs(self.arr).max() / 254 * (1 + 1e-5))
+
+    def test_overwrite(self):
+        # The scales of an int8 file are removed when it is saved again with another codec.
+        cd.save(self.name, self.arr, 'int8')
+        cd.save(self.name, self.arr, 'float16')
+        self.assertFalse(exists(cd.scale_name(self.name)))
+        data, scale = cd.read(self.name)
+        self.assertEqual(data.dtype, np.float16)
+        self.assertIsNone(scale)
+
+    def test_keep_dtype(self):
+        cd.save(self.name, self.arr.astype(np.float64), None)
+        self.assertEqual(np.load(self.name).dtype, np.float64)
+        cd.save(self.name, np.arange(4, dtype=np.int32), None)
+        np.testing.assert_array_equal(cd.load(self.name), np.arange(4))
+
+    def test_np_save(self):
+        # Files written by np.save before the codecs are read as they are.
+        np.save(self.name, self.arr)
+        np.testing.assert_array_equal(cd.load(self.name, 3), self.arr[3:])
+
+
+class FeatureStoreTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.store_dir = fs._mp.store_dir
+        fs._mp.store_dir = self.dir
+        rng = np.random.RandomState(2)
+        self.keys = ['tt0000001', 'tt0000002', 'tt0000003']
+        self.arrays = [rng.randn(n, 3, 8).astype(np.float32) for n in [5, 0, 7]]
+        self.arrays[2][4] = 0
+        self.files = [join(self.dir, k + '.npy') for k in self.keys]
+        for f, a in zip(self.files, self.arrays):
+            np.save(f, a)
+
+    def tearDown(self):
+        fs._mp.store_dir = self.store_dir
+        shutil.rmtree(self.dir)
+
+    def build(self, codec):
+        store_file, index_file = join(self.dir, 'store.npy'), join(self.dir, 'index.json')
+        fs.build_feature_store(self.files, self.keys, store_file, index_file, codec, chunk_rows=2)
+        return fs.FeatureStore(store_file, index_file)
+
+    def test_get(self):
+        for codec in cd.CODECS:
+            store = self.build(codec)
+            for k, a in zip(self.keys, self.arrays):
+                expected = cd.dequantize(*cd.quantize(a, codec))
+                self.assertEqual(store.num_rows(k), len(a))
+                np.testing.assert_array_equal(store.get(k), expected)
+                np.testing.assert_array_equal(store.get(k, 1, 4), expected[1:4])
+                np.testing.assert_array_equal(store.get(k, 3, 2), expected[3:2])
+            self.assertTrue((store.get('tt0000003', 4, 5) == 0).all())
+
+
+if __name__ == '__main__':
+    unittest.main()
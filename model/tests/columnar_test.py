@@ -0,0 +1,78 @@
+import shutil
+import tempfile
+import unittest
+from os.path import join
+
+import numpy as np
+
+from data import columnar as col
+
+
+class StringTableTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def table(self, strings):
+        files = join(self.dir, 'blob.npy'), join(self.dir, 'offsets.npy')
+        col.write_strings(*files, strings)
+        return col.StringTable(*files)
+
+    def test_round_trip(self):
+        strings = ['tt0000001', '', 'Québec', '你好', 'a b\nc']
+        table = self.table(strings)
+        self.assertEqual(len(table), len(strings))
+        self.assertEqual(table.tolist(), strings)
+        self.assertEqual([table[i] for i in range(len(strings))], strings)
+
+    def test_slice(self):
+        strings = [str(i) * i for i in range(10)]
+        table = self.table(strings)
+        self.assertEqual(table.slice(3, 7), strings[3:7])
+        self.assertEqual(table.slice(4, 4), [])
+
+    def test_empty(self):
+        self.assertEqual(self.table([]).tolist(), [])
+        self.assertEqual(self.table(['', '']).tolist(), ['', ''])
+
+    def test_json(self):
+        table = self.table(['{"b": 1, "a": [2, 3]}'])
+        self.assertEqual(list(table.json(0).items()), [('b', 1), ('a', [2, 3])])
+
+
+class ColumnTestCase(unittest.TestCase):
+    def setUp(self):
+        self.columnar_dir = col._mp.columnar_dir
+        col._mp.columnar_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(col._mp.columnar_dir)
+        col._mp.columnar_dir = self.columnar_dir
+
+    def test_ragged_offsets(self):
+        np.testing.assert_array_equal(col.ragged_offsets([2, 0, 3]), [0, 2, 2, 5])
+
+    def test_frame_time(self):
+        frame_time = {'tt0000001': [0.5, 1.0, 1.5], 'tt0000002': [], 'tt0000003': [0.1]}
+        col.save_frame_time(frame_time)
+        keys, offsets, time = col.load_frame_time()
+        self.assertEqual(keys, list(frame_time))
+        for i, k in enumerate(keys):
+            self.assertEqual(time[offsets[i]:offsets[i + 1]].tolist(), frame_time[k])
+
+    def test_subtitle(self):
+        subtitle = {'tt0000001': {'start': [1.0, 2.0], 'end': [1.5, 2.5], 'lines': ['Hi.', 'Bye.']},
+                    'tt0000002': {'start': [0.0], 'end': [0.1], 'lines': ['']}}
+        col.save_subtitle(subtitle)
+        keys, offsets, start, end, lines = col.load_subtitle()
+        self.assertEqual(keys, list(subtitle))
+        for i, k in enumerate(keys):
+            self.assertEqual(start[offsets[i]:offsets[i + 1]].tolist(), subtitle[k]['start'])
+            self.assertEqual(end[offsets[i]:offsets[i + 1]].tolist(), subtitle[k]['end'])
+            self.assertEqual(lines.slice(offsets[i], offsets[i + 1]), subtitle[k]['lines'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,122 @@
+import io
+import json
+import random
+import shutil
+import tempfile
+import unittest
+from os.path import join
+
+import utils.func_utils as fu
+from data import data_loader as dl
+from data.data_loader import SRT_REGEX, iter_srt_cues
+
+
+class SrtCueTestCase(unittest.TestCase):
+    def check(self, text):
+        self.assertEqual(list(iter_srt_cues(io.StringIO(text))), [m.groups() for m in SRT_REGEX.finditer(text)])
+
+    def test_regular(self):
+        self.check('1\n00:00:01,000 --> 00:00:02,000\nHello.\nThere.\n\n'
+                   '2\n00:00:03,000 --> 00:00:04,000 X1:10\n<i>Bye.</i>\n\n')
+
+    def test_no_empty_line(self):
+        # The content ends at the next cue even without an empty line.
+        self.check('1\n00:00:01,000 --> 00:00:02,000\nHello.\n2\n00:00:03,000 --> 00:00:04,000\nBye.')
+
+    def test_empty_content(self):
+        # A cue without content takes the next cue as content, unless an empty line follows.
+        self.check('1\n00:00:01,000 --> 00:00:02,000\n2\n00:00:03,000 --> 00:00:04,000\nBye.\n')
+        self.check('1\n00:00:01,000 --> 00:00:02,000\n\n2\n00:00:03,000 --> 00:00:04,000\nBye.\n')
+        self.check('1\n00:00:01,000 --> 00:00:02,000\n')
+
+    def test_garbage(self):
+        self.check('junk 1\n\n  \n00:00:01,000 --> 00:00:02,000\nHello.\n\n\n\nmore 2\n'
+                   '00:00:03,000 -> 00:00:04,000\nBye.\n3')
+
+    def test_random(self):
+        fragments = ['1\n', '12\n', 'abc 7\n', '3  \n', '00:00:01,000 --> 00:00:02,500\n',
+                     '00:00:03.000 --> 00:00:04,000 X1:5\n', '00:00:05,000 -->00:00:06,000\n', 'Hello there.\n',
+                     '<i>Hi</i>\n', '\n', '   \n', '42', 'text', '5\n\n', '00:01:00,000 --> 00:01:02,000']
+        rng = random.Random(0)
+        for _ in range(3000):
+            self.check(''.join(rng.choice(fragments) for _ in range(rng.randint(0, 25))))
+
+
+def old_get(qa, qa_list):
+    # get() before the indexes, as a reference
+    inc = qa._inc
+    index = [i for i in range(len(qa_list))
+             if any(s in qa_list[i]['qid'] for s in inc['split']) and qa_list[i]['imdb_key'] in inc['imdb_key']]
+    if inc['video_clips'] == {True}:
+        index = [i for i in index if qa_list[i]['video_clips']]
+    elif inc['video_clips'] != {False}:
+        if inc['video_clips']:
+            index = [i for i in index if fu.intersect(qa_list[i]['video_clips'], inc['video_clips'])]
+        else:
+            index = [i for i in index if not qa_list[i]['video_clips']]
+    return [qa_list[i]['qid'] for i in index]
+
+
+class QATestCase(unittest.TestCase):
+    ATTRS = ['qa_file', 'splits_file', 'video_data_file', 'columnar_dir']
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.paths = {k: getattr(dl._mp, k) for k in self.ATTRS}
+        for k in self.ATTRS:
+            setattr(dl._mp, k, join(self.dir, k + ('.json' if k.endswith('file') else '')))
+        rng = random.Random(0)
+        movies = {'train': ['tt0000001', 'tt0000002'], 'val': ['tt0000003'], 'test': ['tt0000004']}
+        self.qa_list = []
+        # Questions of a movie are not contiguous and some have no video clip.
+        for i in range(40):
+            split = rng.choice(list(movies))
+            imdb_key = rng.choice(movies[split])
+            clips = sorted(rng.sample(['%s.sf-%03d.mp4' % (imdb_key, c) for c in range(4)], rng.randint(0, 2)))
+            self.qa_list.append({'qid': '%s:%s:%d' % (split, imdb_key, i), 'imdb_key': imdb_key,
+                                 'question': 'Q%d?' % i, 'answers': ['A', 'B'], 'video_clips': clips})
+        for name, obj in [('qa_file', self.qa_list), ('splits_file', movies),
+                          ('video_data_file', {k: {} for v in movies.values() for k in v})]:
+            with open(getattr(dl._mp, name), 'w') as f:
+                json.dump(obj, f)
+        self.qa = dl.QA()
+
+    def tearDown(self):
+        for k, v in self.paths.items():
+            setattr(dl._mp, k, v)
+        shutil.rmtree(self.dir)
+
+    def check(self):
+        view = self.qa.get()
+        self.assertEqual([ins['qid'] for ins in view], old_get(self.qa, self.qa_list))
+        by_qid = {ins['qid']: ins for ins in self.qa_list}
+        self.assertEqual(list(view), [by_qid[ins['qid']] for ins in view])
+
+    def test_get(self):
+        clip = self.qa_list[0]['video_clips'] or self.qa_list[1]['video_clips']
+        self.check()
+        for kwargs in [{'split': ['train']}, {'split': ['val', 'test']}, {'imdb_key': ['tt0000001', 'tt0000003']},
+                       {'video_clips': True}, {'video_clips': clip},
+                       {'split': ['train'], 'imdb_key': ['tt0000002'], 'video_clips': True}]:
+            self.qa.reset().include(**kwargs)
+            self.check()
+            self.qa.reset().exclude(**kwargs)
+            self.check()
+        self.qa.reset().include(split=['train'], video_clips=clip).include(video_clips=self.qa_list[2]['video_clips'])
+        self.check()
+        # Split names are matched as substrings of qid.
+        self.qa.reset().include(split=['tt0000002'])
+        self.check()
+
+    def test_edit(self):
+        view = self.qa.reset().include(video_clips=True).get()
+        view[0]['question'] = 'Edited?'
+        view[-1]['answers'].append('C')
+        self.assertEqual(view[0]['question'], 'Edited?')
+        self.assertEqual(view[len(view) - 1]['answers'][-1], 'C')
+        self.assertEqual([ins['question'] for ins in view[:1]], ['Edited?'])
+        self.assertEqual(view.tolist()[0]['question'], 'Edited?')
+
+
+if __name__ == '__main__':
+    unittest.main()
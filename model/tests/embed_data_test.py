@@ -0,0 +1,50 @@
+import shutil
+import tempfile
+import unittest
+from os.path import join
+
+import numpy as np
+
+from embed.data import cp, load_text_embedding, parse_lines
+
+
+def write_embedding(filename, words, vecs, header=False):
+    with open(filename, 'w', encoding='utf-8') as f:
+        if header:
+            f.write('%d %d\n' % vecs.shape)
+        for w, v in zip(words, vecs):
+            f.write(w + ' ' + ' '.join(repr(float(x)) for x in v) + ' \n')
+
+
+class TextEmbeddingTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        rng = np.random.RandomState(0)
+        self.words = ['w%d' % i for i in range(200)] + ['a b', 'é']
+        self.vecs = rng.randn(len(self.words), cp.embedding_size)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def check(self, header):
+        text_file, vec_file = join(self.dir, 'embedding.txt'), join(self.dir, 'vec.npy')
+        write_embedding(text_file, self.words, self.vecs, header)
+        # Small chunks, so lines are parsed in many ranges.
+        words = load_text_embedding(text_file, vec_file, chunk_bytes=1 << 14)
+        self.assertEqual(words, self.words)
+        # Same as float() of each number, then float32
+        np.testing.assert_array_equal(np.load(vec_file), self.vecs.astype(np.float32))
+
+    def test_glove(self):
+        self.check(False)
+
+    def test_w2v(self):
+        self.check(True)
+
+    def test_malformed(self):
+        self.assertRaises(ValueError, parse_lines, ['x 1 2'], 3)
+        self.assertRaises(ValueError, parse_lines, ['x 1 abc 3'], 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
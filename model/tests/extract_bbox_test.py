@@ -0,0 +1,87 @@
+import shutil
+import tempfile
+import unittest
+from os.path import join
+
+import numpy as np
+from numpy.lib.format import open_memmap
+
+import extract_bbox as eb
+from data import codec as cd
+from utils import data_utils as du
+
+
+class ResumeTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.manifest_file = eb._mp.object_feature_manifest
+        eb._mp.object_feature_manifest = join(self.dir, 'manifest.jsonl')
+        self.npy_name = join(self.dir, 'tt0000001.npy')
+
+    def tearDown(self):
+        eb._mp.object_feature_manifest = self.manifest_file
+        shutil.rmtree(self.dir)
+
+    def write_part(self, capacity, rows, dtype=np.float32):
+        part = open_memmap(du.part_name(self.npy_name), mode='w+', dtype=dtype, shape=(capacity, 6, 2048))
+        del part
+        du.atomic_json_dump({'rows': rows}, eb.progress_name(self.npy_name))
+
+    def test_resume_from_scratch(self):
+        self.assertEqual(eb.resume_row(self.npy_name, 10), 0)
+
+    def test_resume(self):
+        self.write_part(10, 4)
+        self.assertEqual(eb.resume_row(self.npy_name, 10), 4)
+
+    def test_resume_clipped(self):
+        self.write_part(10, 12)
+        self.assertEqual(eb.resume_row(self.npy_name, 10), 10)
+
+    def test_resume_other_capacity(self):
+        self.write_part(10, 4)
+        self.assertEqual(eb.resume_row(self.npy_name, 11), 0)
+
+    def test_resume_other_codec(self):
+        self.write_part(10, 4)
+        self.assertEqual(eb.resume_row(self.npy_name, 10, 'float16'), 0)
+
+    def test_resume_int8_without_scale(self):
+        self.write_part(10, 4, np.int8)
+        self.assertEqual(eb.resume_row(self.npy_name, 10, 'int8'), 0)
+
+    def test_resume_int8(self):
+        self.write_part(10, 4, np.int8)
+        with open(du.part_name(cd.scale_name(self.npy_name)), 'wb') as f:
+            np.save(f, np.ones((10, 6), dtype=np.float32))
+        self.assertEqual(eb.resume_row(self.npy_name, 10, 'int8'), 4)
+
+    def test_not_finished(self):
+        self.assertFalse(eb.is_finished(self.npy_name, 3, {}))
+
+    def test_finished_without_manifest(self):
+        np.save(self.npy_name, np.ones((3, 6, 2048), dtype=np.float32))
+        manifest = {}
+        self.assertTrue(eb.is_finished(self.npy_name, 3, manifest))
+        self.assertEqual(manifest['tt0000001']['shape'], [3, 6, 2048])
+        # The record is appended to the manifest file.
+        self.assertIn('tt0000001', eb.load_manifest())
+
+    def test_finished_other_capacity(self):
+        np.save(self.npy_name, np.ones((3, 6, 2048), dtype=np.float32))
+        self.assertFalse(eb.is_finished(self.npy_name, 4, {}))
+
+    def test_truncated(self):
+        np.save(self.npy_name, np.ones((3, 6, 2048), dtype=np.float32))
+        with open(self.npy_name, 'r+b') as f:
+            f.truncate(1000)
+        self.assertFalse(eb.is_finished(self.npy_name, 3, {}))
+
+    def test_manifest_shape(self):
+        np.save(self.npy_name, np.ones((3, 6, 2048), dtype=np.float32))
+        record = eb.feature_record(self.npy_name, np.ones((2, 6, 2048), dtype=np.float32))
+        self.assertFalse(eb.is_finished(self.npy_name, 3, {'tt0000001': record}))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,54 @@
+import shutil
+import tempfile
+import unittest
+
+from data import frame_store as fs
+
+KEY = 'tt0000001'
+
+
+class FrameStoreTestCase(unittest.TestCase):
+    def setUp(self):
+        self.frame_store_dir = fs._mp.frame_store_dir
+        fs._mp.frame_store_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(fs._mp.frame_store_dir)
+        fs._mp.frame_store_dir = self.frame_store_dir
+
+    def write(self, clip, frames):
+        writer = fs.ClipWriter(clip)
+        for i, data in frames.items():
+            writer.add_bytes(i, data)
+        writer.close()
+
+    def check(self, clips):
+        self.assertEqual(fs.packed_clips(KEY), set(clips))
+        store = fs.FrameStore(KEY)
+        self.assertEqual(store.clips(), sorted(clips))
+        for clip, frames in clips.items():
+            for i, data in frames.items():
+                self.assertEqual(store.get_bytes(clip, i), data)
+        store.close()
+
+    def test_round_trip(self):
+        clips = {KEY + '.sf-000001.ef-000100.video': {0: b'a' * 10, 5: b'bc'},
+                 KEY + '.sf-000200.ef-000300.video': {1: b'', 2: b'\n\xff' * 100}}
+        for clip, frames in clips.items():
+            self.write(clip, frames)
+        self.check(clips)
+        self.assertEqual(fs.packed_clips('tt0000002'), set())
+
+    def test_torn_line(self):
+        first = {KEY + '.sf-000001.ef-000100.video': {0: b'first'}}
+        self.write(*list(first.items())[0])
+        # A writer killed in the middle of its index line
+        with open(fs.store_files(KEY)[1], 'a') as f:
+            f.write('{"clip": "%s.sf-000200.ef-000300.video", "fra' % KEY)
+        second = {KEY + '.sf-000400.ef-000500.video': {3: b'second'}}
+        self.write(*list(second.items())[0])
+        self.check(dict(first, **second))
+
+
+if __name__ == '__main__':
+    unittest.main()
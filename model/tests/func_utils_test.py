@@ -0,0 +1,30 @@
+import unittest
+
+import utils.func_utils as fu
+
+_shared = {}
+
+
+def read_worker(key):
+    return _shared[key] * 2
+
+
+def fail_worker(key):
+    raise ValueError(key)
+
+
+class SharedPoolTestCase(unittest.TestCase):
+    def test_read(self):
+        with fu.shared_pool(_shared, 2, a=1, b=[2, 3]) as pool:
+            self.assertEqual(pool.map(read_worker, ['a', 'b']), [2, [2, 3, 2, 3]])
+        self.assertEqual(_shared, {})
+
+    def test_clear_on_error(self):
+        with self.assertRaises(ValueError):
+            with fu.shared_pool(_shared, 2, a=1) as pool:
+                pool.map(fail_worker, ['a'])
+        self.assertEqual(_shared, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,73 @@
+import random
+import unittest
+from collections import Counter
+
+import numpy as np
+
+from embed.ngram import NgramEncoder, count_grams, num_grams, word_grams
+
+UNK = '<unk>'
+
+
+def random_words(rng, chars, num):
+    return [''.join(rng.choice(chars) for _ in range(rng.randint(1, 12))) for _ in range(num)]
+
+
+def counter_grams(words):
+    # Counting in embed/data.process before vectorization
+    counter_1gram, counter_3gram, counter_6gram = Counter(), Counter(), Counter()
+    for k in words:
+        counter_1gram.update(k)
+        k = '<' + k + '>'
+        counter_3gram.update([k[i:i + 3] for i in range(len(k) - 2)])
+        counter_6gram.update([k[i:i + 6] for i in range(len(k) - 5)])
+    return counter_1gram, counter_3gram, counter_6gram
+
+
+class NgramTestCase(unittest.TestCase):
+    def check(self, chars):
+        rng = random.Random(0)
+        words = random_words(rng, chars, 500)
+        expected = counter_grams(words)
+        counters = count_grams(words)
+        for n, counter in zip((1, 3, 6), expected):
+            # Same counts, in the same order of first appearance
+            self.assertEqual(list(counters[n].items()), list(counter.items()))
+
+        vocab = list(expected[0]) + list(expected[1]) + list(expected[2]) + [UNK]
+        gtoi = {gram: idx for idx, gram in enumerate(vocab)}
+        # Words with unseen characters and grams
+        words += random_words(rng, chars + 'XYZ', 100)
+        ids, sizes = NgramEncoder(vocab).encode(words, pad=len(vocab) - 1)
+        for i, w in enumerate(words):
+            grams = word_grams(w)
+            self.assertEqual(sizes[i], len(grams))
+            self.assertEqual(ids[i, :len(grams)].tolist(), [gtoi.get(g, len(vocab) - 1) for g in grams])
+            self.assertTrue((ids[i, len(grams):] == len(vocab) - 1).all())
+        np.testing.assert_array_equal(num_grams([len(w) for w in words]), sizes)
+
+        # Embedding of a word is the sum of embedding of its grams in vocabulary.
+        gram_vocab = {g: i for i, g in enumerate(vocab[::2])}
+        gram_embed = np.random.RandomState(0).randn(len(gram_vocab), 4)
+        embed, known = NgramEncoder(gram_vocab).embed(words, gram_embed, chunk_size=64)
+        for i, w in enumerate(words):
+            code = [gram_vocab[g] for g in word_grams(w) if g in gram_vocab]
+            self.assertEqual(known[i], bool(code))
+            np.testing.assert_allclose(embed[i], np.sum(gram_embed[code], axis=0) if code else 0)
+
+    def test_packed(self):
+        self.check('abcdefgé\'-')
+
+    def test_large_alphabet(self):
+        # Too many characters to pack a 6-gram into 63 bits
+        self.check(''.join(chr(0x4e00 + i) for i in range(2000)))
+
+    def test_empty(self):
+        counters = count_grams([])
+        self.assertEqual([len(counters[n]) for n in (1, 3, 6)], [0, 0, 0])
+        ids, sizes = NgramEncoder(['a', UNK]).encode([])
+        self.assertEqual(ids.shape[0], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+import shutil
+import tempfile
+import unittest
+from os.path import join
+
+import numpy as np
+
+from data import qa_store as qs
+
+ATTRS = {'store_dir': '', 'qa_store_file': 'qa_embedding.npy', 'qa_spec_interval_file': 'qa_spec_intervals.npy',
+         'qa_spec_offset_file': 'qa_spec_offsets.npy', 'qa_spec_length_file': 'qa_spec_lengths.npy',
+         'qa_store_index': 'qa_index.json'}
+
+
+class SpecIntervalsTestCase(unittest.TestCase):
+    def test_runs(self):
+        np.testing.assert_array_equal(qs.spec_intervals([0, 1, 1, 0, 0, 1, 0]), [[1, 3], [5, 6]])
+
+    def test_ends(self):
+        np.testing.assert_array_equal(qs.spec_intervals([1, 1, 0, 2]), [[0, 2], [3, 4]])
+        np.testing.assert_array_equal(qs.spec_intervals([1]), [[0, 1]])
+
+    def test_empty(self):
+        self.assertEqual(qs.spec_intervals([0, 0, 0]).shape, (0, 2))
+        self.assertEqual(qs.spec_intervals([]).shape, (0, 2))
+
+    def test_random(self):
+        rng = np.random.RandomState(0)
+        for _ in range(100):
+            spectrum = (rng.uniform(size=rng.randint(0, 50)) < 0.3).astype(np.int32)
+            rebuilt = np.zeros_like(spectrum)
+            for start, end in qs.spec_intervals(spectrum):
+                rebuilt[start:end] = 1
+            np.testing.assert_array_equal(rebuilt, spectrum)
+
+
+class QAStoreTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.paths = {k: getattr(qs._mp, k) for k in ATTRS}
+        for k, v in ATTRS.items():
+            setattr(qs._mp, k, join(self.dir, v))
+        rng = np.random.RandomState(1)
+        self.qids = ['tt0000001:%d' % i for i in range(6)]
+        self.embedding = rng.randn(len(self.qids), 6, 8).astype(np.float32)
+        self.spectra = [(rng.uniform(size=20) < 0.4).astype(np.int32) for _ in self.qids]
+        # A question without spec
+        self.spectra[2][:] = 0
+
+    def tearDown(self):
+        for k, v in self.paths.items():
+            setattr(qs._mp, k, v)
+        shutil.rmtree(self.dir)
+
+    def save(self, codec):
+        qs.save_qa_store(self.qids, self.embedding, [qs.spec_intervals(s) for s in self.spectra],
+                         [len(s) for s in self.spectra], codec)
+        return qs.QAStore()
+
+    def test_round_trip(self):
+        store = self.save('float32')
+        self.assertEqual(len(store), len(self.qids))
+        self.assertNotIn('tt0000002:0', store)
+        for i, qid in enumerate(self.qids):
+            row = store.row(qid)
+            self.assertEqual(row, i)
+            np.testing.assert_array_equal(store.embedding(row), self.embedding[i])
+            np.testing.assert_array_equal(store.spec(row), self.spectra[i])
+            self.assertEqual(store.spec(row).dtype, np.int32)
+            self.assertEqual(store.length(row), 20)
+        np.testing.assert_array_equal(store.embedding([3, 1]), self.embedding[[3, 1]])
+
+    def test_int8(self):
+        store = self.save('int8')
+        rows = list(range(len(self.qids)))
+        np.testing.assert_allclose(store.embedding(rows), self.embedding, atol=np.abs(self.embedding).max() / 127)
+
+
+if __name__ == '__main__':
+    unittest.main()
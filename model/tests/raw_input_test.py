@@ -0,0 +1,395 @@
+import random
+import shutil
+import tempfile
+import unittest
+from functools import partial
+from importlib import import_module
+from os.path import join
+from types import SimpleNamespace
+
+import numpy as np
+import tensorflow as tf
+
+import raw_input as ri
+from data import feature_store as fs
+from data import qa_store as qs
+from raw_input import LRUCache, PrefetchPolicy, add_length, bucket, bucket_pool, element_bytes, embedding_size, \
+    native_load, native_source, py_func_ops, upstream_bytes
+
+full = import_module('model.model_full.1')
+
+
+class LRUCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        # Room for two arrays of 100 float32
+        self.cache = LRUCache(800)
+        self.loads = []
+
+    def load(self, key):
+        def func():
+            self.loads.append(key)
+            return np.full(100, key, dtype=np.float32)
+
+        return self.cache.get(key, func)
+
+    def test_hit(self):
+        self.load(1)
+        self.load(1)
+        self.assertEqual(self.loads, [1])
+        self.assertEqual(self.cache.stats()['hits'], 1)
+        self.assertEqual(self.cache.stats()['misses'], 1)
+
+    def test_copy(self):
+        self.load(1)[:] = 0
+        np.testing.assert_array_equal(self.load(1), np.full(100, 1, dtype=np.float32))
+
+    def test_evict_by_bytes(self):
+        self.load(1)
+        self.load(2)
+        self.load(3)
+        self.assertEqual(self.cache.stats()['items'], 2)
+        self.assertEqual(self.cache.stats()['bytes'], 800)
+        self.load(1)
+        self.assertEqual(self.loads, [1, 2, 3, 1])
+
+    def test_evict_least_recent(self):
+        self.load(1)
+        self.load(2)
+        self.load(1)
+        self.load(3)
+        self.load(1)
+        self.assertEqual(self.loads, [1, 2, 3])
+
+    def test_too_large(self):
+        value = self.cache.get('large', lambda: np.zeros(1000, dtype=np.float32))
+        self.assertEqual(len(value), 1000)
+        self.assertEqual(self.cache.stats()['items'], 0)
+
+
+def run_epoch(policy, length, ahead):
+    """Count an epoch of length elements, where the producer is ahead(i) elements ahead of the model at i."""
+    depth = policy.next_depth()
+    produced = 0
+    for i in range(length):
+        while produced < min(length, i + min(ahead(i), depth)):
+            if produced % policy.sample_every == 0:
+                policy.produce(produced, 100)
+            produced += 1
+        if i % policy.sample_every == 0:
+            policy.consume(i)
+    return depth
+
+
+class PrefetchPolicyTestCase(unittest.TestCase):
+    def test_limit(self):
+        policy = PrefetchPolicy(1000, 100)
+        self.assertEqual((policy.limit, policy.depth, policy.sample_every), (10, 10, 1))
+        self.assertEqual(PrefetchPolicy(1000, 1, max_depth=64).limit, 64)
+        self.assertEqual(PrefetchPolicy(10, 100).limit, 1)
+        self.assertEqual(PrefetchPolicy(10 ** 9, 1).sample_every, 16)
+
+    def test_reserved(self):
+        # The fixed buffers before the prefetch buffer are taken out of the budget.
+        self.assertEqual(PrefetchPolicy(1000, 100, reserved=350).limit, 6)
+        self.assertEqual(PrefetchPolicy(1000, 100, reserved=2000).limit, 1)
+        self.assertEqual(PrefetchPolicy(1000, 100, reserved=2000).stats()['reserved'], 2000)
+
+    def test_upstream_bytes(self):
+        feat = 100 * 6 * 2048 * 4
+        # Up to 4 feat elements in flight and 4 prefetched, plus the other components
+        self.assertEqual(upstream_bytes(100, 'feat'), 8 * feat + 2 * 6 * 300 * 4 + 4 * 300 * 4 + 2 * 100 * 4)
+        self.assertEqual(upstream_bytes(100, 'feat+subt', 8) - upstream_bytes(100, 'feat+subt'),
+                         element_bytes(100, 'feat+subt', 8))
+        self.assertLess(upstream_bytes(100, 'subt'), feat)
+
+    def test_shrink(self):
+        # The model is slower than the producer, so the buffer stays full.
+        policy = PrefetchPolicy(800, 100)
+        run_epoch(policy, 200, lambda i: 8)
+        self.assertEqual(policy.stats()['starved'], 0)
+        self.assertEqual(policy.stats()['peak_occupancy'], 8)
+        self.assertEqual(policy.stats()['peak_bytes'], 800)
+        self.assertEqual(policy.next_depth(), 5)
+
+    def test_grow(self):
+        policy = PrefetchPolicy(800, 100)
+        run_epoch(policy, 200, lambda i: 8)
+        # Bursts of the model empty the buffer, which is full in between.
+        run_epoch(policy, 200, lambda i: 8 if i // 20 % 2 else 1)
+        self.assertGreater(policy.stats()['starved'], 0)
+        self.assertEqual(policy.next_depth(), 8)
+
+    def test_drain(self):
+        # Elements taken while the buffer is filled or drained at the ends of the epoch are not measured.
+        policy = PrefetchPolicy(800, 100)
+        run_epoch(policy, 20, lambda i: 8)
+        self.assertEqual(policy.stats()['starved'], 0)
+
+    def test_sampled(self):
+        policy = PrefetchPolicy(6400, 100)
+        self.assertEqual(policy.sample_every, 8)
+        run_epoch(policy, 2000, lambda i: 64)
+        self.assertEqual(policy.stats()['consumed'], 1993)
+        self.assertEqual(policy.stats()['starved'], 0)
+        depth = policy.next_depth()
+        self.assertTrue(32 <= depth < 64)
+        run_epoch(policy, 2000, lambda i: depth if i // 200 % 2 else 1)
+        self.assertEqual(policy.next_depth(), 64)
+
+    def test_disabled(self):
+        policy = PrefetchPolicy(800, 100, sample_every=0)
+        self.assertEqual(policy.next_depth(), 8)
+        self.assertEqual(policy.stats()['consumed'], 0)
+
+
+class NativeGraphTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.subt = [np.random.RandomState(i).randn(i + 1, embedding_size).astype(np.float32) for i in range(5)]
+        self.files = [join(self.dir, '%d.npy' % i) for i in range(5)]
+        for f, s in zip(self.files, self.subt):
+            np.save(f, s)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def read(self, sample_every):
+        """Read the files natively through a prefetch buffer, as Input does with native=True."""
+        with tf.Graph().as_default() as graph:
+            feed_dict = {}
+            source, dtype = native_source(self.files, feed_dict)
+            dataset = tf.data.Dataset.from_tensor_slices(source)
+            dataset = dataset.map(partial(native_load, comp='subt', mode='subt', dtype=dtype))
+            policy = PrefetchPolicy(1 << 20, embedding_size * 4 * 5, sample_every=sample_every)
+            size = tf.placeholder(dtype=tf.int64, shape=[])
+            iterator = policy.prefetch(dataset, size).make_initializable_iterator()
+            next_element = policy.mark_consumed(iterator.get_next())
+            with tf.Session(graph=graph) as sess:
+                feed_dict[size] = policy.next_depth()
+                sess.run(iterator.initializer, feed_dict=feed_dict)
+                for s in self.subt:
+                    np.testing.assert_array_equal(sess.run(next_element), s)
+            return py_func_ops(graph), policy
+
+    def test_native(self):
+        ops, policy = self.read(0)
+        self.assertEqual(ops, [])
+
+    def test_counted(self):
+        ops, policy = self.read(1)
+        self.assertEqual(len(ops), 2)
+        self.assertEqual(policy.stats()['consumed'], 5)
+
+
+class WindowTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.paths = {k: getattr(ri._mp, k) for k in ['encode_dir', 'store_dir']}
+        self.qa_paths = {k: getattr(qs._mp, k) for k in ['store_dir', 'qa_store_file', 'qa_spec_interval_file',
+                                                          'qa_spec_offset_file', 'qa_spec_length_file',
+                                                          'qa_store_index']}
+        ri._mp.encode_dir = ri._mp.store_dir = qs._mp.store_dir = self.dir
+        for k in self.qa_paths:
+            if k != 'store_dir':
+                setattr(qs._mp, k, join(self.dir, k + '.npy'))
+        qs._mp.qa_store_index = join(self.dir, 'qa_index.json')
+        length = 20
+        spectra = {'tt0000001:0': [0] * 3 + [1] * 2 + [0] * 6 + [1] + [0] * 8,
+                   # Clipped at 0 and at length
+                   'tt0000001:1': [1] + [0] * 18 + [1],
+                   # No spec, so the whole context
+                   'tt0000001:2': [0] * length}
+        self.qa = [{'qid': q, 'imdb_key': 'tt0000001'} for q in spectra]
+        self.spectra = [np.array(s, dtype=np.int32) for s in spectra.values()]
+        for q, s in zip(spectra, self.spectra):
+            np.save(join(self.dir, q + '_spec.npy'), s)
+        qs.save_qa_store(list(spectra), np.zeros((len(spectra), 6, 4), dtype=np.float32),
+                         [qs.spec_intervals(s) for s in self.spectra], [length] * len(spectra))
+        self.subt = np.random.RandomState(5).randn(length, embedding_size).astype(np.float32)
+        np.save(join(self.dir, 'tt0000001.npy'), self.subt)
+        self.lengths = [length] * len(self.qa)
+        self.expected = [(1, 14), (0, 20), (0, 20)]
+
+    def tearDown(self):
+        for k, v in self.paths.items():
+            setattr(ri._mp, k, v)
+        for k, v in self.qa_paths.items():
+            setattr(qs._mp, k, v)
+        shutil.rmtree(self.dir)
+
+    def test_spec_windows(self):
+        self.assertEqual(ri.spec_windows(self.qa, self.lengths, 2), self.expected)
+        self.assertEqual(ri.spec_windows(self.qa, self.lengths, 2, qs.QAStore()), self.expected)
+        self.assertEqual(ri.spec_windows(self.qa, self.lengths, 0)[0], (3, 12))
+
+    def test_window_load(self):
+        store = qs.QAStore()
+        subt_file = join(self.dir, 'tt0000001.npy').encode()
+        for qa, spectrum, (start, end) in zip(self.qa, self.spectra, self.expected):
+            spec_file = join(self.dir, qa['qid'] + '_spec.npy').encode()
+            for spec in [ri.spec_window_load(spec_file, start, end),
+                         ri.spec_window_load(qa['qid'].encode(), start, end, store),
+                         ri.spec_window_load(spec_file, start, end, cache=LRUCache(1 << 20))]:
+                np.testing.assert_array_equal(spec, spectrum[start:end])
+                self.assertEqual(spec.dtype, np.int32)
+            np.testing.assert_array_equal(ri.subt_window_load(subt_file, start, end, 'subt'), self.subt[start:end])
+            self.assertEqual(ri.subt_window_load(subt_file, start, end, 'feat').shape, (1, embedding_size))
+
+    def test_feature_store(self):
+        fs.build_feature_store([join(self.dir, 'tt0000001.npy')], ['tt0000001'], join(self.dir, 'subt.npy'),
+                               join(self.dir, 'subt.json'))
+        store = fs.FeatureStore(join(self.dir, 'subt.npy'), join(self.dir, 'subt.json'))
+        np.testing.assert_array_equal(ri.subt_window_load(b'tt0000001', 1, 14, 'subt', store), self.subt[1:14])
+
+    def test_graph(self):
+        with tf.Graph().as_default():
+            start, end = tf.constant(1, dtype=tf.int64), tf.constant(14, dtype=tf.int64)
+            spec = ri.window_load(tf.constant(join(self.dir, 'tt0000001:0_spec.npy')), start, end, 'spec', 'subt')
+            subt = ri.window_load(tf.constant(join(self.dir, 'tt0000001.npy')), start, end, 'subt', 'subt')
+            with tf.Session() as sess:
+                spec, subt = sess.run([spec, subt])
+        np.testing.assert_array_equal(spec, self.spectra[0][1:14])
+        np.testing.assert_array_equal(subt, self.subt[1:14])
+
+
+class BucketTestCase(unittest.TestCase):
+    def setUp(self):
+        rng = random.Random(0)
+        self.lengths = [rng.randint(1, 1000) for _ in range(4 * bucket_pool * 2 + 7)]
+
+    def test_sorted(self):
+        index = bucket(range(len(self.lengths)), self.lengths, 4, shuffle=False)
+        self.assertEqual(sorted(index), list(range(len(self.lengths))))
+        # Each pool of bucket_pool batches is sorted by length.
+        for i in range(0, len(index), 4 * bucket_pool):
+            pool = [self.lengths[j] for j in index[i:i + 4 * bucket_pool]]
+            self.assertEqual(pool, sorted(pool))
+
+    def test_shuffle(self):
+        random.seed(0)
+        index = bucket(range(len(self.lengths)), self.lengths, 4)
+        self.assertEqual(sorted(index), list(range(len(self.lengths))))
+        batches = [index[i:i + 4] for i in range(0, len(index), 4)]
+        # The incomplete batch is last.
+        self.assertEqual([len(b) for b in batches], [4] * (len(batches) - 1) + [3])
+        # A batch holds questions next to each other in the sorted order of its pool.
+        spread = [max(self.lengths[j] for j in b) - min(self.lengths[j] for j in b) for b in batches]
+        self.assertLess(np.mean(spread), 100)
+
+    def test_short(self):
+        self.assertEqual(bucket([2, 0, 1], [5, 3, 4], 4, shuffle=False), [1, 2, 0])
+        self.assertEqual(bucket([], [], 4), [])
+
+
+def random_question(rng, length):
+    qa = rng.randn(1, embedding_size).astype(np.float32), rng.randn(5, embedding_size).astype(np.float32)
+    subt = rng.randn(length, embedding_size).astype(np.float32)
+    feat = rng.randn(length, 6, 2048).astype(np.float32)
+    spec = (rng.uniform(size=length) < 0.3).astype(np.int32)
+    spec[rng.randint(length)] = 1
+    return qa, subt, feat, np.int64(rng.randint(5)), spec
+
+
+def run_model(model_class, data, checkpoint, save=False):
+    """Belief and output of a model on constant data, with the variables saved to or restored from checkpoint."""
+    with tf.Graph().as_default():
+        model = model_class(SimpleNamespace(**{k: tf.constant(v) for k, v in data.items()}))
+        saver = tf.train.Saver()
+        with tf.Session() as sess:
+            if save:
+                sess.run(tf.global_variables_initializer())
+                saver.save(sess, checkpoint)
+            else:
+                saver.restore(sess, checkpoint)
+            return sess.run([model.belief, model.output])
+
+
+class BatchTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.checkpoint = join(self.dir, 'model')
+        rng = np.random.RandomState(3)
+        self.questions = [random_question(rng, length) for length in [9, 4, 12]]
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def batch(self, questions):
+        """Pad questions into a batch through add_length and padded_batch, as Input does."""
+        with tf.Graph().as_default():
+            elements = [tf.data.Dataset.from_tensors(q) for q in questions]
+            dataset = elements[0]
+            for e in elements[1:]:
+                dataset = dataset.concatenate(e)
+            dataset = dataset.map(add_length)
+            dataset = dataset.padded_batch(len(questions), padded_shapes=dataset.output_shapes)
+            (ques, ans), subt, feat, gt, spec, length = dataset.make_one_shot_iterator().get_next()
+            mask = tf.sequence_mask(length, tf.shape(spec)[1], dtype=tf.float32)
+            with tf.Session() as sess:
+                values = sess.run([ques, ans, subt, feat, gt, spec, length, mask])
+        return dict(zip(['ques', 'ans', 'subt', 'feat', 'gt', 'spec', 'length', 'mask'], values))
+
+    def test_padded_batch(self):
+        batch = self.batch(self.questions)
+        np.testing.assert_array_equal(batch['length'], [9, 4, 12])
+        np.testing.assert_array_equal(batch['mask'], [[1] * n + [0] * (12 - n) for n in [9, 4, 12]])
+        for i, ((q, a), subt, feat, gt, spec) in enumerate(self.questions):
+            n = len(spec)
+            np.testing.assert_array_equal(batch['ques'][i], q)
+            np.testing.assert_array_equal(batch['ans'][i], a)
+            np.testing.assert_array_equal(batch['subt'][i, :n], subt)
+            np.testing.assert_array_equal(batch['feat'][i, :n], feat)
+            np.testing.assert_array_equal(batch['spec'][i, :n], spec)
+            self.assertEqual(batch['gt'][i], gt)
+            # Padded rows are zero and have no spec.
+            self.assertFalse(batch['subt'][i, n:].any())
+            self.assertFalse(batch['spec'][i, n:].any())
+
+    def check(self, questions):
+        batch = self.batch(questions)
+        del batch['length'], batch['gt']
+        belief, output = run_model(full.BatchModel, batch, self.checkpoint)
+        for i, ((q, a), subt, feat, _, spec) in enumerate(questions):
+            expected = run_model(full.Model, {'ques': q, 'ans': a, 'subt': subt, 'feat': feat, 'spec': spec},
+                                 self.checkpoint)
+            np.testing.assert_allclose(belief[i, :len(spec)], expected[0], rtol=1e-4, atol=1e-5)
+            np.testing.assert_allclose(output[i], expected[1][0], rtol=1e-4, atol=1e-5)
+            self.assertFalse(belief[i, len(spec):].any())
+
+    def test_same_as_model(self):
+        (q, a), subt, feat, _, spec = self.questions[0]
+        run_model(full.Model, {'ques': q, 'ans': a, 'subt': subt, 'feat': feat, 'spec': spec}, self.checkpoint,
+                  save=True)
+        self.check(self.questions[:1])
+        self.check(self.questions)
+
+
+class MovieTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.checkpoint = join(self.dir, 'model')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_same_as_model(self):
+        # Questions of a movie share its subtitle and feature, with a spec each.
+        rng = np.random.RandomState(4)
+        _, subt, feat, _, _ = random_question(rng, 10)
+        questions = [random_question(rng, 10)[0] + (random_question(rng, 10)[4],) for _ in range(4)]
+        questions[1][2][:] = 0
+        questions[1][2][3:9] = 1
+        models = []
+        for q, a, spec in questions:
+            data = {'ques': q, 'ans': a, 'subt': subt, 'feat': feat, 'spec': spec}
+            models.append(run_model(full.Model, data, self.checkpoint, save=not models))
+        data = {'ques': np.stack([q for q, _, _ in questions]), 'ans': np.stack([a for _, a, _ in questions]),
+                'subt': subt, 'feat': feat, 'spec': np.stack([s for _, _, s in questions])}
+        belief, output = run_model(full.MovieModel, data, self.checkpoint)
+        for i, (expected_belief, expected_output) in enumerate(models):
+            np.testing.assert_allclose(belief[i], expected_belief, rtol=1e-4, atol=1e-5)
+            np.testing.assert_allclose(output[i], expected_output[0], rtol=1e-4, atol=1e-5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,134 @@
+import unittest
+
+import numpy as np
+
+import process.text_v3 as tv
+from data.data_loader import duration
+
+
+def scalar_lsbs(a, t):
+    # lsbs before vectorization
+    lower = 0
+    upper = len(a) - 1
+    pivot = int((lower + upper) / 2)
+    while lower < upper:
+        if a[pivot] > t:
+            upper = pivot - 1
+        else:
+            lower = pivot + 1
+        pivot = int((lower + upper) / 2)
+    for i in range(max(pivot - 1, 0), min(pivot + 2, len(a) - 1)):
+        if a[i] <= t < a[i + 1]:
+            return i
+    return pivot
+
+
+def scalar_flbs(a, t):
+    # flbs before vectorization
+    lower = 0
+    upper = len(a) - 1
+    pivot = int((lower + upper) / 2)
+    while lower < upper:
+        if a[pivot] > t:
+            upper = pivot - 1
+        else:
+            lower = pivot + 1
+        pivot = int((lower + upper) / 2)
+    for i in range(max(pivot - 1, 0), min(pivot + 2, len(a) - 1)):
+        if a[i - 1] < t <= a[i]:
+            return i
+    return pivot
+
+
+def loop_align(vd, ft, subt, one=False):
+    # sample_frame and sample_frame_v2 before vectorization
+    temp_sample, temp_index = {}, []
+    for video in sorted(list(vd.keys())):
+        if vd[video]['real_frames'] > 0:
+            start_frame, end_frame = duration(video)
+            start_frame = max(start_frame, 0)
+            end_frame = min(start_frame + vd[video]['real_frames'] - 1, len(ft) - 1)
+            start_time, end_time = ft[start_frame], ft[end_frame]
+            start_index, end_index = scalar_flbs(subt['end'], start_time), scalar_lsbs(subt['start'], end_time)
+            if start_index > end_index:
+                end_index = start_index
+            temp_sample[video] = []
+            for i in range(start_index, end_index + 1):
+                i_start, i_end = subt['start'][i], subt['end'][i]
+                i_start_frame = min(max(scalar_flbs(ft, i_start) - start_frame, 0), vd[video]['real_frames'] - 1)
+                i_end_frame = max(min(scalar_lsbs(ft, i_end) - start_frame, vd[video]['real_frames'] - 1), 0)
+                if one:
+                    temp_sample[video].append((i_start_frame + i_end_frame) // 2)
+                    temp_index.append(i)
+                else:
+                    sample_list = list(range(i_start_frame, i_end_frame, 6))
+                    temp_sample[video].extend(sample_list)
+                    temp_index.extend([i] * len(sample_list))
+    return temp_sample, temp_index
+
+
+def random_movie(rng):
+    num_frame = rng.randint(50, 400)
+    ft = np.cumsum(rng.uniform(0.01, 0.1, num_frame))
+    num_line = rng.randint(1, 30)
+    start = np.sort(rng.uniform(-1, ft[-1] + 1, num_line))
+    subt = {'start': start, 'end': start + rng.uniform(0, 3, num_line)}
+    vd, frame = {}, 0
+    while frame < num_frame:
+        length = rng.randint(0, 60)
+        vd['tt0000001.sf-%06d.ef-%06d.video' % (frame, frame + length)] = {'real_frames': length}
+        frame += length + rng.randint(0, 20)
+    return vd, ft, subt
+
+
+class SearchTestCase(unittest.TestCase):
+    def test_search(self):
+        rng = np.random.RandomState(0)
+        for _ in range(200):
+            # Duplicates and targets out of range included
+            a = np.sort(rng.randint(0, 50, rng.randint(1, 30))).astype(np.float64)
+            t = rng.uniform(-5, 55, 20)
+            np.testing.assert_array_equal(tv.lsbs(a, t), [scalar_lsbs(a, x) for x in t])
+            np.testing.assert_array_equal(tv.flbs(a, t), [scalar_flbs(a, x) for x in t])
+
+
+class AlignTestCase(unittest.TestCase):
+    def check(self, one):
+        rng = np.random.RandomState(1)
+        for _ in range(100):
+            vd, ft, subt = random_movie(rng)
+            sample, index = tv.align_movie(vd, ft, subt, one=one)
+            expected_sample, expected_index = loop_align(vd, ft, subt, one=one)
+            self.assertEqual(sample, expected_sample)
+            self.assertEqual(list(index), expected_index)
+
+    def test_every_6_frames(self):
+        self.check(False)
+
+    def test_one_frame(self):
+        self.check(True)
+
+
+class SifTestCase(unittest.TestCase):
+    def test_sif_embedding(self):
+        rng = np.random.RandomState(2)
+        vocab_embed = rng.randn(50, 8).astype(np.float32)
+        weight = rng.uniform(0, 1, 50)
+        filter_vocab = {'w%d' % i: i for i in range(50)}
+        # Words out of vocabulary are dropped, and the second sentence is empty.
+        sentences = [['w%d' % rng.randint(60) for _ in range(rng.randint(0, 12))] for _ in range(40)]
+        sentences[1] = ['oov']
+        ids, offsets = tv.sentence_csr(sentences, filter_vocab)
+        for chunk_tokens in [1, 7, 1 << 18]:
+            embedding = tv.sif_embedding(ids, offsets, vocab_embed, weight, chunk_tokens)
+            for sent, row in zip(sentences, embedding):
+                sent_ids = [filter_vocab[w] for w in sent if w in filter_vocab]
+                if sent_ids:
+                    expected = np.mean(vocab_embed[sent_ids] * weight[sent_ids][:, None], axis=0)
+                    np.testing.assert_allclose(row, expected)
+                else:
+                    self.assertTrue(np.isnan(row).all())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,87 @@
+import shutil
+import tempfile
+import unittest
+from os.path import join
+
+import numpy as np
+import tensorflow as tf
+
+from embed.tfrecord import MailPerson, Package, create_one_tfrecord
+from utils import data_utils as du
+
+
+def baseline(arrays, features, feature_list, index):
+    # Examples built by du.to_feature, as before the reused proto. Map entries are sorted in both.
+    context = tf.train.Features(feature={k: du.to_feature(arrays[k][index]) for k in features})
+    if feature_list:
+        example = tf.train.SequenceExample(
+            context=context,
+            feature_lists=tf.train.FeatureLists(
+                feature_list={k: du.to_feature(arrays[k][index]) for k in feature_list}))
+    else:
+        example = tf.train.Example(features=context)
+    return example.SerializeToString(deterministic=True)
+
+
+class PackageTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        rng = np.random.RandomState(0)
+        num = 10
+        words = np.array([b'', b'a', b'bc', b'\xc3\xa9', b'd e'])
+        self.arrays = {
+            'int_1': rng.randint(-100, 100, num).astype(np.int64),
+            'int_2': rng.randint(0, 1 << 40, (num, 3)),
+            'int_3': rng.randint(0, 10, (num, 4, 2)).astype(np.int32),
+            'float_1': rng.randn(num).astype(np.float32),
+            'float_2': rng.randn(num, 5),
+            'float_3': rng.randn(num, 2, 3).astype(np.float32),
+            'str_1': words[rng.randint(0, len(words), num)],
+            'str_2': words[rng.randint(0, len(words), (num, 2))],
+            'str_3': words[rng.randint(0, len(words), (num, 3, 2))],
+        }
+        self.files = {}
+        for k, v in self.arrays.items():
+            self.files[k] = join(self.dir, k + '.npy')
+            np.save(self.files[k], v)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def split(self, sequence):
+        features = {k: self.files[k] for k in self.files if not k.endswith('_3')}
+        feature_list = {k: self.files[k] for k in self.files if k.endswith('_3')} if sequence else {}
+        return features, feature_list
+
+    def check(self, sequence, num_shards, chunk_size):
+        features, feature_list = self.split(sequence)
+        expected = [baseline(self.arrays, features, feature_list, i) for i in range(len(self.arrays['int_1']))]
+        records = []
+        for pack in MailPerson(join(self.dir, 'r_%d_%d'), num_shards, len(expected), features, feature_list):
+            pack.chunk_size = chunk_size
+            examples = list(pack)
+            self.assertEqual(len(examples), len(pack))
+            records.extend(examples)
+        self.assertEqual(records, expected)
+
+    def test_example(self):
+        self.check(False, 1, 1024)
+        # Shards of 4, 4 and 2 examples read 3 rows at a time, the last chunk of each is short.
+        self.check(False, 3, 3)
+
+    def test_sequence_example(self):
+        self.check(True, 1, 1024)
+        self.check(True, 3, 3)
+        self.check(True, 2, 1)
+
+    def test_record(self):
+        features, feature_list = self.split(True)
+        pack = Package(join(self.dir, 'r.tfrecord'), 7, 10, features, feature_list, chunk_size=2)
+        record_name, length, _ = create_one_tfrecord(pack)
+        self.assertEqual(length, 3)
+        self.assertEqual(list(tf.python_io.tf_record_iterator(record_name)),
+                         [baseline(self.arrays, features, feature_list, i) for i in range(7, 10)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,189 @@
+import random
+import unittest
+
+import numpy as np
+import tensorflow as tf
+
+import data.transform as tr
+
+KEY = 'tt0000001'
+
+
+def random_movie(rng, num_clips=8, num_qa=12):
+    clips = ['%s.sf-%06d.ef-%06d.video' % (KEY, i * 100, i * 100 + 99) for i in range(num_clips)]
+    video_data = {KEY: {v: {'real_frames': rng.randint(1, 6)} for v in clips}}
+    encode_subt = {KEY: {v: [[rng.randint(1, 50) for _ in range(rng.randint(1, 6))]
+                             for _ in range(rng.randint(0, 3))] for v in clips}}
+    qa = []
+    for i in range(num_qa):
+        start = rng.randint(0, num_clips - 1)
+        # Plot-only questions have no clip.
+        video_clips = clips[start:start + rng.randint(1, 3)] if i % 4 else []
+        qa.append({'qid': '%s:%d' % (KEY, i), 'video_clips': video_clips, 'correct_index': rng.randint(0, 4),
+                   'question': [rng.randint(1, 50) for _ in range(rng.randint(1, 8))],
+                   'answers': [[rng.randint(1, 50) for _ in range(rng.randint(0, 6))] for _ in range(5)]})
+    num_frame = sum(d['real_frames'] for d in video_data[KEY].values())
+    feat = np.random.RandomState(rng.randint(0, 100)).randn(num_frame, 4 * 4 * 1536).astype(np.float32)
+    return qa, encode_subt, video_data, feat
+
+
+def movie_args(mode='subt+feat'):
+    args = tr.Args()
+    args.q_max, args.a_max, args.subt_max = 8, 6, 6
+    args.split, args.mode = 'train', mode
+    return args
+
+
+def int_list(values):
+    return tf.train.FeatureList(feature=[tf.train.Feature(int64_list=tf.train.Int64List(value=[int(x) for x in v]))
+                                         for v in values])
+
+
+def baseline_record(qa, encode_subt, args, video_data, key, feat):
+    """
+    create_one_tfrecord before preallocation, with len() of the integer real_frames and the length of
+    each answer in al fixed.
+    """
+    video_list = sorted(list(video_data[key].keys()))
+    num_frame = sum([video_data[key][v]['real_frames'] for v in video_list])
+    spectrum = np.zeros((len(qa), num_frame), dtype=np.int64)
+    ques = np.zeros((len(qa), args.q_max), dtype=np.int64)
+    ans = np.zeros((len(qa), 5, args.a_max), dtype=np.int64)
+    ql = np.zeros(len(qa), dtype=np.int64)
+    al = np.zeros((len(qa), 5), dtype=np.int64)
+    gt = []
+    for idx, ins in enumerate(qa):
+        ques[idx][:len(ins['question'])] = ins['question']
+        ql[idx] = len(ins['question'])
+        for i in range(5):
+            ans[idx][i][:len(ins['answers'][i])] = ins['answers'][i]
+            al[idx][i] = len(ins['answers'][i])
+        index = 0
+        for v in video_list:
+            if v in ins['video_clips']:
+                spectrum[idx][index:index + video_data[key][v]['real_frames']] = 1
+            index += video_data[key][v]['real_frames']
+        gt.append(ins['correct_index'])
+    sequence_dict = {'ques': int_list(ques), 'ans': int_list(np.reshape(ans, [len(qa), 5 * args.a_max])),
+                     'al': int_list(al), 'spec': int_list(spectrum), 'ql': int_list(ql[:, None]),
+                     'gt': int_list([[g] for g in gt])}
+    subt = np.zeros((0, args.subt_max), dtype=np.int64)
+    sl = []
+    for v in sorted(list(encode_subt[key].keys())):
+        if encode_subt[key][v]:
+            rows = np.zeros((len(encode_subt[key][v]), args.subt_max), dtype=np.int64)
+            for i, sent in enumerate(encode_subt[key][v]):
+                rows[i][:len(sent)] = sent
+            subt = np.concatenate([subt, rows])
+            sl += [len(sent) for sent in encode_subt[key][v]]
+    sequence_dict['subt'] = int_list(subt)
+    sequence_dict['sl'] = int_list([[n] for n in sl])
+    sequence_dict['feat'] = tf.train.FeatureList(
+        feature=[tf.train.Feature(float_list=tf.train.FloatList(value=row)) for row in feat])
+    context = tf.train.Features(feature={'N': tf.train.Feature(int64_list=tf.train.Int64List(value=[num_frame])),
+                                         'N_q': tf.train.Feature(int64_list=tf.train.Int64List(value=[len(qa)]))})
+    return tf.train.SequenceExample(context=context, feature_lists=tf.train.FeatureLists(feature_list=sequence_dict))
+
+
+def parse(record):
+    example = tf.train.SequenceExample.FromString(record)
+    values = {}
+    for k, feature_list in example.feature_lists.feature_list.items():
+        values[k] = np.array([list(f.int64_list.value) or list(f.float_list.value) for f in feature_list.feature])
+    values['N'] = example.context.feature['N'].int64_list.value[0]
+    return example, values
+
+
+class PadTestCase(unittest.TestCase):
+    def test_pad(self):
+        sents = [[1, 2, 3], [], [4], [5, 6, 7, 8]]
+        arr, lengths = tr.pad_sentences(sents, 5)
+        np.testing.assert_array_equal(arr, [[1, 2, 3, 0, 0], [0] * 5, [4, 0, 0, 0, 0], [5, 6, 7, 8, 0]])
+        np.testing.assert_array_equal(lengths, [3, 0, 1, 4])
+        self.assertEqual(arr.dtype, np.int64)
+
+    def test_empty(self):
+        arr, lengths = tr.pad_sentences([], 5)
+        self.assertEqual(arr.shape, (0, 5))
+        self.assertEqual(lengths.shape, (0,))
+
+
+class ShardTestCase(unittest.TestCase):
+    def setUp(self):
+        self.qa, _, self.video_data, _ = random_movie(random.Random(0))
+        self.frames = {v: d['real_frames'] for v, d in self.video_data[KEY].items()}
+
+    def test_whole(self):
+        self.assertEqual(tr.shard_qa(self.qa, self.video_data, KEY, 0), [(self.qa, sorted(self.frames))])
+
+    def test_max_frames(self):
+        shards = tr.shard_qa(self.qa, self.video_data, KEY, 8)
+        self.assertGreater(len(shards), 1)
+        self.assertEqual([ins for group, _ in shards for ins in group], self.qa)
+        for group, clips in shards:
+            self.assertTrue(clips)
+            self.assertTrue(all(set(ins['video_clips']) <= set(clips) for ins in group))
+            if len([ins for ins in group if ins['video_clips']]) > 1:
+                self.assertLessEqual(sum(self.frames[v] for v in clips), 8)
+
+    def test_no_clips(self):
+        # Plot-only questions join a shard with clips, or keep the whole movie if no question has clips.
+        plot = [ins for ins in self.qa if not ins['video_clips']]
+        self.assertEqual(tr.shard_qa(plot, self.video_data, KEY, 8), [(plot, sorted(self.frames))])
+        shards = tr.shard_qa(plot[:1] + self.qa[1:2] + plot[1:], self.video_data, KEY, 8)
+        self.assertEqual(shards, [(plot[:1] + self.qa[1:2] + plot[1:], sorted(self.qa[1]['video_clips']))])
+
+
+class SerializeTestCase(unittest.TestCase):
+    def setUp(self):
+        self.qa, self.encode_subt, self.video_data, self.feat = random_movie(random.Random(1))
+        self.args = movie_args()
+        self.video_list = sorted(self.video_data[KEY])
+
+    def test_baseline(self):
+        record = tr.serialize_movie(self.qa, self.encode_subt, self.args, self.video_data, KEY, self.video_list,
+                                    self.feat)
+        expected = baseline_record(self.qa, self.encode_subt, self.args, self.video_data, KEY, self.feat)
+        self.assertEqual(tf.train.SequenceExample.FromString(record), expected)
+
+    def test_shards(self):
+        _, whole = parse(tr.serialize_movie(self.qa, self.encode_subt, self.args, self.video_data, KEY,
+                                            self.video_list, self.feat))
+        frames = [self.video_data[KEY][v]['real_frames'] for v in self.video_list]
+        offset = dict(zip(self.video_list, np.cumsum(frames) - frames))
+        subt_videos = [v for v in self.video_list if self.encode_subt[KEY][v]]
+        subt_rows = np.cumsum([0] + [len(self.encode_subt[KEY][v]) for v in subt_videos])
+        row = {ins['qid']: i for i, ins in enumerate(self.qa)}
+        shards = tr.shard_qa(self.qa, self.video_data, KEY, 8)
+        self.assertGreater(len(shards), 1)
+        for group, clips in shards:
+            _, shard = parse(tr.serialize_movie(group, self.encode_subt, self.args, self.video_data, KEY, clips,
+                                                self.feat))
+            positions = np.concatenate([np.arange(offset[v], offset[v] + self.video_data[KEY][v]['real_frames'])
+                                        for v in clips])
+            self.assertEqual(shard['N'], len(positions))
+            np.testing.assert_array_equal(shard['feat'], whole['feat'][positions])
+            rows = np.concatenate([np.arange(subt_rows[i], subt_rows[i + 1])
+                                   for i, v in enumerate(subt_videos) if v in clips] + [np.zeros(0, int)])
+            np.testing.assert_array_equal(shard['subt'].reshape(-1, self.args.subt_max),
+                                          whole['subt'].reshape(-1, self.args.subt_max)[rows])
+            for i, ins in enumerate(group):
+                j = row[ins['qid']]
+                # All spec of a question is in its shard.
+                np.testing.assert_array_equal(shard['spec'][i], whole['spec'][j][positions])
+                self.assertEqual(shard['spec'][i].sum(), whole['spec'][j].sum())
+                for k in ['ques', 'ans', 'al', 'ql', 'gt']:
+                    np.testing.assert_array_equal(shard[k][i], whole[k][j])
+
+    def test_plot_only_feat(self):
+        # A shard of plot-only questions keeps the whole movie instead of no frame.
+        plot = [ins for ins in self.qa if not ins['video_clips']]
+        (group, clips), = tr.shard_qa(plot, self.video_data, KEY, 8)
+        _, shard = parse(tr.serialize_movie(group, self.encode_subt, self.args, self.video_data, KEY, clips,
+                                            self.feat))
+        self.assertEqual(shard['N'], len(self.feat))
+        self.assertFalse(shard['spec'].any())
+
+
+if __name__ == '__main__':
+    unittest.main()
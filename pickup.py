@@ -6,6 +6,7 @@ import numpy as np
 import utils.data_utils as du
 import utils.func_utils as fu
 from config import MovieQAPath
+from data import frame_store as fs
 from data.data_loader import QA, Subtitle
 
 # from pprint import pprint
@@ -33,11 +34,17 @@ def main():
     sentences = [subtitle[ins['imdb_key']]['lines'][idx] for idx in iid]
     imgs = []
     for v in sorted([fu.basename_wo_ext(n) for n in ins['video_clips']]):
-        imgs.extend([os.path.join(_mp.image_dir, v, '%s_%05d.jpg' % (v, i + 1))
-                     for i in sample[ins['imdb_key']][v]])
+        imgs.extend([(v, i) for i in sample[ins['imdb_key']][v]])
     print(len(imgs))
-    for idx, img in enumerate(imgs):
-        copy(img, os.path.join(_mp.benchmark_dir, 'pickup', '%d_%s.jpg' % (idx, sentences[idx])))
+    # Read from the frame store of the movie if it is packed.
+    store = fs.open_store(ins['imdb_key']) if os.path.exists(fs.store_files(ins['imdb_key'])[1]) else None
+    for idx, (v, i) in enumerate(imgs):
+        dst = os.path.join(_mp.benchmark_dir, 'pickup', '%d_%s.jpg' % (idx, sentences[idx]))
+        if store:
+            with open(dst, 'wb') as f:
+                f.write(store.get_bytes(v, i))
+        else:
+            copy(os.path.join(_mp.image_dir, v, '%s_%05d.jpg' % (v, i + 1)), dst)
     # ins['lines'] = sentences
     du.json_dump(ins, os.path.join(_mp.benchmark_dir, 'pickup.json'))
 
@@ -2,7 +2,6 @@ import os
 from argparse import ArgumentParser
 from collections import Counter
 from functools import partial
-from multiprocessing import Manager, Pool
 
 import numpy as np
 import tensorflow as tf
@@ -14,197 +13,242 @@ from tqdm import tqdm
 import utils.data_utils as du
 import utils.func_utils as fu
 from config import MovieQAPath
+from data import codec as cd
+from data import columnar as col
+from data import qa_store as qs
 from data.data_loader import Subtitle, FrameTime, duration, QA
 from embed.args import EmbeddingPath
+from embed.ngram import NgramEncoder
 
 _mp = MovieQAPath()
 _ep = EmbeddingPath()
 
 
-def lsbs(a, t):
-    # Find last one smaller than t in a sorted array.
-    lower = 0
-    upper = len(a) - 1
-    pivot = int((lower + upper) / 2)
-    while lower < upper:
-        if a[pivot] > t:
-            upper = pivot - 1
-        else:
-            lower = pivot + 1
-        pivot = int((lower + upper) / 2)
-    for i in range(max(pivot - 1, 0), min(pivot + 2, len(a) - 1)):
-        if a[i] <= t < a[i + 1]:
-            return i
+def _quirk_search(a, t):
+    """
+    Run the binary search of lsbs and flbs for all targets at once. The pivot update is kept
+    exactly, including int() truncation toward zero, so the pivots equal the scalar version.
+    :param a: array searched
+    :param t: array of targets
+    :return: array of pivots
+    """
+    lower = np.zeros(t.shape, dtype=np.int64)
+    upper = np.full(t.shape, len(a) - 1, dtype=np.int64)
+    pivot = ((lower + upper) / 2).astype(np.int64)
+    active = lower < upper
+    while active.any():
+        greater = a[pivot[active]] > t[active]
+        upper[active] = np.where(greater, pivot[active] - 1, upper[active])
+        lower[active] = np.where(greater, lower[active], pivot[active] + 1)
+        pivot[active] = ((lower[active] + upper[active]) / 2).astype(np.int64)
+        active = lower < upper
     return pivot
 
 
-def flbs(a, t):
-    # Find first one larger than t in a sorted array.
-    lower = 0
-    upper = len(a) - 1
-    pivot = int((lower + upper) / 2)
-    while lower < upper:
-        if a[pivot] > t:
-            upper = pivot - 1
+def _quirk_fix(a, t, pivot, last):
+    """
+    Check the neighbours of pivots in the same order as lsbs and flbs, and keep pivots without match.
+    :param a: array searched
+    :param t: array of targets
+    :param pivot: array of pivots
+    :param last: boolean, a[i] <= t < a[i + 1] (lsbs) or a[i - 1] < t <= a[i] (flbs)
+    :return: array of indices
+    """
+    result, found = pivot.copy(), np.zeros(t.shape, dtype=bool)
+    for offset in (-1, 0, 1):
+        i = pivot + offset
+        valid = (i >= np.maximum(pivot - 1, 0)) & (i < np.minimum(pivot + 2, len(a) - 1)) & ~found
+        j = np.where(valid, i, 0)
+        if last:
+            match = (a[j] <= t) & (t < a[np.minimum(j + 1, len(a) - 1)])
         else:
-            lower = pivot + 1
-        pivot = int((lower + upper) / 2)
-    for i in range(max(pivot - 1, 0), min(pivot + 2, len(a) - 1)):
-        if a[i - 1] < t <= a[i]:
-            return i
-    return pivot
+            # a[i - 1] wraps to a[-1] when i is 0, same as the scalar version.
+            match = (a[j - 1] < t) & (t <= a[j])
+        match &= valid
+        result[match] = i[match]
+        found |= match
+    return result
 
 
-def sample_frame(video_data, frame_time, subtitle, sample, index, key):
+def lsbs(a, t):
+    # Find last one smaller than t in a sorted array. t can be a scalar or an array.
+    a, t = np.asarray(a), np.asarray(t)
+    if len(a) == 0:
+        return np.zeros(t.shape, dtype=np.int64)
+    return _quirk_fix(a, t, _quirk_search(a, t), True)
+
+
+def flbs(a, t):
+    # Find first one larger than t in a sorted array. t can be a scalar or an array.
+    a, t = np.asarray(a), np.asarray(t)
+    if len(a) == 0:
+        return np.zeros(t.shape, dtype=np.int64)
+    return _quirk_fix(a, t, _quirk_search(a, t), False)
+
+
+def align_movie(vd, ft, subt, one=False):
+    """
+    Align subtitle lines of a movie to frames of its video clips, for all clips and lines at once.
+    :param vd: video meta data of the movie
+    :param ft: frame time of the movie
+    :param subt: subtitle of the movie
+    :param one: boolean, sample only the middle frame of each line or every 6 frames.
+    :return temp_sample, temp_index: sampled frames of each video, and line index of each sampled frame
+    """
+    ft = np.asarray(ft)
+    sub_start, sub_end = np.asarray(subt['start']), np.asarray(subt['end'])
+    videos = [v for v in sorted(list(vd.keys())) if vd[v]['real_frames'] > 0]
+    if not videos:
+        return {}, np.zeros(0, dtype=np.int64)
+
+    real_frames = np.array([vd[v]['real_frames'] for v in videos], dtype=np.int64)
+    start_frame = np.maximum(np.array([duration(v)[0] for v in videos], dtype=np.int64), 0)
+    end_frame = np.minimum(start_frame + real_frames - 1, len(ft) - 1)
+    start_index = flbs(sub_end, ft[start_frame])
+    end_index = np.maximum(lsbs(sub_start, ft[end_frame]), start_index)
+
+    # Lines of all videos, and the video of each line.
+    num_lines = end_index - start_index + 1
+    line_video = np.repeat(np.arange(len(videos)), num_lines)
+    line = np.arange(num_lines.sum()) - np.repeat(np.cumsum(num_lines) - num_lines, num_lines) + \
+        np.repeat(start_index, num_lines)
+
+    line_start, line_rf = start_frame[line_video], real_frames[line_video]
+    i_start_frame = np.minimum(np.maximum(flbs(ft, sub_start[line]) - line_start, 0), line_rf - 1)
+    i_end_frame = np.maximum(np.minimum(lsbs(ft, sub_end[line]) - line_start, line_rf - 1), 0)
+
+    if one:
+        frame, frame_line, frame_video = (i_start_frame + i_end_frame) // 2, line, line_video
+    else:
+        # range(i_start_frame, i_end_frame, 6) of each line
+        num_frames = np.maximum((i_end_frame - i_start_frame + 5) // 6, 0)
+        first = np.repeat(np.cumsum(num_frames) - num_frames, num_frames)
+        frame = np.repeat(i_start_frame, num_frames) + 6 * (np.arange(num_frames.sum()) - first)
+        frame_line, frame_video = np.repeat(line, num_frames), np.repeat(line_video, num_frames)
+
+    bounds = np.searchsorted(frame_video, np.arange(len(videos) + 1))
+    temp_sample = {v: frame[bounds[i]:bounds[i + 1]].tolist() for i, v in enumerate(videos)}
+    return temp_sample, frame_line
+
+
+def sample_frame(video_data, frame_time, subtitle, key, codec=None):
     subt = subtitle[key]
-    ft = frame_time[key]
-    vd = video_data[key]
-    temp_sample = {}
-    temp_index = []
-    a = 0
-    b = 0
-    for video in sorted(list(vd.keys())):
-        if vd[video]['real_frames'] > 0:
-            start_frame, end_frame = duration(video)
-            start_frame = max(start_frame, 0)
-            end_frame = min(start_frame + vd[video]['real_frames'] - 1, len(ft) - 1)
-            start_time, end_time = ft[start_frame], ft[end_frame]
-
-            start_index, end_index = flbs(subt['end'], start_time), lsbs(subt['start'], end_time)
-
-            if start_index > end_index:
-                end_index = start_index
-            temp_sample[video] = []
-            index_sample = list(range(start_index, end_index + 1))
-            for i in index_sample:
-                i_start, i_end = subt['start'][i], subt['end'][i]
-                i_start_frame = min(max(flbs(ft, i_start) - start_frame, 0), vd[video]['real_frames'] - 1)
-                i_end_frame = max(min(lsbs(ft, i_end) - start_frame, vd[video]['real_frames'] - 1), 0)
-                sample_list = list(range(i_start_frame, i_end_frame, 6))
-                temp_sample[video].extend(sample_list)
-                temp_index.extend([i] * len(sample_list))
-                a += len(sample_list)
-                b += len(subt['lines'][[i] * len(sample_list)])
-            assert a == b, '%s not aligned. %d %d %d %d %d %d' % \
-                           (key, a, b, end_index + 1 - start_index, len(subt['lines'][index_sample]),
-                            start_index, end_index)
-
-    sample[key] = temp_sample
-    index[key] = temp_index
-    np.save(os.path.join(_mp.encode_dir, key + '.npy'), subt['lines'][temp_index])
-
-
-def sample_frame_v2(video_data, frame_time, subtitle, sample, index, key):
+    temp_sample, temp_index = align_movie(video_data[key], frame_time[key], subt)
+    cd.save(os.path.join(_mp.encode_dir, key + '.npy'), subt['lines'][temp_index], codec)
+    return key, temp_sample, temp_index.tolist()
+
+
+def sample_frame_v2(video_data, frame_time, subtitle, key, codec=None):
     subt = subtitle[key]
-    ft = frame_time[key]
-    vd = video_data[key]
-    temp_sample = {}
-    temp_index = []
-    a = 0
-    b = 0
-    for video in sorted(list(vd.keys())):
-        if vd[video]['real_frames'] > 0:
-            start_frame, end_frame = duration(video)
-            start_frame = max(start_frame, 0)
-            end_frame = min(start_frame + vd[video]['real_frames'] - 1, len(ft) - 1)
-            start_time, end_time = ft[start_frame], ft[end_frame]
-            start_index, end_index = flbs(subt['end'], start_time), lsbs(subt['start'], end_time)
-            # assert start_index <= end_index, '%s index reversed. %d %d\n%f %f %f %f\n%f %f' % \
-            #                                  (video, start_index, end_index, subt['start'][start_index],
-            #                                   subt['end'][start_index],
-            #                                   subt['start'][end_index], subt['end'][end_index],
-            #                                   start_time, end_time)
-            if start_index > end_index:
-                end_index = start_index
-            temp_sample[video] = []
-
-            index_sample = list(range(start_index, end_index + 1))
-            for i in index_sample:
-                i_start, i_end = subt['start'][i], subt['end'][i]
-                i_start_frame = min(max(flbs(ft, i_start) - start_frame, 0), vd[video]['real_frames'] - 1)
-                i_end_frame = max(min(lsbs(ft, i_end) - start_frame, vd[video]['real_frames'] - 1), 0)
-                temp_sample[video].append((i_start_frame + i_end_frame) // 2)
-                a += 1
-            b += len(subt['lines'][index_sample])
-            assert a == b, '%s not aligned. %d %d %d %d %d %d' % \
-                           (key, a, b, end_index + 1 - start_index, len(subt['lines'][index_sample]),
-                            start_index, end_index)
-            temp_index += index_sample
-
-    sample[key] = temp_sample
-    index[key] = temp_index
-    np.save(os.path.join(_mp.encode_dir, key + '.npy'), subt['lines'][temp_index])
+    temp_sample, temp_index = align_movie(video_data[key], frame_time[key], subt, one=True)
+    cd.save(os.path.join(_mp.encode_dir, key + '.npy'), subt['lines'][temp_index], codec)
+    return key, temp_sample, temp_index.tolist()
 
 
-def subtitle_process(video_data, frame_time, subtitle):
-    manager = Manager()
-    sample = manager.dict()
-    index = manager.dict()
-    video_data = manager.dict(video_data)
-    frame_time = manager.dict(frame_time)
-    subtitle = manager.dict(subtitle)
+# Read-only data of the worker processes, see fu.shared_pool.
+_shared = {}
 
-    keys = list(video_data.keys())
-    if args.one:
-        align_func = partial(sample_frame_v2, video_data, frame_time, subtitle, sample, index)
-    else:
-        align_func = partial(sample_frame, video_data, frame_time, subtitle, sample, index)
 
-    with Pool(4) as p, tqdm(total=len(keys), desc="Align subtitle") as pbar:
-        for _ in p.imap_unordered(align_func, keys):
+def align_worker(one, codec, key):
+    align_func = sample_frame_v2 if one else sample_frame
+    return align_func(_shared['video_data'], _shared['frame_time'], _shared['subtitle'], key, codec)
+
+
+def subtitle_process(video_data, frame_time, subtitle):
+    sample, index = {}, {}
+    keys = list(video_data.keys())
+    with fu.shared_pool(_shared, 4, video_data=video_data, frame_time=frame_time, subtitle=subtitle) as p, \
+            tqdm(total=len(keys), desc="Align subtitle") as pbar:
+        for key, temp_sample, temp_index in p.imap_unordered(partial(align_worker, args.one, args.codec), keys):
+            sample[key] = temp_sample
+            index[key] = temp_index
             pbar.update()
 
-    du.json_dump(sample.copy(), _mp.sample_frame_file)
-    du.json_dump(index.copy(), _mp.sample_index_file)
-    return sample.copy()
+    du.json_dump(sample, _mp.sample_frame_file)
+    du.json_dump(index, _mp.sample_index_file)
+    return sample
 
 
-def collect_embedding(qa, subtitle, video_data, filter_vocab, vocab_embed, frequency):
+def sentence_csr(sentences, filter_vocab):
+    """
+    Flatten tokenized sentences into word ids and offsets. Words out of vocabulary are dropped.
+    :param sentences: iterable of lists of words
+    :param filter_vocab: dictionary mapping word to row of embedding
+    :return ids, offsets: int64 arrays, words of sentence i are ids[offsets[i]:offsets[i + 1]]
+    """
+    ids, lengths = [], []
+    for sent in sentences:
+        sent_ids = [filter_vocab[w] for w in sent if w in filter_vocab]
+        ids.extend(sent_ids)
+        lengths.append(len(sent_ids))
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    return np.array(ids, dtype=np.int64), offsets
+
+
+def sif_embedding(ids, offsets, vocab_embed, weight, chunk_tokens=1 << 18):
+    """
+    Weighted mean of word embeddings of each sentence, computed with segment sums over chunks of
+    at most chunk_tokens words. An empty sentence is NaN, like the mean of an empty array.
+    :param ids: word ids of all sentences
+    :param offsets: offsets of sentences in ids
+    :param vocab_embed: word embedding
+    :param weight: float64 weight of each word
+    :param chunk_tokens: maximal number of words in a chunk
+    :return: float64 array of sentence embedding
+    """
+    num_sent = len(offsets) - 1
+    embedding = np.full((num_sent, vocab_embed.shape[1]), np.nan, dtype=np.float64)
+    start = 0
+    while start < num_sent:
+        end = max(start + 1, int(np.searchsorted(offsets, offsets[start] + chunk_tokens, 'right')) - 1)
+        end = min(end, num_sent)
+        chunk_ids = ids[offsets[start]:offsets[end]]
+        lengths = np.diff(offsets[start:end + 1])
+        nonempty = lengths > 0
+        if len(chunk_ids):
+            values = vocab_embed[chunk_ids].astype(np.float64) * weight[chunk_ids][:, None]
+            sums = np.add.reduceat(values, offsets[start:end][nonempty] - offsets[start], axis=0)
+            embedding[start:end][nonempty] = sums / lengths[nonempty][:, None]
+        start = end
+    return embedding
+
+
+def collect_embedding(qa, subtitle, video_data, filter_vocab, vocab_embed, frequency, codec=None):
     fu.make_dirs(_mp.encode_dir)
     total = sum(list(frequency.values()))
-    frequency = {k: v / total for k, v in frequency.items()}
-    all_embedding = []
+    weight = np.zeros(len(vocab_embed), dtype=np.float64)
+    for w, v in frequency.items():
+        weight[filter_vocab[w]] = 10 ** (-3) / (10 ** (-3) + v / total)
+
+    # Rows: lines of all subtitles, then question and 5 answers of each qa.
+    keys = list(video_data)
+    sentences = [line for key in keys for line in subtitle[key]['lines']]
+    num_line = len(sentences)
+    for ins in qa:
+        sentences.append(ins['question'])
+        sentences.extend(ins['answers'])
+    ids, offsets = sentence_csr(tqdm(sentences, desc='Collect Sentences'), filter_vocab)
+    all_embedding = sif_embedding(ids, offsets, vocab_embed, weight)
+    # Lines and answers were kept in float32, and questions in float64.
+    qa_rows = all_embedding[num_line:].reshape((len(qa), 6, -1))
+    all_embedding[:num_line] = all_embedding[:num_line].astype(np.float32)
+    qa_rows[:, 1:] = qa_rows[:, 1:].astype(np.float32)
 
-    for key in tqdm(video_data, desc='Create Sentence Embedding'):
-        subt = subtitle[key]
-        sent_embedding = np.zeros((len(subt['lines']), 300), dtype=np.float32)
-        for idx, line in enumerate(subt['lines']):
-            embed = vocab_embed[[filter_vocab[w] for w in line]]
-            w = 10 ** (-3) / (10 ** (-3) + np.expand_dims(np.array([frequency[w] for w in line]), axis=1))
-            sent = np.mean(embed * w, axis=0)
-            sent_embedding[idx] = sent
-        subt['lines'] = sent_embedding
-        all_embedding.append(sent_embedding)
-
-    for ins in tqdm(qa, desc='Create QA Embedding'):
-        embed = vocab_embed[[filter_vocab[w] for w in ins['question'] if w in filter_vocab]]
-        w = 10 ** (-3) / (10 ** (-3) + np.expand_dims(np.array([frequency[w] for w in ins['question']]), axis=1))
-        sent = np.mean(embed * w, axis=0, keepdims=True)
-        ins['question'] = sent
-        all_embedding.append(ins['question'])
-        ans_embedding = np.zeros((5, 300), dtype=np.float32)
-        for idx, candidate in enumerate(ins['answers']):
-            embed = vocab_embed[[filter_vocab[w] for w in candidate]]
-            w = 10 ** (-3) / (10 ** (-3) + np.expand_dims(np.array([frequency[w] for w in candidate]), axis=1))
-            sent = np.mean(embed * w, axis=0)
-            ans_embedding[idx] = sent
-        ins['answers'] = ans_embedding
-        all_embedding.append(ins['answers'])
-
-    all_embedding = np.concatenate(all_embedding, axis=0)
     svd = TruncatedSVD(n_components=1, n_iter=7, random_state=0)
     svd.fit(all_embedding)
+    all_embedding -= all_embedding.dot(np.transpose(svd.components_)) * svd.components_
 
-    for key in tqdm(video_data, desc='Subtitle Remove Component'):
-        subtitle[key]['lines'] = subtitle[key]['lines'] - \
-                                 subtitle[key]['lines'].dot(np.transpose(svd.components_)) * svd.components_
+    index = 0
+    for key in keys:
+        num = len(subtitle[key]['lines'])
+        subtitle[key]['lines'] = all_embedding[index:index + num]
+        index += num
 
-    for ins in tqdm(qa, desc='QA Remove Component'):
-        ins['question'] = ins['question'] - ins['question'].dot(np.transpose(svd.components_)) * svd.components_
-        ins['answers'] = ins['answers'] - ins['answers'].dot(np.transpose(svd.components_)) * svd.components_
-
-        np.save(os.path.join(_mp.encode_dir, ins['qid'] + '.npy'),
-                np.concatenate([ins['question'], ins['answers']], axis=0))
+    for idx, ins in enumerate(tqdm(qa, desc='Save QA Embedding')):
+        ins['question'], ins['answers'] = qa_rows[idx, :1], qa_rows[idx, 1:]
+        cd.save(os.path.join(_mp.encode_dir, ins['qid'] + '.npy'), qa_rows[idx], codec)
+    return qa_rows
 
 
 def create_vocab_glove(qa, subtitle, video_data, glove_vocab, glove_embed):
@@ -238,54 +282,117 @@ def create_vocab_glove(qa, subtitle, video_data, glove_vocab, glove_embed):
     return glove_vocab, subtitle, glove_embed, vocab, qa
 
 
+def tokenize(sent):
+    return wordpunct_tokenize(sent.strip().lower())
+
+
+def tokenize_qa(ins):
+    ins['question'] = tokenize(ins['question'])
+    ins['answers'] = [tokenize(sent) if sent else ['.'] for sent in ins['answers']]
+    return ins
+
+
+def qa_words(ins):
+    return ins['question'] + [w for sent in ins['answers'] for w in sent]
+
+
+VOCAB_ARTIFACTS = ['freq_file', 'vocab_file', 'embedding_file', 'temp_subtitle_file', 'tokenize_qa']
+
+
+def load_vocab_state():
+    """
+    Load the vocabulary artifacts of the last run, if they are all there and none of them was
+    changed after the manifest was written.
+    :return: manifest and artifacts, or None
+    """
+    if not all(os.path.exists(getattr(_mp, a)) for a in VOCAB_ARTIFACTS + ['vocab_manifest_file']):
+        return None
+    manifest = du.json_load(_mp.vocab_manifest_file)
+    if any(manifest['checksum'].get(a) != du.file_checksum(getattr(_mp, a)) for a in VOCAB_ARTIFACTS):
+        print('Vocabulary artifacts do not match manifest, build from scratch.')
+        return None
+    return manifest, du.json_load(_mp.freq_file), du.json_load(_mp.vocab_file), \
+        np.load(_mp.embedding_file), du.json_load(_mp.temp_subtitle_file), \
+        {ins['qid']: ins for ins in du.json_load(_mp.tokenize_qa)}
+
+
 def create_vocab(qa, subtitle, video_data, gram_vocab, gram_embed):
-    if not os.path.exists(_mp.vocab_file):
-        vocab = Counter()
-
-        for key in tqdm(video_data, desc='Tokenize Subtitle'):
-            subt = subtitle[key]
-            for idx, line in enumerate(subt['lines']):
-                line = wordpunct_tokenize(line.strip().lower())
-                vocab.update(line)
-                subt['lines'][idx] = line
-
-        for ins in tqdm(qa, desc='Tokenize QA'):
-            ins['question'] = wordpunct_tokenize(ins['question'].strip().lower())
-            vocab.update(ins['question'])
-            ins['answers'] = [wordpunct_tokenize(sent.strip().lower()) if sent else ['.']
-                              for sent in ins['answers']]
-            for sent in ins['answers']:
-                vocab.update(sent)
-
-        filter_vocab, idx_vocab = {}, 1
-
-        frequency = {}
-        vocab_embed = np.zeros((len(vocab) + 1, gram_embed.shape[1]), dtype=np.float32)
-        for v in tqdm(vocab, desc='Create Embedding'):
-            v_ = '<' + v + '>'
-            v_gram = [c for c in v] + [v_[i:i + 3] for i in range(len(v_) - 2)] + \
-                     [v_[i:i + 6] for i in range(len(v_) - 5)]
-            v_gram_code = [gram_vocab[gram] for gram in v_gram if gram in gram_vocab]
-            if v_gram_code:
-                frequency[v] = vocab[v]
-                filter_vocab[v] = idx_vocab
-                vocab_embed[idx_vocab] = np.sum(gram_embed[v_gram_code], axis=0)
-                idx_vocab += 1
-        vocab_embed = vocab_embed[:idx_vocab]
-        du.json_dump(frequency, _mp.freq_file)
-        du.json_dump(filter_vocab, _mp.vocab_file)
-        np.save(_mp.embedding_file, vocab_embed)
-        print(len(vocab_embed))
-        du.json_dump(subtitle, _mp.temp_subtitle_file)
-        du.json_dump(qa, _mp.tokenize_qa)
+    """
+    Tokenize subtitle and qa, and build the vocabulary with embedding of each word. The hash of
+    each movie's lines and each qa is kept, so only new or changed text is tokenized, its words
+    are merged into the frequency, and only new words get embedding. Words never lose their row.
+    :return filter_vocab, subtitle, vocab_embed, frequency, qa: tokenized subtitle and qa
+    """
+    state = load_vocab_state()
+    if state:
+        manifest, frequency, filter_vocab, vocab_embed, old_subt, old_qa = state
     else:
-        filter_vocab = du.json_load(_mp.vocab_file)
-        subtitle = du.json_load(_mp.temp_subtitle_file)
-        vocab_embed = np.load(_mp.embedding_file)
-        frequency = du.json_load(_mp.freq_file)
-        qa = du.json_load(_mp.tokenize_qa)
+        manifest = {'subtitle': {}, 'qa': {}}
+        frequency, filter_vocab, old_subt, old_qa = {}, {}, {}, {}
+        vocab_embed = np.zeros((1, gram_embed.shape[1]), dtype=np.float32)
+    hashes = {'subtitle': {}, 'qa': {}}
+    # Change of word counts
+    vocab = Counter()
 
-    return filter_vocab, subtitle, vocab_embed, frequency, qa
+    for key in tqdm(video_data, desc='Tokenize Subtitle'):
+        subt = subtitle[key]
+        hashes['subtitle'][key] = du.json_checksum(subt['lines'])
+        if key in old_subt and key in manifest['subtitle']:
+            if manifest['subtitle'][key] == hashes['subtitle'][key]:
+                subt['lines'] = old_subt[key]['lines']
+                continue
+            for line in old_subt[key]['lines']:
+                vocab.subtract(line)
+        subt['lines'] = [tokenize(line) for line in subt['lines']]
+        for line in subt['lines']:
+            vocab.update(line)
+    for key in set(manifest['subtitle']) - set(hashes['subtitle']):
+        for line in old_subt[key]['lines']:
+            vocab.subtract(line)
+
+    tokenized_qa = []
+    for ins in tqdm(qa, desc='Tokenize QA'):
+        qid = ins['qid']
+        hashes['qa'][qid] = du.json_checksum(ins)
+        if qid in old_qa and qid in manifest['qa']:
+            if manifest['qa'][qid] == hashes['qa'][qid]:
+                tokenized_qa.append(old_qa[qid])
+                continue
+            vocab.subtract(qa_words(old_qa[qid]))
+        tokenized_qa.append(tokenize_qa(ins))
+        vocab.update(qa_words(ins))
+    for qid in set(manifest['qa']) - set(hashes['qa']):
+        vocab.subtract(qa_words(old_qa[qid]))
+
+    new_words = []
+    for v in tqdm(vocab, desc='Update Frequency'):
+        if v in filter_vocab:
+            count = frequency.get(v, 0) + vocab[v]
+            if count > 0:
+                frequency[v] = count
+            else:
+                frequency.pop(v, None)
+        elif vocab[v] > 0:
+            new_words.append(v)
+    # Embedding of a word is the sum of embedding of its n-grams.
+    new_embed, known = NgramEncoder(gram_vocab).embed(new_words, gram_embed)
+    for idx, v in enumerate(v for v, k in zip(new_words, known) if k):
+        frequency[v] = vocab[v]
+        filter_vocab[v] = len(vocab_embed) + idx
+    if known.any():
+        vocab_embed = np.concatenate([vocab_embed, new_embed[known].astype(np.float32)], axis=0)
+
+    if not state or hashes != {k: manifest[k] for k in hashes}:
+        du.atomic_json_dump(frequency, _mp.freq_file)
+        du.atomic_json_dump(filter_vocab, _mp.vocab_file)
+        du.atomic_save(_mp.embedding_file, vocab_embed)
+        du.atomic_json_dump(subtitle, _mp.temp_subtitle_file)
+        du.atomic_json_dump(tokenized_qa, _mp.tokenize_qa)
+        hashes['checksum'] = {a: du.file_checksum(getattr(_mp, a)) for a in VOCAB_ARTIFACTS}
+        hashes['vocab_size'] = len(vocab_embed)
+        du.atomic_json_dump(hashes, _mp.vocab_manifest_file, indent=0)
+
+    return filter_vocab, subtitle, vocab_embed, frequency, tokenized_qa
 
 
 def remove_all():
@@ -293,6 +400,7 @@ def remove_all():
     fu.safe_remove(_mp.tokenize_qa)
     fu.safe_remove(_mp.tokenize_subt)
     fu.safe_remove(_mp.vocab_file)
+    fu.safe_remove(_mp.vocab_manifest_file)
     fu.safe_remove(_mp.embedding_file)
     fu.safe_remove(_mp.freq_file)
     fu.safe_remove(_mp.sample_frame_file)
@@ -300,7 +408,7 @@ def remove_all():
         os.system('rm -rf %s' % _mp.encode_dir)
 
 
-def gen_embedding(qa, subtitle, video_data):
+def gen_embedding(qa, subtitle, video_data, codec=None):
     embed = hub.Module("https://tfhub.dev/google/universal-sentence-encoder/1")
     sentences_placeholder = tf.placeholder(tf.string, [None])
     embed_encoding = embed(sentences_placeholder)
@@ -314,10 +422,13 @@ def gen_embedding(qa, subtitle, video_data):
                                        feed_dict={sentences_placeholder: subt['lines']})
             subt['lines'] = lines_embedding
 
+        qa_rows = []
         for ins in tqdm(qa):
             lines_embedding = sess.run(embed_encoding,
                                        feed_dict={sentences_placeholder: [ins['question']] + ins['answers']})
-            np.save(os.path.join(_mp.encode_dir, ins['qid'] + '.npy'), lines_embedding)
+            cd.save(os.path.join(_mp.encode_dir, ins['qid'] + '.npy'), lines_embedding, codec)
+            qa_rows.append(lines_embedding)
+    return np.stack(qa_rows)
 
 
 def arg_parse():
@@ -328,6 +439,8 @@ def arg_parse():
                                                   '1: universal embedding, '
                                                   '2: Glove embedding', type=int)
     parser.add_argument('--one', action='store_true', help='Sample only one frame.')
+    parser.add_argument('--codec', default=None, choices=cd.CODECS,
+                        help='Storage codec of subtitle and QA embedding, default keeps the computed dtype.')
     return parser.parse_args()
 
 
@@ -346,19 +459,23 @@ def main():
         gram_embed = np.load(_ep.gram_embedding_vec_file)
         filter_vocab, subtitle, vocab_embed, frequency, qa = \
             create_vocab(qa, subtitle, video_data, gram_vocab, gram_embed)
-        collect_embedding(qa, subtitle, video_data, filter_vocab, vocab_embed, frequency)
+        qa_embedding = collect_embedding(qa, subtitle, video_data, filter_vocab, vocab_embed, frequency,
+                                         args.codec)
     elif args.mode == 1:
-        gen_embedding(qa, subtitle, video_data)
+        qa_embedding = gen_embedding(qa, subtitle, video_data, args.codec)
     elif args.mode == 2:
-        glove_vocab = {k: i for i, k in enumerate(du.json_load(_ep.glove_embedding_key_file))}
-        glove_embed = np.load(_ep.glove_embedding_vec_file)
+        glove_keys = col.StringTable(_ep.glove_embedding_key_file, _ep.glove_embedding_offset_file).tolist()
+        glove_vocab = {k: i for i, k in enumerate(glove_keys)}
+        glove_embed = np.load(_ep.glove_embedding_vec_file, mmap_mode='r')
         filter_vocab, subtitle, vocab_embed, frequency, qa = \
             create_vocab(qa, subtitle, video_data, glove_vocab, glove_embed)
-        collect_embedding(qa, subtitle, video_data, filter_vocab, vocab_embed, frequency)
+        qa_embedding = collect_embedding(qa, subtitle, video_data, filter_vocab, vocab_embed, frequency,
+                                         args.codec)
 
     print('Process done!')
     sample = subtitle_process(video_data, frame_time, subtitle)
 
+    intervals, lengths = [], []
     for ins in tqdm(qa, desc='Create Spectrum'):
         video_list = sorted(list(sample[ins['imdb_key']].keys()))
 
@@ -375,6 +492,9 @@ def main():
         assert np.sum(spectrum) > 0, '%s no content needed.' % ins['qid']
         np.save(os.path.join(_mp.encode_dir, ins['qid'] + '_spec' + '.npy'),
                 spectrum)
+        intervals.append(qs.spec_intervals(spectrum))
+        lengths.append(num_frame)
+    qs.save_qa_store([ins['qid'] for ins in qa], qa_embedding, intervals, lengths, args.codec or 'float32')
 
 
 if __name__ == '__main__':
@@ -1,9 +1,10 @@
 import argparse
+import json
 import os
 from functools import partial
 from glob import glob
-from multiprocessing import Pool, Manager
-from os.path import join
+from multiprocessing import Pool
+from os.path import join, exists
 
 import imageio
 import numpy as np
@@ -12,68 +13,155 @@ from tqdm import tqdm
 import utils.data_utils as du
 from config import MovieQAPath
 from data.data_loader import duration
+from data.frame_store import ClipWriter
 from utils import func_utils as fu
 
 _mp = MovieQAPath()
 
 
-def check_and_extract_videos(extract, video_clips, video_data, key):
+def write_frames(frames, img_dir, base_name, extract, packed=False):
     """
-    check the availability of video clips and save frames to directory.
+    Write frames to directory, or to the frame store of the movie, as soon as they are decoded.
+    :param frames: iterable of frames
+    :param img_dir: directory of the frames of a clip
+    :param base_name: video name without extension
+    :param extract: boolean, write or only count.
+    :param packed: boolean, write to frame store or not.
+    :return: number of frames
+    """
+    writer = ClipWriter(base_name) if extract and packed else None
+    if extract and not packed:
+        fu.make_dirs(img_dir)
+    num = 0
+    try:
+        for num, img in enumerate(frames, start=1):
+            if writer:
+                writer.add(num - 1, img)
+            elif extract:
+                imageio.imwrite(join(img_dir, '%s_%05d.jpg' % (base_name, num)), img)
+    except RuntimeError:
+        # There is no error here anymore. This exception scope is used, just in case.
+        pass
+    if writer:
+        writer.close()
+    return num
+
+
+def check_and_extract_video(extract, packed, item):
+    """
+    check the availability of a video clip and save its frames to directory.
     :param extract: boolean, extract or not.
-    :param video_clips: dictionary with key: "imdb_key", value: list of all video paths of "imdb_key"
-    :param video_data: empty video meta data.
-    :param key: imdb_key e.g. ttxxxxxxx
-    :return: None
+    :param packed: boolean, write to frame store or not.
+    :param item: tuple of imdb_key and video path
+    :return: imdb_key, video name and meta data of the video
     """
     # Warning: Can't not get the last frame of the file
-    temp_video_data, delta, img_list = {}, 5, []
+    key, video = item
+    delta = 5
     nil_img = np.zeros((299, 299, 3), dtype=np.uint8)
 
-    for video in video_clips[key]:
-        del img_list[:]
+    # video name without mp4
+    base_name = fu.basename_wo_ext(video)
+    img_dir = join(_mp.image_dir, base_name)
+    # Frames written by a run without manifest.
+    extracted = 0 if packed else len(glob(join(img_dir, '*.jpg')))
+
+    try:
+        # open the video file with imageio
+        reader = imageio.get_reader(video, ffmpeg_params=['-analyzeduration', '10M'])
+    except OSError:
+        reader = None
+        # Almost all errors will be here.
+        # We try our best to make sure the completeness of data.
+        start, end = duration(base_name)
+        num_frame = end - start
+        meta_data = {'nframes': num_frame}
+        frames = (nil_img for _ in range(num_frame))
+    else:
+        # If imageio succeed to open the imageio, we start to extract frames.
+        meta_data = reader.get_meta_data()
+        frames = reader
+
+    meta_data['real_frames'] = extracted
+    if meta_data['nframes'] > extracted + delta:
+        meta_data['real_frames'] = write_frames(frames, img_dir, base_name, extract, packed)
+    if reader is not None:
+        reader.close()
+
+    return key, base_name, meta_data
 
-        # video name without mp4
-        base_name = fu.basename_wo_ext(video)
-        img_dir = join(_mp.image_dir, base_name)
-        extracted = glob(join(img_dir, '*.jpg'))
 
+def sample_frames(reader, indices, nil_img):
+    """
+    Decode only the sampled frames of a clip. Indices are visited in increasing order, so the
+    reader only seeks forward. A frame which can not be decoded is replaced with nil image.
+    :param reader: imageio reader of the clip, or None if the clip can not be opened
+    :param indices: sorted list of 0-based frame indices
+    :param nil_img: placeholder image
+    :return: generator of (index, frame)
+    """
+    for i in indices:
+        if reader is None:
+            yield i, nil_img
+            continue
         try:
-            # open the video file with imageio
-            reader = imageio.get_reader(video, ffmpeg_params=['-analyzeduration', '10M'])
-        except OSError:
-            # Almost all errors will be here.
-            # We try our best to make sure the completeness of data.
-            start, end = duration(base_name)
-            num_frame = end - start
-            meta_data = {'nframes': num_frame}
-
-            if meta_data['nframes'] > len(extracted) + delta:
-                img_list = [nil_img] * num_frame
+            yield i, reader.get_data(i)
+        except (IndexError, RuntimeError):
+            yield i, nil_img
+
+
+def extract_sample_video(packed, item):
+    """
+    Save the sampled frames of a video clip to directory, with the same file names as the full
+    extraction, i.e. <image_dir>/<clip>/<clip>_<index + 1>.jpg, or to the frame store of the movie.
+    :param packed: boolean, write to frame store or not.
+    :param item: tuple of imdb_key, video path and list of sampled frame indices
+    :return: imdb_key, video name and meta data of the video
+    """
+    key, video, indices = item
+    nil_img = np.zeros((299, 299, 3), dtype=np.uint8)
+
+    base_name = fu.basename_wo_ext(video)
+    img_dir = join(_mp.image_dir, base_name)
+    writer = ClipWriter(base_name) if packed else None
+    if not packed:
+        fu.make_dirs(img_dir)
+    indices = sorted(set(indices))
+
+    try:
+        reader = imageio.get_reader(video, ffmpeg_params=['-analyzeduration', '10M'])
+    except OSError:
+        reader = None
+
+    for i, img in sample_frames(reader, indices, nil_img):
+        if writer:
+            writer.add(i, img)
         else:
-            # If imageio succeed to open the imageio, we start to extract frames.
-            meta_data = reader.get_meta_data()
+            imageio.imwrite(join(img_dir, '%s_%05d.jpg' % (base_name, i + 1)), img)
+    if writer:
+        writer.close()
+    if reader is not None:
+        reader.close()
+
+    return key, base_name, {'sampled_frames': len(indices)}
 
-            if meta_data['nframes'] > len(extracted) + delta:
+
+def load_manifest(manifest_file):
+    """
+    Load the meta data of finished clips from manifest. A line broken by interruption is ignored.
+    :param manifest_file: path of manifest
+    :return: dictionary with key: "imdb_key", value: dictionary of meta data of finished clips
+    """
+    video_data = {}
+    if exists(manifest_file):
+        with open(manifest_file, 'r') as f:
+            for line in f:
                 try:
-                    for img in reader:
-                        img_list.append(img)
-                except RuntimeError:
-                    # There is no error here anymore. This exception scope is used, just in case.
-                    pass
-
-        meta_data['real_frames'] = len(extracted)
-        # Check if already extracted or not
-        if img_list:
-            if len(extracted) != len(img_list) and extract:
-                fu.make_dirs(img_dir)
-                for i, img in enumerate(img_list):
-                    imageio.imwrite(join(img_dir, '%s_%05d.jpg' % (base_name, i + 1)), img)
-            meta_data['real_frames'] = len(img_list)
-        # save metadata for videos
-        temp_video_data[base_name] = meta_data
-    # save all metadata in a movie
-    video_data[key] = temp_video_data
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                video_data.setdefault(record['key'], {})[record['video']] = record['meta']
+    return video_data
 
 
 def get_videos_clips():
@@ -91,29 +179,61 @@ def get_videos_clips():
     return video_clips
 
 
-def video_process(extract):
+def video_process(extract, num_workers=16, packed=False):
     """
-    Start multi-thread to process video file. The video meta data is saved here.
+    Start multi-process to process video files. Each process takes one clip at a time and
+    writes its frames as they are decoded. Finished clips are appended to the manifest, so an
+    interrupted run skips them when it is started again. The video meta data is saved here.
     :param extract: boolean, extract or not.
+    :param num_workers: number of processes
+    :param packed: boolean, write to frame stores or not.
     :return: None
     """
     fu.make_dirs(_mp.image_dir)
-    # multiprocessing proxy manager
-    manager = Manager()
-
-    # video clips and data proxy object
-    video_clips = manager.dict(get_videos_clips())
-    video_data = manager.dict()
-    keys = list(video_clips.keys())
-
-    with Pool(16) as p, tqdm(total=len(keys), desc="Check and extract videos") as pbar:
-        check_func = partial(check_and_extract_videos, extract, video_clips, video_data)
-        # check and extract all videos. Each thread takes all videos from a movie once
-        # at a time.
-        for _ in p.imap_unordered(check_func, keys):
+    # Only clips with frames on disk count as finished.
+    video_data = load_manifest(_mp.video_manifest_file) if extract else {}
+
+    video_clips = get_videos_clips()
+    items = [(k, v) for k in video_clips for v in video_clips[k]
+             if fu.basename_wo_ext(v) not in video_data.get(k, {})]
+    # Longest clips first, so that no worker is left with a long clip at the end.
+    items.sort(key=lambda item: os.path.getsize(item[1]), reverse=True)
+
+    with Pool(num_workers) as p, open(_mp.video_manifest_file if extract else os.devnull, 'a') as f, \
+            tqdm(total=len(items), desc="Check and extract videos") as pbar:
+        check_func = partial(check_and_extract_video, extract, packed)
+        for key, base_name, meta_data in p.imap_unordered(check_func, items):
+            f.write(json.dumps({'key': key, 'video': base_name, 'meta': meta_data}) + '\n')
+            f.flush()
+            video_data.setdefault(key, {})[base_name] = meta_data
             pbar.update()
 
-    du.json_dump(video_data.copy(), _mp.video_data_file)
+    du.json_dump(video_data, _mp.video_data_file)
+
+
+def sample_process(num_workers=16, packed=False):
+    """
+    Extract only the frames listed in sample file, which is made by process.text_v3. The meta data
+    of the full extraction (video_data.json) is left untouched.
+    :param num_workers: number of processes
+    :param packed: boolean, write to frame stores or not.
+    :return: None
+    """
+    fu.make_dirs(_mp.image_dir)
+    finished = load_manifest(_mp.sample_manifest_file)
+    sample = du.json_load(_mp.sample_frame_file)
+
+    video_path = {fu.basename_wo_ext(v): v for clips in get_videos_clips().values() for v in clips}
+    items = [(k, video_path[v], sample[k][v]) for k in sample for v in sample[k]
+             if sample[k][v] and v not in finished.get(k, {})]
+    items.sort(key=lambda item: len(item[2]), reverse=True)
+
+    with Pool(num_workers) as p, open(_mp.sample_manifest_file, 'a') as f, \
+            tqdm(total=len(items), desc="Extract sampled frames") as pbar:
+        for key, base_name, meta_data in p.imap_unordered(partial(extract_sample_video, packed), items):
+            f.write(json.dumps({'key': key, 'video': base_name, 'meta': meta_data}) + '\n')
+            f.flush()
+            pbar.update()
 
 
 def check():
@@ -142,12 +262,17 @@ def parse_args():
     parser = argparse.ArgumentParser()
     parser.add_argument('--no_extract', action='store_false', help='Run without frame extracting.')
     parser.add_argument('--check', action='store_true', help='Checl that number of image is correct')
+    parser.add_argument('--workers', default=16, type=int, help='Number of extracting processes.')
+    parser.add_argument('--sample', action='store_true', help='Extract only frames in sample file.')
+    parser.add_argument('--packed', action='store_true', help='Write frames to one frame store per movie.')
     return parser.parse_args()
 
 
 if __name__ == '__main__':
     args = parse_args()
-    if not args.check:
-        video_process(args.no_extract)
+    if args.sample:
+        sample_process(args.workers, args.packed)
+    elif not args.check:
+        video_process(args.no_extract, args.workers, args.packed)
     else:
         check()
@@ -1,4 +1,8 @@
+import math
 import random
+import threading
+import time
+from collections import OrderedDict, deque
 from functools import partial
 from os.path import join
 
@@ -7,140 +11,886 @@ import tensorflow as tf
 from tqdm import trange
 
 from config import MovieQAPath
+from data import codec as cd
+from data.feature_store import FeatureStore
+from data.columnar import load_npy
+from data.qa_store import QAStore, spec_intervals
 from utils import data_utils as du
 
 _mp = MovieQAPath()
 embedding_size = 300
+# Number of batches sorted together when bucketing questions by context length.
+bucket_pool = 64
+# Number of parallel loader calls of each component in Input and TestInput. Each component also prefetches
+# as many loaded elements, so up to twice as many elements are held before the bounded prefetch buffer.
+parallel_calls = {'qa': 1, 'subt': 2, 'feat': 4, 'spec': 1}
 
 
-def subt_load(s, mode):
+class LRUCache(object):
+    """
+    Least-recently-used cache of numpy arrays bounded by their total bytes.
+    It is shared by the loaders running in parallel map threads, so all accesses are locked, and a
+    key being loaded by one thread is waited for by the others instead of being loaded twice.
+    Counters of hits and misses tell how many disk reads are saved.
+    """
+
+    def __init__(self, capacity):
+        """
+        :param capacity: maximal total bytes of cached arrays
+        """
+        self.capacity = capacity
+        self.hits = 0
+        self.misses = 0
+        self._size = 0
+        self._data = OrderedDict()
+        self._loading = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, func):
+        """
+        Get a copy of the cached value of key, or load it by func() and cache it.
+        A copy is returned because tensorflow may reuse the buffer of a py_func output.
+        """
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return self._data[key].copy()
+            loading = self._loading.get(key)
+            if loading is None:
+                self.misses += 1
+                loading = self._loading[key] = threading.Event()
+                owner = True
+            else:
+                owner = False
+
+        if not owner:
+            loading.wait()
+            with self._lock:
+                value = self._data.get(key)
+                # The value may be too large to be cached, or already evicted.
+                if value is not None:
+                    self.hits += 1
+                else:
+                    self.misses += 1
+            return value.copy() if value is not None else func()
+
+        try:
+            value = func()
+            with self._lock:
+                if value.nbytes <= self.capacity:
+                    self._data[key] = value
+                    self._size += value.nbytes
+                    while self._size > self.capacity:
+                        _, evicted = self._data.popitem(last=False)
+                        self._size -= evicted.nbytes
+        finally:
+            with self._lock:
+                del self._loading[key]
+            loading.set()
+        return value.copy()
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {'hits': self.hits, 'misses': self.misses,
+                    'hit_rate': self.hits / total if total else 0.0,
+                    'items': len(self._data), 'bytes': self._size}
+
+
+def cached(cache, key, func):
+    return cache.get(key, func) if cache is not None else func()
+
+
+def flatten(element):
+    """Tensors of a nested tuple, in order."""
+    if isinstance(element, tuple):
+        return [t for e in element for t in flatten(e)]
+    return [element]
+
+
+def map_nested(func, element):
+    """Apply func to each tensor of a nested tuple, keeping its structure."""
+    if isinstance(element, tuple):
+        return tuple(map_nested(func, e) for e in element)
+    return func(element)
+
+
+class PrefetchPolicy(object):
+    """
+    Depth of a prefetch buffer bounded by a byte budget.
+    The largest element is estimated from the npy headers of the data, so that the pipeline never holds more
+    than budget bytes. The budget covers the fixed buffers before the prefetch buffer too: their reserved bytes
+    (loader calls in flight, prefetches of each component, and the batch being padded) are taken out of it,
+    and depth elements take at most the rest. At least one element is prefetched, even if nothing is left.
+    Elements are numbered in the order they enter the buffer, and one in sample_every of them is counted by
+    py_func when it enters the buffer and when the model takes it. The gap between the numbers of the last
+    counted element produced and the element taken gives the occupancy of the buffer, short by at most
+    sample_every - 1 elements, its bytes and the consumer rate.
+    The depth is fed to the prefetch dataset when its iterator is initialized, so it adapts per epoch only:
+    at the start of each epoch, the depth grows if the model often found the buffer empty while it was full
+    at times, and shrinks if some elements stayed unused in the buffer during the whole epoch.
+    With sample_every=0, nothing is counted, no py_func is added to the graph, and the depth stays at the limit.
+    """
+
+    def __init__(self, budget, element_bytes, max_depth=128, sample_every=None, reserved=0):
+        """
+        :param budget: maximal bytes of elements held by the input pipeline
+        :param element_bytes: bytes of the largest element
+        :param max_depth: maximal number of prefetched elements
+        :param sample_every: count one element in sample_every, 0 to count none. By default, an eighth of
+        the limit of the depth up to 16, so small elements which come fast are counted rarely.
+        :param reserved: bytes held by the fixed buffers before the prefetch buffer, see upstream_bytes
+        """
+        self.budget = budget
+        self.element_bytes = element_bytes
+        self.reserved = reserved
+        self.limit = int(max(1, min(max_depth, (budget - reserved) // max(element_bytes, 1))))
+        self.depth = self.limit
+        self.sample_every = max(1, min(16, self.limit // 8)) if sample_every is None else sample_every
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self._sizes = deque()
+        self._produced_index = -1
+        self.consumed = 0
+        self.starved = 0
+        self.peak_occupancy = 0
+        self.peak_bytes = 0
+        self._occupancy_sum = 0
+        self._samples = 0
+        self._measured = 0
+        self._pending = deque()
+        self._min_slack = None
+        self._first = None
+        self._last = None
+
+    def produce(self, index, nbytes):
+        with self._lock:
+            self._sizes.append(int(nbytes))
+            self._produced_index = max(self._produced_index, int(index))
+        return nbytes
+
+    def consume(self, index):
+        with self._lock:
+            now = time.time()
+            self._first = self._first or now
+            self._last = now
+            # Elements index to the last counted one are in the buffer.
+            occupancy = max(self._produced_index - int(index), 0) + 1
+            if self._sizes:
+                self.peak_bytes = max(self.peak_bytes, occupancy * sum(self._sizes) // len(self._sizes))
+                self._sizes.popleft()
+            self.consumed = int(index) + 1
+            self._samples += 1
+            self._occupancy_sum += occupancy
+            self.peak_occupancy = max(self.peak_occupancy, occupancy)
+            # The first elements are taken while the buffer is being filled, and the last ones while it is
+            # drained, so occupancies are measured once depth more elements were taken.
+            if index >= self.depth:
+                self._pending.append(occupancy)
+                if len(self._pending) > math.ceil(self.depth / self.sample_every):
+                    measured = self._pending.popleft()
+                    self._measured += 1
+                    self.starved += measured <= 1
+                    slack = measured - 1
+                    self._min_slack = slack if self._min_slack is None else min(self._min_slack, slack)
+        return np.int64(occupancy)
+
+    def next_depth(self):
+        """
+        Adapt the depth to the last epoch and start counting a new one.
+        :return: depth of the prefetch buffer
+        """
+        with self._lock:
+            if self._measured:
+                # The occupancy is short by less than sample_every elements.
+                if self.starved > 0.1 * self._measured and self.peak_occupancy + self.sample_every > self.depth:
+                    self.depth = min(self.limit, self.depth * 2)
+                elif not self.starved and self._min_slack:
+                    # Shrink by half of the slack, so a short burst of the next epoch is still covered.
+                    self.depth = max(1, self.depth - self._min_slack // 2)
+            self._reset()
+            return self.depth
+
+    def stats(self):
+        with self._lock:
+            seconds = (self._last - self._first) if self._samples > 1 else 0
+            return {'depth': self.depth, 'limit': self.limit, 'element_bytes': self.element_bytes,
+                    'reserved': self.reserved,
+                    'sample_every': self.sample_every, 'consumed': self.consumed,
+                    'rate': (self._samples - 1) * self.sample_every / seconds if seconds else 0.0,
+                    'mean_occupancy': self._occupancy_sum / self._samples if self._samples else 0.0,
+                    'peak_occupancy': self.peak_occupancy, 'peak_bytes': self.peak_bytes,
+                    'starved': self.starved}
+
+    def sampled(self, index):
+        return tf.equal(index % self.sample_every, 0)
+
+    def mark_produced(self, index, element):
+        """Map function counting the sampled elements which enter the prefetch buffer."""
+        nbytes = tf.add_n([tf.cast(tf.size(t), tf.int64) * t.dtype.size for t in flatten(element)])
+        done = tf.cond(self.sampled(index), lambda: tf.py_func(self.produce, [index, nbytes], tf.int64),
+                       lambda: nbytes)
+        with tf.control_dependencies([done]):
+            return tf.identity(index), map_nested(tf.identity, element)
+
+    def mark_consumed(self, element):
+        """Count the sampled elements given by the iterator, and drop their numbers."""
+        if not self.sample_every:
+            return element
+        index, element = element
+        with tf.control_dependencies(flatten(element)):
+            done = tf.cond(self.sampled(index), lambda: tf.py_func(self.consume, [index], tf.int64),
+                           lambda: tf.constant(0, dtype=tf.int64))
+        with tf.control_dependencies([done]):
+            return map_nested(tf.identity, element)
+
+    def prefetch(self, dataset, size):
+        """
+        :param dataset: dataset of elements
+        :param size: scalar int64 placeholder of the depth, fed with next_depth()
+        :return: prefetched dataset, of (number, element) pairs if elements are counted
+        """
+        if not self.sample_every:
+            return dataset.prefetch(size)
+        index = tf.data.Dataset.range(np.iinfo(np.int64).max)
+        return tf.data.Dataset.zip((index, dataset)).map(self.mark_produced).prefetch(size)
+
+
+def py_func_ops(graph):
+    """
+    :param graph: tensorflow graph
+    :return: names of the py_func ops of the graph, including those in the functions of datasets
+    """
+    graph_def = graph.as_graph_def()
+    nodes = list(graph_def.node) + [n for f in graph_def.library.function for n in f.node_def]
+    return [n.name for n in nodes if n.op in ('PyFunc', 'PyFuncStateless', 'EagerPyFunc')]
+
+
+def subt_load(s, mode, store=None, cache=None):
     if 'subt' in mode:
-        return np.load(s.decode('utf-8')).astype(np.float32)
+        if store is not None:
+            # s is imdb key, and the store gives its rows.
+            return cached(cache, ('subt', s), lambda: store.get(s.decode('utf-8')))
+        return cached(cache, ('subt', s), lambda: cd.load(s.decode('utf-8')))
     else:
         return np.zeros((1, embedding_size), dtype=np.float32)
 
 
-def feat_load(f, mode):
+def feat_load(f, mode, store=None, cache=None):
     if 'feat' in mode:
-        return np.load(f.decode('utf-8')).astype(np.float32)
+        if store is not None:
+            return cached(cache, ('feat', f), lambda: store.get(f.decode('utf-8')))
+        return cached(cache, ('feat', f), lambda: cd.load(f.decode('utf-8')))
     else:
         return np.zeros((1, 6, 2048), dtype=np.float32)
 
 
-def qa_load(qa):
-    qa = np.load(qa.decode('utf-8')).astype(np.float32)
+def qa_load(qa, store=None):
+    if store is not None:
+        # qa is qid, and the store gives a view of its row.
+        qa = np.array(store.embedding(store.row(qa.decode('utf-8'))), dtype=np.float32)
+    else:
+        qa = cd.load(qa.decode('utf-8'))
     return qa[:1], qa[1:6]
 
 
-def spec_load(spec):
-    return np.load(spec.decode('utf-8')).astype(np.int32)
+def spec_load(spec, store=None, cache=None):
+    if store is not None:
+        return cached(cache, ('spec', spec), lambda: store.spec(store.row(spec.decode('utf-8'))))
+    return cached(cache, ('spec', spec), lambda: np.load(spec.decode('utf-8')).astype(np.int32))
 
 
-def load(tensor, comp, mode):
+def load(tensor, comp, mode, store=None, cache=None):
     with tf.device("/cpu:0"):
         if comp == 'qa':
-            func = qa_load
+            func = partial(qa_load, store=store)
             q, a = tf.py_func(func, [tensor], [tf.float32, tf.float32])
             return tf.reshape(q, [-1, embedding_size]), tf.reshape(a, [-1, embedding_size])
         elif comp == 'subt':
-            func = partial(subt_load, mode=mode)
+            func = partial(subt_load, mode=mode, store=store, cache=cache)
             return tf.reshape(tf.py_func(func, [tensor], [tf.float32]), [-1, embedding_size])
         elif comp == 'spec':
-            func = spec_load
+            func = partial(spec_load, store=store, cache=cache)
             # return tf.reshape(tf.py_func(func, [tensor], [tf.int64]), [-1, 1])
             return tf.reshape(tf.py_func(func, [tensor], [tf.int32]), [-1])
         else:
-            func = partial(feat_load, mode=mode)
+            func = partial(feat_load, mode=mode, store=store, cache=cache)
             return tf.reshape(tf.py_func(func, [tensor], [tf.float32]), [-1, 6, 2048])
 
 
+def context_rows(source, start, end, store):
+    """Float32 rows [start, end) of a movie context, read from a feature store or a memory-mapped .npy file."""
+    source = source.decode('utf-8')
+    return store.get(source, start, end) if store is not None else cd.load(source, start, end)
+
+
+def subt_window_load(s, start, end, mode, store=None, cache=None):
+    if 'subt' in mode:
+        return cached(cache, ('subt', s, start, end), lambda: context_rows(s, start, end, store))
+    else:
+        return np.zeros((1, embedding_size), dtype=np.float32)
+
+
+def feat_window_load(f, start, end, mode, store=None, cache=None):
+    if 'feat' in mode:
+        return cached(cache, ('feat', f, start, end), lambda: context_rows(f, start, end, store))
+    else:
+        return np.zeros((1, 6, 2048), dtype=np.float32)
+
+
+def spec_window_load(spec, start, end, store=None, cache=None):
+    if store is not None:
+        return cached(cache, ('spec', spec, start, end), lambda: store.spec(store.row(spec.decode('utf-8')))[start:end])
+    return cached(cache, ('spec', spec, start, end),
+                  lambda: np.array(load_npy(spec.decode('utf-8'))[start:end], dtype=np.int32))
+
+
+def window_load(tensor, start, end, comp, mode, store=None, cache=None):
+    """Same as load, but only context rows [start, end) are read, and spec is cut to the same rows."""
+    with tf.device("/cpu:0"):
+        if comp == 'subt':
+            func = partial(subt_window_load, mode=mode, store=store, cache=cache)
+            return tf.reshape(tf.py_func(func, [tensor, start, end], [tf.float32]), [-1, embedding_size])
+        elif comp == 'spec':
+            func = partial(spec_window_load, store=store, cache=cache)
+            return tf.reshape(tf.py_func(func, [tensor, start, end], [tf.int32]), [-1])
+        else:
+            func = partial(feat_window_load, mode=mode, store=store, cache=cache)
+            return tf.reshape(tf.py_func(func, [tensor, start, end], [tf.float32]), [-1, 6, 2048])
+
+
+def npy_layouts(files):
+    """
+    Byte layout of .npy files for native_load. The header of a file shared by several entries is read once.
+    :param files: list of .npy files, all of the same dtype
+    :return offsets, nbytes, dtype: where the data of each file start, their bytes, and their dtype
+    """
+    layout = {}
+    for f in files:
+        if f not in layout:
+            shape, fortran_order, dtype, offset = du.npy_layout(f)
+            if fortran_order or dtype.byteorder == '>':
+                raise ValueError('%s is not a little-endian C-order array, which can not be decoded natively.' % f)
+            if dtype == np.int8:
+                raise ValueError('%s is int8 with scales in a sidecar file, which can not be decoded natively.' % f)
+            layout[f] = offset, int(np.prod(shape)) * dtype.itemsize, dtype
+    dtypes = set(l[2] for l in layout.values())
+    if len(dtypes) > 1:
+        raise ValueError('Files of different dtypes %s can not be decoded by one reader.' % dtypes)
+    return [layout[f][0] for f in files], [layout[f][1] for f in files], \
+        dtypes.pop() if dtypes else np.dtype(np.float32)
+
+
+def native_source(files, feed_dict, enabled=True):
+    """
+    Placeholders of file names, data offsets and data bytes of .npy files read by native_load.
+    :param files: list of .npy files
+    :param feed_dict: feed dictionary, where the placeholders and their values are added
+    :param enabled: read the headers of the files or not, a disabled source is fed zero offsets and bytes
+    :return placeholders, dtype: tuple of placeholders, and dtype of the files
+    """
+    if enabled:
+        offsets, nbytes, dtype = npy_layouts(files)
+    else:
+        offsets, nbytes, dtype = [0] * len(files), [0] * len(files), np.dtype(np.float32)
+    placeholders = (tf.placeholder(dtype=tf.string, shape=[None]),
+                    tf.placeholder(dtype=tf.int64, shape=[None]),
+                    tf.placeholder(dtype=tf.int64, shape=[None]))
+    feed_dict.update(zip(placeholders, [files, offsets, nbytes]))
+    return placeholders, dtype
+
+
+def native_decode(path, offset, nbytes, dtype, out_type):
+    """
+    Read the data of a .npy file with tensorflow ops only, so no python runs per element.
+    :param path: file name
+    :param offset: number of bytes of the header
+    :param nbytes: number of bytes of the data
+    :param dtype: numpy dtype of the data
+    :param out_type: tensorflow dtype of the output
+    :return: flat tensor
+    """
+    data = tf.decode_raw(tf.substr(tf.read_file(path), offset, nbytes), tf.as_dtype(dtype))
+    return tf.cast(data, out_type)
+
+
+def native_load(path, offset, nbytes, comp, mode, dtype):
+    """Same as load, but with native_decode instead of py_func."""
+    with tf.device("/cpu:0"):
+        if comp == 'qa':
+            qa = tf.reshape(native_decode(path, offset, nbytes, dtype, tf.float32), [-1, embedding_size])
+            return qa[:1], qa[1:6]
+        elif comp == 'subt':
+            if 'subt' in mode:
+                return tf.reshape(native_decode(path, offset, nbytes, dtype, tf.float32), [-1, embedding_size])
+            else:
+                return tf.zeros([1, embedding_size], dtype=tf.float32)
+        elif comp == 'spec':
+            return tf.reshape(native_decode(path, offset, nbytes, dtype, tf.int32), [-1])
+        else:
+            if 'feat' in mode:
+                return tf.reshape(native_decode(path, offset, nbytes, dtype, tf.float32), [-1, 6, 2048])
+            else:
+                return tf.zeros([1, 6, 2048], dtype=tf.float32)
+
+
+def questions_load(qa, spec, gt, store=None):
+    """Load a chunk of questions of one movie. Each argument joins one entry per question with '|'."""
+    if store is not None:
+        rows = [store.row(qid) for qid in qa.decode('utf-8').split('|')]
+        qa = np.array(store.embedding(rows), dtype=np.float32)
+        spec = np.stack([store.spec(r) for r in rows])
+    else:
+        qa = np.stack([cd.load(n) for n in qa.decode('utf-8').split('|')])
+        spec = np.stack([np.load(n).astype(np.int32) for n in spec.decode('utf-8').split('|')])
+    gt = np.array([int(g) for g in gt.decode('utf-8').split('|')], dtype=np.int64)
+    return qa[:, :1], qa[:, 1:6], spec, gt
+
+
+def questions_map(qa, spec, gt, store=None):
+    with tf.device("/cpu:0"):
+        q, a, spec, gt = tf.py_func(partial(questions_load, store=store), [qa, spec, gt],
+                                    [tf.float32, tf.float32, tf.int32, tf.int64])
+        return tf.reshape(q, [-1, 1, embedding_size]), tf.reshape(a, [-1, 5, embedding_size]), \
+               tf.reshape(spec, [tf.shape(q)[0], -1]), tf.reshape(gt, [-1])
+
+
+def open_stores(mode):
+    """
+    Open the memory-mapped feature stores needed by mode. Build them with `python -m data.feature_store`.
+    :param mode: data mode, e.g. 'feat+subt'
+    :return subt_store, feat_store: FeatureStore or None
+    """
+    subt_store = FeatureStore(_mp.subtitle_feature_store, _mp.subtitle_feature_index) \
+        if 'subt' in mode else None
+    feat_store = FeatureStore(_mp.object_feature_store, _mp.object_feature_index) \
+        if 'feat' in mode else None
+    return subt_store, feat_store
+
+
+def context_sources(qa_list, store):
+    """
+    Sources of subtitle and object feature of each question. They are file paths,
+    or imdb keys if the data come from feature stores.
+    """
+    if store:
+        return [qa['imdb_key'] for qa in qa_list], [qa['imdb_key'] for qa in qa_list]
+    else:
+        return [join(_mp.encode_dir, qa['imdb_key'] + '.npy') for qa in qa_list], \
+               [join(_mp.object_feature_dir, qa['imdb_key'] + '.npy') for qa in qa_list]
+
+
+def question_sources(qa_list, store):
+    """
+    Sources of QA embedding and spec of each question. They are file paths,
+    or qids if the data come from the QA store.
+    """
+    if store:
+        return [qa['qid'] for qa in qa_list], [qa['qid'] for qa in qa_list]
+    else:
+        return [join(_mp.encode_dir, qa['qid'] + '.npy') for qa in qa_list], \
+               [join(_mp.encode_dir, qa['qid'] + '_spec' + '.npy') for qa in qa_list]
+
+
+def context_lengths(qa_list, qa_store=None):
+    """
+    Number of context rows (sampled frames) of each question, read from the QA store, or from the headers
+    of spec files. Questions of the same movie share the same context, so only one header per movie is read.
+    :param qa_list: list of qa
+    :param qa_store: QAStore or None
+    :return: list of context lengths aligned with qa_list
+    """
+    movie_length = {}
+    for qa in qa_list:
+        if qa['imdb_key'] not in movie_length:
+            if qa_store is not None:
+                movie_length[qa['imdb_key']] = qa_store.length(qa_store.row(qa['qid']))
+            else:
+                shape, _, _ = du.npy_header(join(_mp.encode_dir, qa['qid'] + '_spec' + '.npy'))
+                movie_length[qa['imdb_key']] = shape[0]
+    return [movie_length[qa['imdb_key']] for qa in qa_list]
+
+
+def spec_windows(qa_list, lengths, margin, qa_store=None):
+    """
+    Context rows of each question in the spec-window mode: from margin rows before the first frame of its spec
+    to margin rows after the last one.
+    :param qa_list: list of qa
+    :param lengths: context length of each question
+    :param margin: number of rows kept on each side
+    :param qa_store: QAStore or None, spec files are read if None
+    :return: list of (start, end) aligned with qa_list
+    """
+    windows = []
+    for qa, length in zip(qa_list, lengths):
+        if qa_store is not None:
+            intervals = qa_store.intervals(qa_store.row(qa['qid']))
+        else:
+            intervals = spec_intervals(np.load(join(_mp.encode_dir, qa['qid'] + '_spec' + '.npy')))
+        start, end = (int(intervals[0, 0]), int(intervals[-1, 1])) if len(intervals) else (0, length)
+        windows.append((max(start - margin, 0), min(end + margin, length)))
+    return windows
+
+
+def component_bytes(length, mode):
+    """
+    Bytes of each component of a question, as loaded into float32/int32 tensors.
+    :param length: number of context rows
+    :param mode: data mode, e.g. 'feat+subt'
+    :return: dictionary of bytes of qa, subt, feat and spec
+    """
+    subt = length if 'subt' in mode else 1
+    feat = length if 'feat' in mode else 1
+    return {'qa': 4 * 6 * embedding_size, 'subt': 4 * subt * embedding_size, 'feat': 4 * feat * 6 * 2048,
+            'spec': 4 * length}
+
+
+def element_bytes(length, mode, batch_size=1):
+    """
+    Bytes of an element of Input, as loaded into float32/int32/int64 tensors.
+    :param length: number of context rows
+    :param mode: data mode, e.g. 'feat+subt'
+    :param batch_size: number of questions per element
+    :return: bytes
+    """
+    # ques, ans, subt, feat and spec, then gt and length
+    return batch_size * (sum(component_bytes(length, mode).values()) + 8 + 8)
+
+
+def upstream_bytes(length, mode, batch_size=1):
+    """
+    Bytes held before the prefetch buffer of Input: the loader calls in flight and the prefetched elements
+    of each component, and with batch_size > 1 the questions which padded_batch gathers into the next batch.
+    :param length: number of context rows
+    :param mode: data mode, e.g. 'feat+subt'
+    :param batch_size: number of questions per element
+    :return: bytes
+    """
+    sizes = component_bytes(length, mode)
+    held = sum(2 * parallel_calls[k] * sizes[k] for k in sizes)
+    return held + (element_bytes(length, mode, batch_size) if batch_size > 1 else 0)
+
+
+def bucket(index, lengths, batch_size, shuffle=True):
+    """
+    Order questions so that each batch holds questions of similar context length.
+    Questions are cut into pools of `bucket_pool` batches, each pool is sorted by length and
+    split into batches, and then the batches are shuffled. The only incomplete batch is kept last,
+    so batch boundaries stay aligned with padded_batch.
+    :param index: list of question indices
+    :param lengths: context length of each question
+    :param batch_size: number of questions per batch
+    :param shuffle: shuffle the questions and the batches or not
+    :return: new order of question indices
+    """
+    index = list(index)
+    if shuffle:
+        random.shuffle(index)
+    pool_size = batch_size * bucket_pool
+    batches = []
+    for i in range(0, len(index), pool_size):
+        pool = sorted(index[i:i + pool_size], key=lambda j: lengths[j])
+        batches.extend(pool[j:j + batch_size] for j in range(0, len(pool), batch_size))
+    tail = [batches.pop()] if batches and len(batches[-1]) < batch_size else []
+    if shuffle:
+        random.shuffle(batches)
+    return [i for b in batches + tail for i in b]
+
+
+def group_by_movie(index, qa_list, shuffle=True):
+    """
+    Order questions movie by movie, so consecutive questions share the same context.
+    :param index: list of question indices
+    :param qa_list: list of qa
+    :param shuffle: shuffle the movies and the questions inside each movie or not
+    :return: new order of question indices
+    """
+    movies = OrderedDict()
+    for i in index:
+        movies.setdefault(qa_list[i]['imdb_key'], []).append(i)
+    groups = list(movies.values())
+    if shuffle:
+        random.shuffle(groups)
+        for g in groups:
+            random.shuffle(g)
+    return [i for g in groups for i in g]
+
+
+def add_length(qa, subt, feat, gt, spec):
+    # Spec has one entry per context row, so its length is the context length.
+    return qa, subt, feat, gt, spec, tf.shape(spec)[0]
+
+
 class Input(object):
-    def __init__(self, split='train', mode='feat+subt', shuffle=True):
+    """
+    Input pipeline of training and validation questions.
+    With batch_size == 1, each step gives one question:
+        ques (1, E), ans (5, E), subt (N, E), feat (N, 6, 2048), gt (1,), spec (N,)
+    With batch_size > 1, questions are bucketed by context length and padded to the longest context
+    N of the batch:
+        ques (B, 1, E), ans (B, 5, E), subt (B, N, E), feat (B, N, 6, 2048), gt (B,), spec (B, N),
+        length (B,): number of valid context rows, mask (B, N): 1.0 for valid rows, 0.0 for padding.
+    Padded rows have zero spec. Models consuming batches (e.g. model_full.1.BatchModel) must use mask
+    to keep padded rows out of attention.
+    With movie=True, questions are ordered movie by movie, and subtitle, feature and spec are read through
+    an LRU cache of cache_size bytes, so each movie is read from disk about once per epoch.
+    The elements held by the pipeline take at most prefetch_size bytes: the fixed buffers of each component and
+    of padded_batch, see upstream_bytes, and the prefetch buffer which gets the rest, see PrefetchPolicy.
+    With native=True, the .npy files are decoded by tensorflow ops instead of py_func, so the loaders are not
+    serialized on the GIL. The prefetch buffer counts no element either, so the graph of the input has no py_func
+    and its depth stays at the limit. It reads per-movie files only, and relies on the page cache instead of
+    the LRU cache.
+    With window=K, only the context rows from K rows before the first frame of the spec of a question to K rows
+    after its last one are read from disk, and spec is cut to the same rows. The models must tolerate a
+    truncated context.
+    With store=True, subtitle and feature are read from the feature stores, and with qa_store=True, QA embedding
+    and spec are read from the QA store. Otherwise they are read from the per-movie and per-question files.
+    """
+
+    def __init__(self, split='train', mode='feat+subt', shuffle=True, store=False, batch_size=1,
+                 movie=False, cache_size=4 * 1024 ** 3, prefetch_size=2 * 1024 ** 3, native=False, window=None,
+                 qa_store=False):
         self.shuffle = shuffle
+        self.batch_size = batch_size
+        self.movie = movie
+        self.cache = LRUCache(cache_size) if movie else None
         vsqa = [qa for qa in du.json_load(_mp.qa_file) if qa['video_clips']]
         self.qa = [qa for qa in vsqa if split in qa['qid']]
         self.index = list(range(len(self)))
-        self._feed_dict = {
-            tf.placeholder(dtype=tf.string, shape=[None]):
-                [join(_mp.encode_dir, qa['qid'] + '.npy') for qa in self.qa],
-            tf.placeholder(dtype=tf.string, shape=[None]):
-                [join(_mp.encode_dir, qa['imdb_key'] + '.npy') for qa in self.qa],
-            tf.placeholder(dtype=tf.string, shape=[None]):
-                [join(_mp.object_feature_dir, qa['imdb_key'] + '.npy') for qa in self.qa],
-            tf.placeholder(dtype=tf.int64, shape=[None]): [qa['correct_index'] for qa in self.qa],
-            tf.placeholder(dtype=tf.string, shape=[None]):
-                [join(_mp.encode_dir, qa['qid'] + '_spec' + '.npy') for qa in self.qa],
-        }
-        self.placeholders = list(self.feed_dict.keys())
+        self.qa_store = QAStore() if qa_store else None
+        self.lengths = context_lengths(self.qa, self.qa_store)
+        if window is not None:
+            if native:
+                raise ValueError('The native reader decodes whole files, and can not read spec windows.')
+            self.windows = spec_windows(self.qa, self.lengths, window, self.qa_store)
+            self.lengths = [end - start for start, end in self.windows]
+        # The native reader runs no python per element, and neither does the prefetch buffer.
+        length = max(self.lengths, default=1)
+        self.prefetch = PrefetchPolicy(prefetch_size, element_bytes(length, mode, batch_size),
+                                       max_depth=max(128 // batch_size, 1), sample_every=0 if native else None,
+                                       reserved=upstream_bytes(length, mode, batch_size))
+        self.prefetch_size = tf.placeholder(dtype=tf.int64, shape=[])
+        self.subt_store, self.feat_store = open_stores(mode) if store else (None, None)
+        subt_source, feat_source = context_sources(self.qa, store)
+        qa_source, spec_source = question_sources(self.qa, qa_store)
+        if native:
+            if store or qa_store:
+                raise ValueError('The native reader decodes .npy files, and can not read feature or QA stores.')
+            self._feed_dict = {}
+            qa_source, qa_dtype = native_source(qa_source, self._feed_dict)
+            subt_source, subt_dtype = native_source(subt_source, self._feed_dict, 'subt' in mode)
+            feat_source, feat_dtype = native_source(feat_source, self._feed_dict, 'feat' in mode)
+            gt_source = tf.placeholder(dtype=tf.int64, shape=[None])
+            self._feed_dict[gt_source] = [qa['correct_index'] for qa in self.qa]
+            spec_source, spec_dtype = native_source(spec_source, self._feed_dict)
+            self.placeholders = [qa_source, subt_source, feat_source, gt_source, spec_source]
+            qa_func = partial(native_load, comp='qa', mode=mode, dtype=qa_dtype)
+            subt_func = partial(native_load, comp='subt', mode=mode, dtype=subt_dtype)
+            feat_func = partial(native_load, comp='feat', mode=mode, dtype=feat_dtype)
+            spec_func = partial(native_load, comp='spec', mode=mode, dtype=spec_dtype)
+        else:
+            self._feed_dict = {
+                tf.placeholder(dtype=tf.string, shape=[None]): qa_source,
+                tf.placeholder(dtype=tf.string, shape=[None]): subt_source,
+                tf.placeholder(dtype=tf.string, shape=[None]): feat_source,
+                tf.placeholder(dtype=tf.int64, shape=[None]): [qa['correct_index'] for qa in self.qa],
+                tf.placeholder(dtype=tf.string, shape=[None]): spec_source,
+            }
+            self.placeholders = list(self._feed_dict.keys())
+            qa_func = partial(load, comp='qa', mode=mode, store=self.qa_store)
+            subt_func = partial(load, comp='subt', mode=mode, store=self.subt_store, cache=self.cache)
+            feat_func = partial(load, comp='feat', mode=mode, store=self.feat_store, cache=self.cache)
+            spec_func = partial(load, comp='spec', mode=mode, store=self.qa_store, cache=self.cache)
+        if window is not None:
+            window_source = (tf.placeholder(dtype=tf.int64, shape=[None]), tf.placeholder(dtype=tf.int64, shape=[None]))
+            self._feed_dict[window_source[0]] = [start for start, _ in self.windows]
+            self._feed_dict[window_source[1]] = [end for _, end in self.windows]
+            self.placeholders = [self.placeholders[0], (self.placeholders[1],) + window_source,
+                                 (self.placeholders[2],) + window_source, self.placeholders[3],
+                                 (self.placeholders[4],) + window_source]
+            subt_func = partial(window_load, comp='subt', mode=mode, store=self.subt_store, cache=self.cache)
+            feat_func = partial(window_load, comp='feat', mode=mode, store=self.feat_store, cache=self.cache)
+            spec_func = partial(window_load, comp='spec', mode=mode, store=self.qa_store, cache=self.cache)
         dataset = tf.data.Dataset.from_tensor_slices(self.placeholders[0]).repeat(1)
-        func = partial(load, comp='qa', mode=mode)
-        qa_dataset = dataset.map(func, num_parallel_calls=1).prefetch(1)
+        qa_dataset = dataset.map(qa_func, num_parallel_calls=parallel_calls['qa'])
+        qa_dataset = qa_dataset.prefetch(parallel_calls['qa'])
         dataset = tf.data.Dataset.from_tensor_slices(self.placeholders[1]).repeat(1)
-        func = partial(load, comp='subt', mode=mode)
-        subt_dataset = dataset.map(func, num_parallel_calls=2).prefetch(2)
+        subt_dataset = dataset.map(subt_func, num_parallel_calls=parallel_calls['subt'])
+        subt_dataset = subt_dataset.prefetch(parallel_calls['subt'])
         dataset = tf.data.Dataset.from_tensor_slices(self.placeholders[2]).repeat(1)
-        func = partial(load, comp='feat', mode=mode)
-        feat_dataset = dataset.map(func, num_parallel_calls=4).prefetch(4)
+        feat_dataset = dataset.map(feat_func, num_parallel_calls=parallel_calls['feat'])
+        feat_dataset = feat_dataset.prefetch(parallel_calls['feat'])
         gt_dataset = tf.data.Dataset.from_tensor_slices(self.placeholders[3]).repeat(1)
         dataset = tf.data.Dataset.from_tensor_slices(self.placeholders[4]).repeat(1)
-        func = partial(load, comp='spec', mode=mode)
-        spec_dataset = dataset.map(func, num_parallel_calls=1).prefetch(1)
+        spec_dataset = dataset.map(spec_func, num_parallel_calls=parallel_calls['spec'])
+        spec_dataset = spec_dataset.prefetch(parallel_calls['spec'])
 
         dataset = tf.data.Dataset.zip((qa_dataset, subt_dataset, feat_dataset, gt_dataset, spec_dataset))
-        dataset = dataset.prefetch(128)
+        if batch_size > 1:
+            dataset = dataset.map(add_length)
+            dataset = dataset.padded_batch(batch_size, padded_shapes=dataset.output_shapes)
+        dataset = self.prefetch.prefetch(dataset, self.prefetch_size)
         iterator = dataset.make_initializable_iterator()
-        next_element = iterator.get_next()
-        (self.ques, self.ans), self.subt, self.feat, self.gt, self.spec = next_element
-        self.gt = tf.expand_dims(self.gt, axis=0)
+        next_element = self.prefetch.mark_consumed(iterator.get_next())
+        if batch_size > 1:
+            (self.ques, self.ans), self.subt, self.feat, self.gt, self.spec, self.length = next_element
+            self.mask = tf.sequence_mask(self.length, tf.shape(self.spec)[1], dtype=tf.float32)
+        else:
+            (self.ques, self.ans), self.subt, self.feat, self.gt, self.spec = next_element
+            self.gt = tf.expand_dims(self.gt, axis=0)
         self.next_element = (self.ques, self.ans, self.subt, self.feat, self.gt, self.spec)
         self.initializer = iterator.initializer
 
     def __len__(self):
         return len(self.qa)
 
+    @property
+    def num_step(self):
+        """Number of steps (batches) in one epoch."""
+        return int(math.ceil(len(self) / self.batch_size))
+
     @property
     def feed_dict(self):
-        if self.shuffle:
+        if self.movie:
+            # Questions of a movie have the same context length, so batches need little padding.
+            self.index = group_by_movie(range(len(self)), self.qa, self.shuffle)
+            feed_dict = {k: [self._feed_dict[k][i] for i in self.index] for k in self._feed_dict}
+        elif self.batch_size > 1:
+            self.index = bucket(range(len(self)), self.lengths, self.batch_size, self.shuffle)
+            feed_dict = {k: [self._feed_dict[k][i] for i in self.index] for k in self._feed_dict}
+        elif self.shuffle:
             random.shuffle(self.index)
-            return {k: [self._feed_dict[k][i] for i in self.index] for k in self._feed_dict}
+            feed_dict = {k: [self._feed_dict[k][i] for i in self.index] for k in self._feed_dict}
+        else:
+            feed_dict = dict(self._feed_dict)
+        feed_dict[self.prefetch_size] = self.prefetch.next_depth()
+        return feed_dict
+
+
+def movie_chunks(qa_list, max_questions, shuffle=True):
+    """
+    Cut the questions of each movie into chunks of at most max_questions questions.
+    :return: list of chunks, each a list of question indices of the same movie
+    """
+    index = group_by_movie(range(len(qa_list)), qa_list, shuffle)
+    chunks = []
+    for i in index:
+        if chunks and len(chunks[-1]) < max_questions and \
+                qa_list[chunks[-1][0]]['imdb_key'] == qa_list[i]['imdb_key']:
+            chunks[-1].append(i)
         else:
-            return self._feed_dict
+            chunks.append([i])
+    return chunks
+
+
+class MovieInput(object):
+    """
+    Input pipeline giving several questions of a movie together with the context they share,
+    so a model (e.g. model_full.1.MovieModel) projects the movie context once per step:
+        ques (Q, 1, E), ans (Q, 5, E), subt (N, E), feat (N, 6, 2048), gt (Q,), spec (Q, N)
+    Q is at most max_questions. The context of a movie is read once per chunk of its questions.
+    """
+
+    def __init__(self, split='train', mode='feat+subt', shuffle=True, store=False, max_questions=16, qa_store=False):
+        self.shuffle = shuffle
+        self.store = store
+        self.max_questions = max_questions
+        vsqa = [qa for qa in du.json_load(_mp.qa_file) if qa['video_clips']]
+        self.qa = [qa for qa in vsqa if split in qa['qid']]
+        self.subt_store, self.feat_store = open_stores(mode) if store else (None, None)
+        self.qa_store = QAStore() if qa_store else None
+        self.chunks = movie_chunks(self.qa, max_questions, shuffle=False)
+        self.placeholders = [tf.placeholder(dtype=tf.string, shape=[None]) for _ in range(5)]
+
+        dataset = tf.data.Dataset.from_tensor_slices(
+            (self.placeholders[0], self.placeholders[3], self.placeholders[4])).repeat(1)
+        func = partial(questions_map, store=self.qa_store)
+        qa_dataset = dataset.map(func, num_parallel_calls=2).prefetch(2)
+        dataset = tf.data.Dataset.from_tensor_slices(self.placeholders[1]).repeat(1)
+        func = partial(load, comp='subt', mode=mode, store=self.subt_store)
+        subt_dataset = dataset.map(func, num_parallel_calls=2).prefetch(2)
+        dataset = tf.data.Dataset.from_tensor_slices(self.placeholders[2]).repeat(1)
+        func = partial(load, comp='feat', mode=mode, store=self.feat_store)
+        feat_dataset = dataset.map(func, num_parallel_calls=2).prefetch(2)
+
+        dataset = tf.data.Dataset.zip((qa_dataset, subt_dataset, feat_dataset))
+        dataset = dataset.prefetch(4)
+        iterator = dataset.make_initializable_iterator()
+        next_element = iterator.get_next()
+        (self.ques, self.ans, self.spec, self.gt), self.subt, self.feat = next_element
+        self.next_element = (self.ques, self.ans, self.subt, self.feat, self.gt, self.spec)
+        self.initializer = iterator.initializer
+
+    def __len__(self):
+        return len(self.qa)
+
+    @property
+    def num_step(self):
+        """Number of steps (chunks of questions) in one epoch."""
+        return len(self.chunks)
+
+    @property
+    def feed_dict(self):
+        if self.shuffle:
+            self.chunks = movie_chunks(self.qa, self.max_questions, shuffle=True)
+        subt_source, feat_source = context_sources([self.qa[c[0]] for c in self.chunks], self.store)
+        qa_source, spec_source = question_sources(self.qa, self.qa_store is not None)
+        values = [
+            ['|'.join(qa_source[i] for i in c) for c in self.chunks],
+            subt_source,
+            feat_source,
+            ['|'.join(spec_source[i] for i in c) for c in self.chunks],
+            ['|'.join(str(self.qa[i]['correct_index']) for i in c) for c in self.chunks],
+        ]
+        # Order of placeholders: qa, subt, feat, spec, gt
+        return dict(zip(self.placeholders, values))
 
 
 class TestInput(object):
-    def __init__(self, mode='feat+subt', shuffle=True):
+    def __init__(self, mode='feat+subt', shuffle=True, store=False, prefetch_size=2 * 1024 ** 3, qa_store=False):
         self.shuffle = shuffle
         vsqa = [qa for qa in du.json_load(_mp.qa_file) if qa['video_clips']]
         self.qa = [qa for qa in vsqa if 'test' in qa['qid']]
         self.index = list(range(len(self)))
+        self.qa_store = QAStore() if qa_store else None
+        length = max(context_lengths(self.qa, self.qa_store), default=1)
+        self.prefetch = PrefetchPolicy(prefetch_size, element_bytes(length, mode),
+                                       reserved=upstream_bytes(length, mode))
+        self.prefetch_size = tf.placeholder(dtype=tf.int64, shape=[])
+        self.subt_store, self.feat_store = open_stores(mode) if store else (None, None)
+        subt_source, feat_source = context_sources(self.qa, store)
+        qa_source, spec_source = question_sources(self.qa, qa_store)
         self._feed_dict = {
-            tf.placeholder(dtype=tf.string, shape=[None]):
-                [join(_mp.encode_dir, qa['qid'] + '.npy') for qa in self.qa],
-            tf.placeholder(dtype=tf.string, shape=[None]):
-                [join(_mp.encode_dir, qa['imdb_key'] + '.npy') for qa in self.qa],
-            tf.placeholder(dtype=tf.string, shape=[None]):
-                [join(_mp.object_feature_dir, qa['imdb_key'] + '.npy') for qa in self.qa],
-            tf.placeholder(dtype=tf.string, shape=[None]):
-                [join(_mp.encode_dir, qa['qid'] + '_spec' + '.npy') for qa in self.qa],
+            tf.placeholder(dtype=tf.string, shape=[None]): qa_source,
+            tf.placeholder(dtype=tf.string, shape=[None]): subt_source,
+            tf.placeholder(dtype=tf.string, shape=[None]): feat_source,
+            tf.placeholder(dtype=tf.string, shape=[None]): spec_source,
         }
-        self.placeholders = list(self.feed_dict.keys())
+        self.placeholders = list(self._feed_dict.keys())
         dataset = tf.data.Dataset.from_tensor_slices(self.placeholders[0]).repeat(1)
-        func = partial(load, comp='qa', mode=mode)
-        qa_dataset = dataset.map(func, num_parallel_calls=1).prefetch(1)
+        func = partial(load, comp='qa', mode=mode, store=self.qa_store)
+        qa_dataset = dataset.map(func, num_parallel_calls=parallel_calls['qa'])
+        qa_dataset = qa_dataset.prefetch(parallel_calls['qa'])
         dataset = tf.data.Dataset.from_tensor_slices(self.placeholders[1]).repeat(1)
-        func = partial(load, comp='subt', mode=mode)
-        subt_dataset = dataset.map(func, num_parallel_calls=2).prefetch(2)
+        func = partial(load, comp='subt', mode=mode, store=self.subt_store)
+        subt_dataset = dataset.map(func, num_parallel_calls=parallel_calls['subt'])
+        subt_dataset = subt_dataset.prefetch(parallel_calls['subt'])
         dataset = tf.data.Dataset.from_tensor_slices(self.placeholders[2]).repeat(1)
-        func = partial(load, comp='feat', mode=mode)
-        feat_dataset = dataset.map(func, num_parallel_calls=4).prefetch(4)
+        func = partial(load, comp='feat', mode=mode, store=self.feat_store)
+        feat_dataset = dataset.map(func, num_parallel_calls=parallel_calls['feat'])
+        feat_dataset = feat_dataset.prefetch(parallel_calls['feat'])
         dataset = tf.data.Dataset.from_tensor_slices(self.placeholders[3]).repeat(1)
-        func = partial(load, comp='spec', mode=mode)
-        spec_dataset = dataset.map(func, num_parallel_calls=1).prefetch(1)
+        func = partial(load, comp='spec', mode=mode, store=self.qa_store)
+        spec_dataset = dataset.map(func, num_parallel_calls=parallel_calls['spec'])
+        spec_dataset = spec_dataset.prefetch(parallel_calls['spec'])
 
         dataset = tf.data.Dataset.zip((qa_dataset, subt_dataset, feat_dataset, spec_dataset))
-        dataset = dataset.prefetch(128)
+        dataset = self.prefetch.prefetch(dataset, self.prefetch_size)
         iterator = dataset.make_initializable_iterator()
-        next_element = iterator.get_next()
+        next_element = self.prefetch.mark_consumed(iterator.get_next())
         (self.ques, self.ans), self.subt, self.feat, self.spec = next_element
         self.next_element = (self.ques, self.ans, self.subt, self.feat, self.spec)
         self.initializer = iterator.initializer
@@ -152,9 +902,11 @@ class TestInput(object):
     def feed_dict(self):
         if self.shuffle:
             random.shuffle(self.index)
-            return {k: [self._feed_dict[k][i] for i in self.index] for k in self._feed_dict}
+            feed_dict = {k: [self._feed_dict[k][i] for i in self.index] for k in self._feed_dict}
         else:
-            return self._feed_dict
+            feed_dict = dict(self._feed_dict)
+        feed_dict[self.prefetch_size] = self.prefetch.next_depth()
+        return feed_dict
 
 
 def main():
@@ -35,7 +35,7 @@ class TestManager(object):
         fu.make_dirs(self._attn_dir)
         fu.make_dirs(_mp.test_dir)
 
-        self.test_data = TestInput(mode=args.mode)
+        self.test_data = TestInput(mode=args.mode, store=args.store, qa_store=args.qa_store)
 
         self.test_model = mod.Model(self.test_data, scale=hp['reg'], training=True)
 
@@ -134,6 +134,8 @@ if __name__ == '__main__':
     parser.add_argument('--hp', default='01', help='Hyper-parameters.')
     parser.add_argument('--extra', default='', help='Extra model name.')
     parser.add_argument('--attn', action='store_true', help='Save attention.')
+    parser.add_argument('--store', action='store_true', help='Read subtitle and feature from feature stores.')
+    parser.add_argument('--qa_store', action='store_true', help='Read QA embedding and spec from the QA store.')
     # parser.add_argument('--reg', action='store_true', help='Regularize the model.')
     args = parser.parse_args()
     mod = importlib.import_module('model.' + args.mod)
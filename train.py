@@ -12,7 +12,7 @@ from tqdm import trange
 from config import MovieQAPath
 # from input import Input as In
 # from input_v2 import Input as In2
-from raw_input import Input
+from raw_input import Input, MovieInput
 from utils import func_utils as fu
 from utils import model_utils as mu
 
@@ -34,13 +34,32 @@ class TrainManager(object):
         fu.make_dirs(self._log_dir)
         fu.make_dirs(self._attn_dir)
 
-        self.train_data = Input(split='train', mode=args.mode)
-        self.val_data = Input(split='val', mode=args.mode)
+        if args.shared:
+            self.train_data = MovieInput(split='train', mode=args.mode, store=args.store,
+                                         max_questions=args.max_questions, qa_store=args.qa_store)
+            self.val_data = MovieInput(split='val', mode=args.mode, shuffle=False, store=args.store,
+                                       max_questions=args.max_questions, qa_store=args.qa_store)
+        else:
+            self.train_data = Input(split='train', mode=args.mode, store=args.store, batch_size=args.batch_size,
+                                    movie=args.movie, cache_size=int(args.cache_gb * 1024 ** 3),
+                                    prefetch_size=int(args.prefetch_gb * 1024 ** 3), native=args.native,
+                                    window=args.window if args.window >= 0 else None, qa_store=args.qa_store)
+            self.val_data = Input(split='val', mode=args.mode, store=args.store, batch_size=args.batch_size,
+                                  movie=args.movie, cache_size=int(args.cache_gb * 1024 ** 3),
+                                  prefetch_size=int(args.prefetch_gb * 1024 ** 3), native=args.native,
+                                  window=args.window if args.window >= 0 else None, qa_store=args.qa_store)
         # self.test_data = TestInput()
 
-        self.train_model = mod.Model(self.train_data, scale=hp['reg'], training=True)
+        if args.shared:
+            model_fn = mod.MovieModel
+        elif args.batch_size > 1:
+            model_fn = mod.BatchModel
+        else:
+            model_fn = mod.Model
+
+        self.train_model = model_fn(self.train_data, scale=hp['reg'], training=True)
         with tf.variable_scope(tf.get_variable_scope(), reuse=True):
-            self.val_model = mod.Model(self.val_data)
+            self.val_model = model_fn(self.val_data)
 
         # with tf.variable_scope(tf.get_variable_scope(), reuse=True):
         #     self.test_model = mod.Model(self.test_data, training=False)
@@ -65,7 +84,7 @@ class TrainManager(object):
 
         self.global_step = tf.train.get_or_create_global_step()
 
-        decay_step = int(hp['decay_epoch'] * len(self.train_data))
+        decay_step = int(hp['decay_epoch'] * self.train_data.num_step)
         self.learning_rate = mu.get_lr(hp['decay_type'], hp['learning_rate'], self.global_step,
                                        decay_step, hp['decay_rate'])
 
@@ -145,12 +164,12 @@ class TrainManager(object):
             try:
                 while True:
                     step = tf.train.global_step(sess, self.global_step)
-                    epoch = math.floor(step / len(self.train_data)) + 1
+                    epoch = math.floor(step / self.train_data.num_step) + 1
 
                     # Train Loop
                     sess.run(self.train_init_op_list, feed_dict=self.train_data.feed_dict)
 
-                    with trange(epoch * len(self.train_data) - step) as pbar:
+                    with trange(epoch * self.train_data.num_step - step) as pbar:
 
                         for i in pbar:
                             if step % 10000 == 0:
@@ -187,10 +206,14 @@ class TrainManager(object):
                                 train_pair[qa['qid'].replace(':', '')] = np.stack([gt, ans])
 
                     self.saver.save(sess, self._checkpoint_file, step)
+                    if getattr(self.train_data, 'cache', None):
+                        print('Train cache:', self.train_data.cache.stats())
+                    if getattr(self.train_data, 'prefetch', None):
+                        print('Train prefetch:', self.train_data.prefetch.stats())
 
                     # Validation Loop
                     sess.run(self.val_init_op_list, feed_dict=self.val_data.feed_dict)
-                    with trange(len(self.val_data)) as pbar:
+                    with trange(self.val_data.num_step) as pbar:
                         for i in pbar:
                             if attn:
                                 acc, _, summary, attention, belief, gt, ans = sess.run(self.val_op_list)
@@ -254,6 +277,17 @@ if __name__ == '__main__':
     parser.add_argument('--hp', default='01', help='Hyper-parameters.')
     parser.add_argument('--extra', default='', help='Extra model name.')
     parser.add_argument('--attn', action='store_true', help='Save attention.')
+    parser.add_argument('--store', action='store_true', help='Read subtitle and feature from feature stores.')
+    parser.add_argument('--qa_store', action='store_true', help='Read QA embedding and spec from the QA store.')
+    parser.add_argument('--batch_size', default=1, type=int, help='Number of questions per step.')
+    parser.add_argument('--movie', action='store_true', help='Group questions by movie, and cache movie context.')
+    parser.add_argument('--cache_gb', default=4.0, type=float, help='Size of movie context cache in GB.')
+    parser.add_argument('--prefetch_gb', default=2.0, type=float, help='Size of data held by the input pipeline in GB.')
+    parser.add_argument('--native', action='store_true', help='Decode npy files with tensorflow ops, not py_func.')
+    parser.add_argument('--window', default=-1, type=int,
+                        help='Read only context rows around spec with this margin, -1 for whole context.')
+    parser.add_argument('--shared', action='store_true', help='Score questions of a movie on shared context.')
+    parser.add_argument('--max_questions', default=16, type=int, help='Max questions per step with --shared.')
 
     # parser.add_argument('--reg', action='store_true', help='Regularize the model.')
     args = parser.parse_args()
@@ -262,4 +296,13 @@ if __name__ == '__main__':
     reset = args.reset
     debug = args.debug
     attn = args.attn
+    if attn and args.batch_size > 1:
+        parser.error('--attn only supports --batch_size 1.')
+    if args.shared and (attn or args.batch_size > 1):
+        parser.error('--shared can not be used with --attn or --batch_size.')
+    # Only some models implement the batched and the shared movie context inputs, e.g. model_full.1.
+    if args.shared and not hasattr(mod, 'MovieModel'):
+        parser.error('model.%s has no MovieModel for --shared.' % args.mod)
+    if args.batch_size > 1 and not hasattr(mod, 'BatchModel'):
+        parser.error('model.%s has no BatchModel for --batch_size %d.' % (args.mod, args.batch_size))
     main()
@@ -1,4 +1,6 @@
+import hashlib
 import json
+import os
 from collections import OrderedDict
 from functools import reduce
 from operator import or_
@@ -6,6 +8,7 @@ from os.path import join, exists
 
 import numpy as np
 import tensorflow as tf
+from numpy.lib.format import read_magic, read_array_header_1_0, read_array_header_2_0
 
 from config import MovieQAConfig
 from . import func_utils as fu
@@ -34,9 +37,18 @@ def exist_json_load(file_name, default=None):
         return default
 
 
+def json_default(obj):
+    """Serialize numpy arrays and scalars, e.g. columns loaded by data.columnar, and lazy views with tolist()."""
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if hasattr(obj, 'tolist'):
+        return obj.tolist()
+    raise TypeError('Object of type %s is not JSON serializable' % type(obj).__name__)
+
+
 def json_dump(obj, file_name, ensure_ascii=False, indent=4):
     with open(file_name, 'w') as f:
-        json.dump(obj, f, ensure_ascii=ensure_ascii, indent=indent)
+        json.dump(obj, f, ensure_ascii=ensure_ascii, indent=indent, default=json_default)
 
 
 def json_load(file_name):
@@ -45,10 +57,99 @@ def json_load(file_name):
     return data
 
 
+def part_name(file_name):
+    """Temporary name where a file is written before it is renamed to file_name."""
+    return file_name + '.part'
+
+
+def commit_part(file_name):
+    """
+    Atomically replace file_name with its finished temporary file.
+    :param file_name: final path
+    :return: None
+    """
+    with open(part_name(file_name), 'rb') as f:
+        os.fsync(f.fileno())
+    os.replace(part_name(file_name), file_name)
+
+
+def atomic_json_dump(obj, file_name, ensure_ascii=False, indent=4):
+    """json_dump which never leaves a truncated file behind."""
+    json_dump(obj, part_name(file_name), ensure_ascii, indent)
+    commit_part(file_name)
+
+
+def atomic_save(file_name, arr):
+    """np.save which never leaves a truncated file behind."""
+    with open(part_name(file_name), 'wb') as f:
+        np.save(f, arr)
+    commit_part(file_name)
+
+
+def array_checksum(arr, chunk_rows=256):
+    """
+    sha1 of the data of an array, read chunk by chunk, so a memory-mapped array is never loaded at once.
+    :param arr: array or memory map
+    :param chunk_rows: number of rows hashed at a time
+    :return: hex digest
+    """
+    h = hashlib.sha1()
+    for i in range(0, len(arr), chunk_rows):
+        h.update(np.ascontiguousarray(arr[i:i + chunk_rows]).tobytes())
+    return h.hexdigest()
+
+
+def file_checksum(file_name, chunk_size=1 << 20):
+    """
+    sha1 of the content of a file, read chunk by chunk.
+    :param file_name: path of file
+    :param chunk_size: number of bytes hashed at a time
+    :return: hex digest
+    """
+    h = hashlib.sha1()
+    with open(file_name, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def json_checksum(obj):
+    """sha1 of the json form of an object, e.g. to find out if a piece of text changed."""
+    return hashlib.sha1(json.dumps(obj, ensure_ascii=False, sort_keys=True,
+                                   default=json_default).encode('utf-8')).hexdigest()
+
+
 def get_npy_name(feature_dir, video):
     return join(feature_dir, NPY_PATTERN_ % video)
 
 
+def npy_header(file_name):
+    """
+    Read the header of a .npy file without touching its data.
+    :param file_name: path of .npy file
+    :return shape, fortran_order, dtype: header information of the array
+    """
+    with open(file_name, 'rb') as f:
+        if read_magic(f) == (1, 0):
+            return read_array_header_1_0(f)
+        else:
+            return read_array_header_2_0(f)
+
+
+def npy_layout(file_name):
+    """
+    Where the data of a .npy file are, so they can be read without numpy.
+    :param file_name: path of .npy file
+    :return shape, fortran_order, dtype, offset: header information, and number of bytes before the data
+    """
+    with open(file_name, 'rb') as f:
+        if read_magic(f) == (1, 0):
+            header = read_array_header_1_0(f)
+        else:
+            header = read_array_header_2_0(f)
+        return header + (f.tell(),)
+
+
 def probe_type(value):
     return (vec_type_check(value) and reduce(or_, [probe_type(e) for e in value])) or \
            set([type(e) for e in value])
@@ -146,6 +247,9 @@ def to_feature(value, feature_list=False):
 
 def int64_feature(value):
     """Wrapper for inserting an int64 Feature into a SequenceExample proto."""
+    if isinstance(value, np.ndarray):
+        # One conversion of the whole array is much faster than converting element by element.
+        value = value.tolist()
     if not type_check(value):
         value = [value]
     return tf.train.Feature(int64_list=tf.train.Int64List(value=value))
@@ -160,6 +264,9 @@ def bytes_feature(value):
 
 def float_feature(value):
     """Wrapper for inserting a float Feature into a SequenceExample proto."""
+    if isinstance(value, np.ndarray):
+        # One conversion of the whole array is much faster than converting element by element.
+        value = value.tolist()
     if not type_check(value):
         value = [value]
     return tf.train.Feature(float_list=tf.train.FloatList(value=value))
@@ -167,6 +274,8 @@ def float_feature(value):
 
 def int64_feature_list(values):
     """Wrapper for inserting an int64 FeatureList into a SequenceExample proto."""
+    if isinstance(values, np.ndarray):
+        values = values.tolist()
     return tf.train.FeatureList(feature=[int64_feature(v) for v in values])
 
 
@@ -177,6 +286,8 @@ def bytes_feature_list(values):
 
 def float_feature_list(values):
     """Wrapper for inserting a float FeatureList into a SequenceExample proto."""
+    if isinstance(values, np.ndarray):
+        values = values.tolist()
     return tf.train.FeatureList(feature=[float_feature(v) for v in values])
 
 
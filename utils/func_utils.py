@@ -1,7 +1,8 @@
 import os
 import re
 import shutil
-from multiprocessing import Pool
+from contextlib import contextmanager
+from multiprocessing import Pool, get_context
 
 from tqdm import tqdm
 
@@ -49,6 +50,26 @@ def parfor(func, iterable, desc='', ret=False, order=False, num_thread=8):
         return res
 
 
+@contextmanager
+def shared_pool(shared, num_process, **data):
+    """
+    Pool of workers which read data from a module-level dict. The dict is filled before the workers are
+    forked, so they inherit the data without any copy through pipes, and it is cleared when the pool is
+    done, even if a worker raised. The pool uses the fork start method, since spawned workers would see an
+    empty dict.
+    :param shared: module-level dict read by the worker functions
+    :param num_process: number of workers
+    :param data: entries of the dict
+    :return: pool
+    """
+    shared.update(data)
+    try:
+        with get_context('fork').Pool(num_process) as pool:
+            yield pool
+    finally:
+        shared.clear()
+
+
 def imdb_key(base_name):
     return base_name.split('.')[0]
 